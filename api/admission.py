@@ -0,0 +1,239 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from fastapi import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+READ = "read"
+WRITE = "write"
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a repository operation is not admitted.
+
+    Attributes:
+        retry_after (int): Seconds the client should wait before retrying.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Admission rejected, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter for one route class with a bounded wait queue.
+
+    The limit follows an AIMD rule driven by the observed latency of admitted
+    operations: it grows by about one slot per window of completions that stay
+    under the target latency and is cut by a factor when they exceed it, at
+    most once per target latency interval.
+    """
+
+    def __init__(self, initial_limit: int = 20, min_limit: int = 1, max_limit: int = 100,
+                 max_queue: int = 100, max_wait: float = 1.0, target_latency: float = 0.05,
+                 decrease_factor: float = 0.9):
+        """
+        Initialize the limiter.
+
+        Args:
+            initial_limit (int): Concurrent operations allowed at start.
+            min_limit (int): Lower bound of the adaptive limit.
+            max_limit (int): Upper bound of the adaptive limit.
+            max_queue (int): Maximum number of waiting operations.
+            max_wait (float): Seconds an operation may wait for a slot.
+            target_latency (float): Latency in seconds above which the limit shrinks.
+            decrease_factor (float): Factor applied to the limit on a slow operation.
+        """
+        self.limit: float = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.latency = target_latency
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+
+    @property
+    def queued(self) -> int:
+        """
+        Number of operations waiting for a slot.
+        """
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        """
+        Wait for a slot.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait timed out.
+        """
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just before giving up on it.
+                self._hand_over()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(error, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise AdmissionRejected(self.retry_after()) from error
+            raise
+        self.admitted += 1
+
+    def release(self, latency: float) -> None:
+        """
+        Give a slot back and adapt the limit to the operation latency.
+
+        Args:
+            latency (float): Seconds the operation held its slot.
+        """
+        self.latency += (latency - self.latency) * 0.2
+        now = time.monotonic()
+        if latency > self.target_latency:
+            if now - self._last_decrease >= self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self._last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._hand_over()
+
+    def _hand_over(self) -> None:
+        """
+        Pass the released slot to the next waiter, or free it.
+        """
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.in_flight += 1
+
+    def retry_after(self) -> int:
+        """
+        Estimate how long the current backlog needs to drain.
+
+        Returns:
+            int: Whole seconds, at least 1.
+        """
+        return max(1, math.ceil((len(self._waiters) + 1) * self.latency / max(1, int(self.limit))))
+
+    def snapshot(self) -> dict:
+        """
+        Describe the current state of the limiter.
+
+        Returns:
+            dict: Limit, in-flight and queued operations and counters.
+        """
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "latency_ms": round(self.latency * 1000, 3),
+        }
+
+
+class AdmissionController:
+    """
+    Holds one AdaptiveLimiter per route class.
+    """
+
+    def __init__(self, limiters: Dict[str, AdaptiveLimiter]):
+        """
+        Initialize the controller.
+
+        Args:
+            limiters (Dict[str, AdaptiveLimiter]): Limiters keyed by route class.
+        """
+        self.limiters = limiters
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        """
+        Build a controller for the read and write route classes.
+
+        Settings are read from ADMISSION_<CLASS>_<SETTING> environment
+        variables, e.g. ADMISSION_READ_MAX_QUEUE.
+
+        Returns:
+            AdmissionController: The configured controller.
+        """
+        def limiter(route_class: str, initial_limit: int) -> AdaptiveLimiter:
+            prefix = f"ADMISSION_{route_class.upper()}_"
+            return AdaptiveLimiter(
+                initial_limit=int(os.getenv(prefix + "INITIAL_LIMIT", str(initial_limit))),
+                min_limit=int(os.getenv(prefix + "MIN_LIMIT", "1")),
+                max_limit=int(os.getenv(prefix + "MAX_LIMIT", "100")),
+                max_queue=int(os.getenv(prefix + "MAX_QUEUE", "100")),
+                max_wait=float(os.getenv(prefix + "MAX_WAIT", "1.0")),
+                target_latency=float(os.getenv(prefix + "TARGET_LATENCY", "0.05")),
+            )
+
+        return cls({READ: limiter(READ, 20), WRITE: limiter(WRITE, 10)})
+
+    def snapshot(self) -> dict:
+        """
+        Describe the state of every route class.
+
+        Returns:
+            dict: Limiter snapshots keyed by route class.
+        """
+        return {route_class: limiter.snapshot() for route_class, limiter in self.limiters.items()}
+
+
+admission_controller = AdmissionController.from_env()
+
+
+def admit(route_class: str):
+    """
+    Build a dependency that holds a slot of a route class for the request.
+
+    Declare it before the repository dependency so that no database session
+    is opened for a request that is not admitted.
+
+    Args:
+        route_class (str): READ or WRITE.
+
+    Returns:
+        Callable: The FastAPI dependency.
+    """
+    async def dependency():
+        limiter = admission_controller.limiters[route_class]
+        try:
+            await limiter.acquire()
+        except AdmissionRejected as error:
+            raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many requests, try again later",
+                                headers={"Retry-After": str(error.retry_after)}) from error
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            limiter.release(time.monotonic() - started)
+
+    return dependency
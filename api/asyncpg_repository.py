@@ -0,0 +1,321 @@
+"""
+User repository serving the hot routes on raw asyncpg, with USER_REPOSITORY_BACKEND=asyncpg.
+
+Lookups by email, /find with any combination of criteria, the version and
+generation checks behind the ETags, and /create/ skip the ORM and the
+session: each one sends a fixed statement text on an asyncpg connection and
+builds the users straight from the returned records. Every filter shape has
+its own text, so asyncpg's per-connection statement cache prepares each one
+once and later calls only bind and execute.
+
+These statements run in autocommit, like the reads of the read-only
+repository and like save, which commits at once. The other operations are
+delegated to a SQLUserRepository, whose transaction is committed when the
+repository is closed; they are the rarer and larger writes, where the ORM
+costs little next to the database.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import asyncpg
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+
+from labels import ENUM_TYPES
+from partitioning import quote
+from user_repository import (DB_MAX_OVERFLOW, DB_POOL_SIZE, User, UserFilter, UserRepository,
+                             UserRepositoryDecorator)
+
+USER_COLUMNS = "email, name, country, status, password"
+GET_BY_EMAIL = f"SELECT {USER_COLUMNS}, version FROM user_table WHERE email = $1"
+GET_VERSION = "SELECT version FROM user_table WHERE email = $1"
+GET_MANY_BY_EMAIL = f"SELECT {USER_COLUMNS}, version FROM user_table " \
+                    "WHERE email = ANY($1::varchar[])"
+GET_GENERATION = "SELECT sum(generation)::bigint FROM user_table_generation"
+INSERT_USER = f"INSERT INTO user_table ({USER_COLUMNS}) VALUES ($1, $2, $3, $4, $5)"
+FILTER_COLUMNS = (("by_name", "name"), ("by_country", "country"), ("status", "status"))
+
+# Pools of this process by connection string, with the event loop they belong to.
+_pools: Dict[str, Tuple[asyncio.AbstractEventLoop, "asyncio.Future[asyncpg.Pool]"]] = {}
+# A pool must not be shared with a forked worker either.
+os.register_at_fork(after_in_child=_pools.clear)
+
+
+def filter_query(user_filter: UserFilter) -> Tuple[str, List]:
+    """
+    Build the statement of a filter shape and its arguments.
+
+    Args:
+        user_filter (UserFilter): The filter criteria.
+
+    Returns:
+        Tuple[str, List]: The statement, the same for every filter with the
+            same criteria given, and the values to bind.
+    """
+    clauses, arguments = [], []
+    for attribute, column in FILTER_COLUMNS:
+        value = getattr(user_filter, attribute)
+        if value is not None:
+            arguments.append(value)
+            clauses.append(f"{column} = ${len(arguments)}")
+    query = f"SELECT {USER_COLUMNS} FROM user_table"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    if user_filter.limit is not None:
+        arguments.append(user_filter.limit)
+        query += f" LIMIT ${len(arguments)}"
+    return query, arguments
+
+
+def _to_user(record: asyncpg.Record) -> User:
+    """
+    Build a User from a record without validating it again.
+
+    Args:
+        record (asyncpg.Record): The email, name, country, status and password.
+
+    Returns:
+        User: The user.
+    """
+    return User.model_construct(email=record[0], name=record[1], country=record[2],
+                                status=record[3], password=record[4])
+
+
+async def _add_labels(connection: asyncpg.Connection, user: User) -> None:
+    """
+    Add the status and country of a user to their enums, unless they are there already.
+
+    Args:
+        connection (asyncpg.Connection): A connection in autocommit.
+        user (User): The user about to be inserted.
+    """
+    for column, type_name in ENUM_TYPES.items():
+        try:
+            await connection.execute(f"ALTER TYPE {type_name} ADD VALUE IF NOT EXISTS "
+                                     f"{quote(getattr(user, column))}")
+        except (asyncpg.DuplicateObjectError, asyncpg.UniqueViolationError):
+            # Another connection added it at the same time.
+            pass
+
+
+def asyncpg_dsn(db_string: str) -> str:
+    """
+    Turn a SQLAlchemy connection string into one asyncpg accepts.
+
+    Args:
+        db_string (str): The SQLAlchemy connection string.
+
+    Returns:
+        str: The libpq connection string.
+    """
+    return make_url(db_string).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+async def get_pool(dsn: str) -> asyncpg.Pool:
+    """
+    The connection pool of the running event loop for a database, created on first use.
+
+    Args:
+        dsn (str): The libpq connection string.
+
+    Returns:
+        asyncpg.Pool: Up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+    """
+    loop = asyncio.get_running_loop()
+    cached = _pools.get(dsn)
+    if cached is None or cached[0] is not loop:
+        pool = asyncio.ensure_future(asyncpg.create_pool(dsn, min_size=0,
+                                                         max_size=DB_POOL_SIZE + DB_MAX_OVERFLOW))
+        cached = _pools[dsn] = (loop, pool)
+    return await asyncio.shield(cached[1])
+
+
+class AsyncpgUserRepository(UserRepositoryDecorator):
+    """
+    Serves the hot operations on asyncpg and delegates the others to a SQLUserRepository.
+
+    With DB_POOL_SIZE set, a pooled connection is checked out for each
+    statement and handed back at once. Otherwise one connection is opened on
+    the first statement and closed with the repository, as under NullPool.
+    """
+
+    def __init__(self, repository: UserRepository, db_string: str):
+        """
+        Initialize without connecting.
+
+        Args:
+            repository (UserRepository): The repository the other operations are delegated to.
+            db_string (str): The SQLAlchemy connection string of the database.
+        """
+        super().__init__(repository)
+        self._dsn = asyncpg_dsn(db_string)
+        self._connection: Optional[asyncpg.Connection] = None
+        self.statements = 0
+
+    @property
+    def queries(self) -> int:
+        """
+        The statements sent by this repository and by the delegate.
+        """
+        return self.statements + getattr(self._repository, "queries", 0)
+
+    @asynccontextmanager
+    async def _connect(self) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Provide a connection for one statement.
+
+        Returns:
+            AsyncIterator[asyncpg.Connection]: A context manager yielding the connection.
+        """
+        self.statements += 1
+        if DB_POOL_SIZE > 0:
+            async with (await get_pool(self._dsn)).acquire() as connection:
+                yield connection
+            return
+        if self._connection is None:
+            self._connection = await asyncpg.connect(self._dsn)
+        yield self._connection
+
+    async def close(self) -> None:
+        """
+        Close the connection of this repository, if it opened one.
+        """
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await connection.close()
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit the delegate, then close the connection of this repository.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        try:
+            await self._repository.__aexit__(exc_type, exc_value, exc_traceback)
+        finally:
+            await self.close()
+
+    async def save(self, user: User) -> None:
+        """
+        Insert a user in one prepared statement.
+
+        The status and country are added to their enums, and the insert
+        retried, only when the database rejects them as unknown.
+
+        Args:
+            user (User): The user to save.
+
+        Raises:
+            IntegrityError: If the email is already taken, as with SQLUserRepository.
+        """
+        arguments = (user.email, user.name, user.country, user.status, user.password)
+        async with self._connect() as connection:
+            try:
+                try:
+                    await connection.execute(INSERT_USER, *arguments)
+                except asyncpg.InvalidTextRepresentationError:
+                    await _add_labels(connection, user)
+                    await connection.execute(INSERT_USER, *arguments)
+            except asyncpg.IntegrityConstraintViolationError as error:
+                raise IntegrityError(INSERT_USER, arguments, error) from error
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by email in one prepared statement.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        async with self._connect() as connection:
+            record = await connection.fetchrow(GET_BY_EMAIL, email)
+        return _to_user(record) if record else None
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email in one prepared statement.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        async with self._connect() as connection:
+            record = await connection.fetchrow(GET_BY_EMAIL, email)
+        return (_to_user(record), record[5]) if record else None
+
+    async def get_version(self, email: str) -> Optional[int]:
+        """
+        Retrieve the version of a user in one prepared statement.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            Optional[int]: The version of the user, or None if not found.
+        """
+        async with self._connect() as connection:
+            return await connection.fetchval(GET_VERSION, email)
+
+    async def get_generation(self) -> int:
+        """
+        Retrieve the generation of user_table in one prepared statement.
+
+        Returns:
+            int: The current generation, 0 if no counter row exists.
+        """
+        async with self._connect() as connection:
+            return await connection.fetchval(GET_GENERATION) or 0
+
+    async def get(self, user_filter: UserFilter) -> List[User]:
+        """
+        Get the users matching a filter with the prepared statement of its shape.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            List[User]: The users matching the filter; none for a status or
+                country no user ever had.
+        """
+        query, arguments = filter_query(user_filter)
+        async with self._connect() as connection:
+            try:
+                records = await connection.fetch(query, *arguments)
+            except asyncpg.InvalidTextRepresentationError:
+                return []
+        return [_to_user(record) for record in records]
+
+    async def get_many_by_email(self, emails: List[str]) -> List[User]:
+        """
+        Retrieve the users with any of the given emails in one prepared statement.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            List[User]: The users found, emails without a user are left out.
+        """
+        return [user for user, _ in (await self.get_many_versioned_by_email(emails)).values()]
+
+    async def get_many_versioned_by_email(self, emails: List[str]) -> Dict[str, Tuple[User, int]]:
+        """
+        Retrieve the users with any of the given emails and their versions in one statement.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            Dict[str, Tuple[User, int]]: The users found and their versions, keyed by email.
+        """
+        async with self._connect() as connection:
+            records = await connection.fetch(GET_MANY_BY_EMAIL, list(set(emails)))
+        return {record[0]: (_to_user(record), record[5]) for record in records}
@@ -0,0 +1,167 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from user_repository import User, UserRepository, UserRepositoryDecorator
+
+
+class _Batch:
+    """
+    Emails requested during one event-loop tick.
+    """
+
+    def __init__(self, repository: UserRepository):
+        """
+        Initialize an empty batch.
+
+        Args:
+            repository (UserRepository): The repository of the first caller, which runs the query.
+        """
+        self.repository = repository
+        self.futures: Dict[str, asyncio.Future] = {}
+
+
+class UserLoader:
+    """
+    DataLoader-style batcher for lookups by email.
+
+    Lookups made during the same event-loop tick are collected and resolved
+    with one get_many_versioned_by_email query, run on the repository of the
+    first caller once the tick is over.
+    """
+
+    def __init__(self):
+        """
+        Initialize the loader with no pending batch.
+        """
+        self._batch: Optional[_Batch] = None
+        self.batches = 0
+        self.loads = 0
+
+    def load(self, email: str, repository: UserRepository) -> Tuple[asyncio.Future, Optional[_Batch]]:
+        """
+        Add an email to the batch of the current tick.
+
+        Args:
+            email (str): The email to resolve.
+            repository (UserRepository): The caller's repository.
+
+        Returns:
+            Tuple[asyncio.Future, Optional[_Batch]]: The future result, and the
+            batch when this caller started it and must keep its repository open.
+        """
+        self.loads += 1
+        batch = self._batch
+        started = batch is None
+        if batch is None:
+            batch = self._batch = _Batch(repository)
+            asyncio.get_running_loop().call_soon(self._dispatch, batch)
+        future = batch.futures.get(email)
+        if future is None:
+            future = batch.futures[email] = asyncio.get_running_loop().create_future()
+        return future, batch if started else None
+
+    def _dispatch(self, batch: _Batch) -> None:
+        """
+        Close the batch of the finished tick and start its query.
+
+        Args:
+            batch (_Batch): The batch to resolve.
+        """
+        self._batch = None
+        self.batches += 1
+        asyncio.ensure_future(self._resolve(batch))
+
+    @staticmethod
+    async def _resolve(batch: _Batch) -> None:
+        """
+        Query the batch and hand every caller its result.
+
+        Args:
+            batch (_Batch): The batch to resolve.
+        """
+        try:
+            found = await batch.repository.get_many_versioned_by_email(list(batch.futures))
+        except Exception as error:  # pylint: disable=broad-except
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for email, future in batch.futures.items():
+            if not future.done():
+                future.set_result(found.get(email))
+
+    def snapshot(self) -> dict:
+        """
+        Describe the loader.
+
+        Returns:
+            dict: Lookups received and batch queries run.
+        """
+        return {"loads": self.loads, "batches": self.batches}
+
+
+user_loader = UserLoader()
+
+
+class BatchingUserRepository(UserRepositoryDecorator):
+    """
+    UserRepository decorator that batches lookups by email across requests.
+
+    A request whose repository runs a batch waits for that batch in
+    __aexit__, so its session stays open until every request in the batch
+    has its result.
+    """
+
+    def __init__(self, repository: UserRepository, loader: UserLoader):
+        """
+        Initialize with the repository that runs the batches.
+
+        Args:
+            repository (UserRepository): The decorated repository.
+            loader (UserLoader): The loader shared by all requests.
+        """
+        super().__init__(repository)
+        self._loader = loader
+        self._led: List[_Batch] = []
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Wait for the batches this request runs, then exit the decorated repository.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        futures = [future for batch in self._led for future in batch.futures.values()]
+        if futures:
+            await asyncio.shield(asyncio.gather(*futures, return_exceptions=True))
+        await self._repository.__aexit__(exc_type, exc_value, exc_traceback)
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email as part of the current batch.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        future, batch = self._loader.load(email, self._repository)
+        if batch is not None:
+            self._led.append(batch)
+        return await asyncio.shield(future)
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by email as part of the current batch.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        versioned_user = await self.get_versioned_by_email(email)
+        return versioned_user[0] if versioned_user else None
@@ -0,0 +1,76 @@
+"""
+Measure the throughput of concurrent /create/ calls.
+
+Run from the api directory with DB_STRING set:
+
+    python -m benchmarks.concurrent_creates --clients 1 8 32 --requests 2000
+
+Each client posts new users one after the other, on pooled connections
+(DB_POOL_SIZE defaults to 64 here). Admission control is opened up to 100
+concurrent writes so that only the database is measured.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("DB_POOL_SIZE", "64")
+os.environ.setdefault("ADMISSION_WRITE_INITIAL_LIMIT", "100")
+os.environ.setdefault("ADMISSION_WRITE_MIN_LIMIT", "100")
+
+# pylint: disable=wrong-import-position
+import httpx
+
+from benchmarks.repository_backends import seed_database
+from main import app
+
+
+async def timed(clients: int, requests: int) -> float:
+    """
+    Time concurrent clients creating users.
+
+    Args:
+        clients (int): Number of concurrent clients.
+        requests (int): Number of users created, split between the clients.
+
+    Returns:
+        float: Users created per second.
+    """
+    await seed_database([])
+    failures = []
+
+    async def client_loop(client: httpx.AsyncClient, number: int) -> None:
+        for request in range(number, requests, clients):
+            response = await client.post("/create/", json={
+                "email": f"bench-create{request}@test.com", "name": "Created",
+                "country": "Country1", "status": "Student", "password": "password"})
+            if response.status_code != 201:
+                failures.append(response.status_code)
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, number) for number in range(clients)))
+        elapsed = time.perf_counter() - started
+    assert not failures, f"{len(failures)} creations failed: {sorted(set(failures))}"
+    return requests / elapsed
+
+
+async def run(clients: list, requests: int) -> None:
+    """
+    Time /create/ at each level of concurrency.
+
+    Args:
+        clients (List[int]): Numbers of concurrent clients.
+        requests (int): Number of users created at each level.
+    """
+    for number in clients:
+        throughput = await timed(number, requests)
+        print(f"clients={number:<4} requests={requests} throughput={throughput:8.0f} req/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=2000)
+    arguments = parser.parse_args()
+    asyncio.run(run(arguments.clients, arguments.requests))
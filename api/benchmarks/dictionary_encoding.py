@@ -0,0 +1,129 @@
+"""
+Compare text and enum status and country columns on storage and reads.
+
+Run from the api directory with DB_STRING set:
+
+    python -m benchmarks.dictionary_encoding --rows 500000
+
+The same users are loaded into two scratch schemas, bench_text with the
+columns as VARCHAR and bench_enum with the user_status and user_country
+enums, each with an index on (country, status). The schemas are dropped at
+the end.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from sqlalchemy import NullPool, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from labels import ENUM_TYPES, enum_type_ddl
+from partitioning import NONE, TEXT_TYPES, constraint_ddl, table_ddl
+
+COUNTRIES = 50
+ENCODINGS = {"text": TEXT_TYPES, "enum": ENUM_TYPES}
+
+
+def encoding_engine(encoding: str) -> AsyncEngine:
+    """
+    Create an engine whose sessions use the scratch schema of an encoding.
+
+    Args:
+        encoding (str): A key of ENCODINGS.
+
+    Returns:
+        AsyncEngine: The engine.
+    """
+    return create_async_engine(os.getenv("DB_STRING", ""), poolclass=NullPool,
+                               connect_args={"server_settings": {"search_path": f"bench_{encoding}"}})
+
+
+async def build(engine: AsyncEngine, encoding: str, rows: int) -> None:
+    """
+    Create and seed the scratch schema of an encoding.
+
+    Args:
+        engine (AsyncEngine): The engine of the encoding.
+        encoding (str): A key of ENCODINGS.
+        rows (int): Number of users to insert.
+    """
+    types = ENCODINGS[encoding]
+    async with engine.begin() as connection:
+        await connection.execute(text(f"DROP SCHEMA IF EXISTS bench_{encoding} CASCADE"))
+        await connection.execute(text(f"CREATE SCHEMA bench_{encoding}"))
+        await connection.execute(text("CREATE SEQUENCE user_table_id_seq"))
+        if types is ENUM_TYPES:
+            await connection.execute(text(enum_type_ddl("status", ["Student", "Worker"])))
+            await connection.execute(text(enum_type_ddl("country", [f"Country{i}" for i in range(COUNTRIES)])))
+        for statement in table_ddl(NONE, "user_table_id_seq", types=types):
+            await connection.execute(text(statement))
+        await connection.execute(text(f"""
+            INSERT INTO user_table (email, password, name, status, country)
+            SELECT 'bench' || i || '@test.com', 'password', 'Bench User ' || i,
+                   (CASE WHEN i % 4 < 2 THEN 'Student' ELSE 'Worker' END)::{types['status']},
+                   ('Country' || i % {COUNTRIES})::{types['country']}
+            FROM generate_series(0, {rows - 1}) AS i
+        """))
+        for statement in constraint_ddl(NONE):
+            await connection.execute(text(statement))
+        await connection.execute(text("CREATE INDEX user_table_country_status ON user_table (country, status)"))
+    async with engine.connect() as connection:
+        await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text("VACUUM ANALYZE user_table"))
+
+
+async def measure(engine: AsyncEngine, encoding: str, queries: int) -> None:
+    """
+    Report the sizes of an encoding and time its reads.
+
+    Args:
+        engine (AsyncEngine): The engine of the encoding.
+        encoding (str): A key of ENCODINGS.
+        queries (int): Number of timed calls per read.
+    """
+    async with engine.connect() as connection:
+        heap, index = (await connection.execute(text(
+            "SELECT pg_table_size('user_table'), pg_relation_size('user_table_country_status')"))).one()
+
+        filtered = text("SELECT id, email, name, country, status FROM user_table "
+                        "WHERE country = :country AND status = :status")
+        started = time.perf_counter()
+        for i in range(queries):
+            await connection.execute(filtered, {"country": f"Country{i % COUNTRIES}", "status": "Worker"})
+        filtered_ms = (time.perf_counter() - started) * 1000 / queries
+
+        started = time.perf_counter()
+        for _ in range(max(1, queries // 10)):
+            await connection.execute(text("SELECT country, status FROM user_table"))
+        scan_ms = (time.perf_counter() - started) * 1000 / max(1, queries // 10)
+
+    print(f"encoding={encoding:<5} heap={heap / 2 ** 20:6.1f} MB  index={index / 2 ** 20:5.1f} MB  "
+          f"find_by_country_status={filtered_ms:6.2f} ms  read_all_labels={scan_ms:7.1f} ms")
+
+
+async def run(rows: int, queries: int) -> None:
+    """
+    Build, measure and drop every encoding.
+
+    Args:
+        rows (int): Number of users per encoding.
+        queries (int): Number of timed calls per read.
+    """
+    for encoding in ENCODINGS:
+        engine = encoding_engine(encoding)
+        try:
+            await build(engine, encoding, rows)
+            await measure(engine, encoding, queries)
+        finally:
+            async with engine.begin() as connection:
+                await connection.execute(text(f"DROP SCHEMA IF EXISTS bench_{encoding} CASCADE"))
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--queries", type=int, default=50)
+    arguments = parser.parse_args()
+    asyncio.run(run(arguments.rows, arguments.queries))
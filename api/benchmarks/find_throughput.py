@@ -0,0 +1,97 @@
+"""
+Measure the throughput of the /find endpoint.
+
+Run from the api directory:
+
+    python -m benchmarks.find_throughput --rows 10000 --requests 50
+
+By default the users are served from an InMemoryUserRepository so that only
+the request handling and serialization are measured. Pass --backend sql to
+seed and query the database at DB_STRING instead.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+from main import app
+from user_repository import (
+    InMemoryUserRepository,
+    SQL_BASE,
+    User,
+    UserInDB,
+    create_user_repository,
+    get_engine,
+)
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def make_users(rows: int):
+    """
+    Build the benchmark data set.
+
+    Args:
+        rows (int): Number of users to generate.
+
+    Returns:
+        List[User]: The generated users.
+    """
+    return [User(email=f"bench{i}@test.com", name=f"Bench User {i}", country=f"Country{i % 50}",
+                 status="Student" if i % 2 else "Worker", password="password")
+            for i in range(rows)]
+
+
+async def seed_database(users) -> None:
+    """
+    Replace the content of user_table with the benchmark users.
+
+    Args:
+        users (List[User]): The users to insert.
+    """
+    async with AsyncSession(get_engine(os.getenv("DB_STRING", ""))) as session:
+        await session.execute(text(f"TRUNCATE TABLE {', '.join(SQL_BASE.metadata.tables.keys())} CASCADE"))
+        session.add_all([UserInDB(**user.model_dump()) for user in users])
+        await session.commit()
+
+
+async def run(rows: int, requests: int, backend: str) -> None:
+    """
+    Seed the users and time sequential /find calls.
+
+    Args:
+        rows (int): Number of users returned by each call.
+        requests (int): Number of timed calls.
+        backend (str): "memory" or "sql".
+    """
+    users = make_users(rows)
+    if backend == "memory":
+        repository = InMemoryUserRepository()
+        for user in users:
+            await repository.save(user)
+        app.dependency_overrides[create_user_repository] = lambda: repository
+    else:
+        await seed_database(users)
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        response = await client.get("/find")
+        assert len(response.json()) == rows
+        started = time.perf_counter()
+        for _ in range(requests):
+            await client.get("/find")
+        elapsed = time.perf_counter() - started
+
+    print(f"backend={backend} rows={rows} requests={requests} "
+          f"elapsed={elapsed:.2f}s throughput={requests / elapsed:.1f} req/s "
+          f"({rows * requests / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--backend", choices=["memory", "sql"], default="memory")
+    arguments = parser.parse_args()
+    asyncio.run(run(arguments.rows, arguments.requests, arguments.backend))
@@ -0,0 +1,135 @@
+"""
+Compare the user_table layouts on filtered reads, lookups by email and vacuum.
+
+Run from the api directory with DB_STRING set:
+
+    python -m benchmarks.partitioning --rows 500000
+
+Every layout is built in a scratch schema of its own (bench_none,
+bench_hash, bench_country), seeded with the same users and queried through
+SQLUserRepository. The schemas are dropped at the end.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from sqlalchemy import NullPool, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+
+from labels import ENUM_TYPES, enum_type_ddl
+from partitioning import COUNTRY, LAYOUTS, constraint_ddl, email_guard_ddl, table_ddl
+from user_repository import SQLUserRepository, UserFilter
+
+COUNTRIES = 50
+
+
+def layout_engine(layout: str) -> AsyncEngine:
+    """
+    Create an engine whose sessions use the scratch schema of a layout.
+
+    Args:
+        layout (str): One of LAYOUTS.
+
+    Returns:
+        AsyncEngine: The engine.
+    """
+    return create_async_engine(os.getenv("DB_STRING", ""), poolclass=NullPool,
+                               connect_args={"server_settings": {"search_path": f"bench_{layout}"}})
+
+
+async def build(engine: AsyncEngine, layout: str, rows: int) -> None:
+    """
+    Create and seed the scratch schema of a layout.
+
+    Args:
+        engine (AsyncEngine): The engine of the layout.
+        layout (str): One of LAYOUTS.
+        rows (int): Number of users to insert.
+    """
+    countries = [f"Country{i}" for i in range(COUNTRIES)]
+    async with engine.begin() as connection:
+        await connection.execute(text(f"DROP SCHEMA IF EXISTS bench_{layout} CASCADE"))
+        await connection.execute(text(f"CREATE SCHEMA bench_{layout}"))
+        await connection.execute(text("CREATE SEQUENCE user_table_id_seq"))
+        await connection.execute(text(enum_type_ddl("status", ["Student", "Worker"])))
+        await connection.execute(text(enum_type_ddl("country", countries)))
+        for statement in table_ddl(layout, "user_table_id_seq", countries=countries, types=ENUM_TYPES):
+            await connection.execute(text(statement))
+        await connection.execute(text(f"""
+            INSERT INTO user_table (email, password, name, status, country)
+            SELECT 'bench' || i || '@test.com', 'password', 'Bench User ' || i,
+                   (CASE WHEN i % 4 < 2 THEN 'Student' ELSE 'Worker' END)::user_status,
+                   ('Country' || i % {COUNTRIES})::user_country
+            FROM generate_series(0, {rows - 1}) AS i
+        """))
+        for statement in constraint_ddl(layout) + (email_guard_ddl() if layout == COUNTRY else []):
+            await connection.execute(text(statement))
+    async with engine.connect() as connection:
+        await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text("VACUUM ANALYZE user_table"))
+
+
+async def measure(engine: AsyncEngine, layout: str, rows: int, queries: int) -> None:
+    """
+    Time the repository reads and a vacuum on one layout and print the results.
+
+    Args:
+        engine (AsyncEngine): The engine of the layout.
+        layout (str): One of LAYOUTS.
+        rows (int): Number of users in the table.
+        queries (int): Number of timed calls per read.
+    """
+    async with AsyncSession(engine) as session:
+        repository = SQLUserRepository(session)
+        user_filter = UserFilter(by_country="Country7", status="Worker")
+        started = time.perf_counter()
+        for _ in range(queries):
+            users = await repository.get(user_filter)
+        find_ms = (time.perf_counter() - started) * 1000 / queries
+        assert len(users) == rows // COUNTRIES // 2
+
+        started = time.perf_counter()
+        for i in range(queries):
+            assert await repository.get_by_email(f"bench{i * 7919 % rows}@test.com") is not None
+        lookup_ms = (time.perf_counter() - started) * 1000 / queries
+
+    # Rewrite every row of one country, then vacuum what holds the dead rows:
+    # its partition with the country layout, the whole table otherwise.
+    async with engine.connect() as connection:
+        await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text("UPDATE user_table SET name = name || '.' WHERE country = 'Country7'"))
+        vacuumed = "user_table_c7" if layout == COUNTRY else "user_table"
+        started = time.perf_counter()
+        await connection.execute(text(f"VACUUM {vacuumed}"))
+        vacuum_ms = (time.perf_counter() - started) * 1000
+
+    print(f"layout={layout:<8} find_by_country={find_ms:7.2f} ms  get_by_email={lookup_ms:5.2f} ms  "
+          f"vacuum={vacuum_ms:7.1f} ms")
+
+
+async def run(rows: int, queries: int) -> None:
+    """
+    Build, measure and drop every layout.
+
+    Args:
+        rows (int): Number of users per layout.
+        queries (int): Number of timed calls per read.
+    """
+    for layout in LAYOUTS:
+        engine = layout_engine(layout)
+        try:
+            await build(engine, layout, rows)
+            await measure(engine, layout, rows, queries)
+        finally:
+            async with engine.begin() as connection:
+                await connection.execute(text(f"DROP SCHEMA IF EXISTS bench_{layout} CASCADE"))
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--queries", type=int, default=50)
+    arguments = parser.parse_args()
+    asyncio.run(run(arguments.rows, arguments.queries))
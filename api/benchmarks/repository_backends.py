@@ -0,0 +1,114 @@
+"""
+Compare the SQLAlchemy and asyncpg repository backends operation by operation.
+
+Run from the api directory with DB_STRING set:
+
+    python -m benchmarks.repository_backends --rows 100000 --operations 2000
+
+The users of benchmarks.find_throughput replace the content of user_table
+before each backend runs. Each operation opens a repository the way a
+request does, runs one call and closes it, on pooled connections
+(DB_POOL_SIZE defaults to 5 here).
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+os.environ.setdefault("DB_POOL_SIZE", "5")
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from asyncpg_repository import AsyncpgUserRepository
+from benchmarks.find_throughput import make_users
+from user_repository import (SQL_BASE, SQLUserRepository, User, UserFilter, UserRepository,
+                             get_engine, get_read_only_engine, open_user_repository)
+
+BACKENDS = ("sqlalchemy", "asyncpg")
+
+
+async def seed_database(users) -> None:
+    """
+    Replace the content of user_table with the benchmark users.
+
+    Args:
+        users (List[User]): The users to insert.
+    """
+    async with AsyncSession(get_engine(os.getenv("DB_STRING", ""))) as session:
+        tables = ", ".join(SQL_BASE.metadata.tables.keys())
+        await session.execute(text(f"TRUNCATE TABLE {tables} CASCADE"))
+        await session.commit()
+    async with open_user_repository() as repository:
+        await repository.upsert_many(users)
+
+
+async def timed(backend: str, read_only: bool, operation, operations: int) -> float:
+    """
+    Time an operation run through a new repository each time.
+
+    Args:
+        backend (str): "sqlalchemy" or "asyncpg".
+        read_only (bool): Whether the repository is read-only, in autocommit.
+        operation (Callable[[UserRepository, int], Awaitable]): Called with the
+            repository and the run number.
+        operations (int): Number of timed runs, after as many warm-up runs.
+
+    Returns:
+        float: Operations per second.
+    """
+    db_string = os.getenv("DB_STRING", "")
+    engine = get_read_only_engine(db_string) if read_only else get_engine(db_string)
+
+    async def run_once(number: int) -> None:
+        async with AsyncSession(engine) as session:
+            repository: UserRepository = SQLUserRepository(session, read_only)
+            if backend == "asyncpg":
+                repository = AsyncpgUserRepository(repository, db_string)
+            async with repository:
+                await operation(repository, number)
+
+    for number in range(operations):
+        await run_once(-number - 1)
+    started = time.perf_counter()
+    for number in range(operations):
+        await run_once(number)
+    return operations / (time.perf_counter() - started)
+
+
+async def run(rows: int, operations: int) -> None:
+    """
+    Seed the users and time every operation on both backends.
+
+    Args:
+        rows (int): Number of users in user_table.
+        operations (int): Number of timed runs of each operation.
+    """
+    users = make_users(rows)
+    emails = [user.email for user in random.Random(0).sample(users, min(rows, operations))]
+    cases = {
+        "get_by_email": (True, lambda repository, number: repository.get_by_email(
+            emails[number % len(emails)])),
+        "get(country, status, limit=100)": (True, lambda repository, number: repository.get(
+            UserFilter(by_country=f"Country{number % 50}", status="Student", limit=100))),
+        "get(name)": (True, lambda repository, number: repository.get(
+            UserFilter(by_name=f"Bench User {number % rows}"))),
+        "save": (False, lambda repository, number: repository.save(User(
+            email=f"bench-save{number}@test.com", name="Saved", country="Country1",
+            status="Student", password="password"))),
+    }
+    for backend in BACKENDS:
+        await seed_database(users)
+        for name, (read_only, operation) in cases.items():
+            throughput = await timed(backend, read_only, operation, operations)
+            print(f"backend={backend:<10} operation={name:<32} {throughput:8.0f} ops/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--operations", type=int, default=2000)
+    arguments = parser.parse_args()
+    asyncio.run(run(arguments.rows, arguments.operations))
@@ -0,0 +1,153 @@
+"""
+Measure how fast the API starts.
+
+Run from the api directory with DB_STRING set:
+
+    python -m benchmarks.startup --workers 1 4 [--check]
+
+Two numbers are reported:
+
+- the time spent importing main, from ``python -X importtime``, with the
+  modules that cost the most;
+- the time from starting the production server until a first
+  GET /user/{email} succeeds, with and without preloading the app.
+
+With --check the numbers are compared to startup_budget.json and the script
+exits with an error when one is over budget or when a module that must be
+loaded lazily is imported by main.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import httpx
+
+from user_repository import User, open_user_repository
+
+BUDGET_FILE = Path(__file__).with_name("startup_budget.json")
+BENCH_EMAIL = "startup@test.com"
+
+
+def load_budget() -> dict:
+    """
+    Read the startup budget.
+
+    Returns:
+        dict: The budget, see startup_budget.json.
+    """
+    return json.loads(BUDGET_FILE.read_text(encoding="utf-8"))
+
+
+def measure_imports(module: str = "main") -> Tuple[float, Dict[str, float]]:
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Args:
+        module (str): The module to import.
+
+    Returns:
+        Tuple[float, Dict[str, float]]: The cumulative import time of the module
+        in milliseconds, and the cumulative time of every module it imported.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).resolve().parent.parent)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules[module], modules
+
+
+async def first_request(workers: int, preload: bool, port: int) -> float:
+    """
+    Start the production server and time its first successful request.
+
+    Args:
+        workers (int): Number of worker processes.
+        preload (bool): Whether the app is imported once in the master.
+        port (int): Port the server listens on.
+
+    Returns:
+        float: Milliseconds from starting the server to the first 200 response.
+    """
+    environment = {**os.environ, "WEB_CONCURRENCY": str(workers), "BIND": f"127.0.0.1:{port}",
+                   "PRELOAD_APP": "1" if preload else "0"}
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "main:app", "--config", "gunicorn.conf.py"],
+                              env=environment, stderr=subprocess.DEVNULL)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            while True:
+                try:
+                    if (await client.get(f"/user/{BENCH_EMAIL}")).status_code == 200:
+                        return (time.perf_counter() - started) * 1000
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def run(worker_counts: List[int], repeats: int, port: int, check: bool) -> int:
+    """
+    Run the measures and print them.
+
+    Args:
+        worker_counts (List[int]): Worker counts to start the server with.
+        repeats (int): Runs per measure; the median is reported.
+        port (int): Port the server listens on.
+        check (bool): Whether to compare the results to the budget.
+
+    Returns:
+        int: The exit status, 1 when over budget.
+    """
+    budget = load_budget()
+    import_times = [measure_imports() for _ in range(repeats)]
+    import_ms = statistics.median(total for total, _ in import_times)
+    modules = import_times[-1][1]
+    print(f"import main: {import_ms:.0f} ms (budget {budget['import_main_ms']} ms)")
+    for name, cumulative in sorted(modules.items(), key=lambda item: -item[1])[1:9]:
+        print(f"  {cumulative:7.1f} ms  {name}")
+
+    async with open_user_repository() as repository:
+        await repository.upsert(User(email=BENCH_EMAIL, name="Startup", country="Country1",
+                                     status="Student", password="password"))
+    first_request_ms = 0.0
+    for workers in worker_counts:
+        for preload in (False, True):
+            elapsed = statistics.median([await first_request(workers, preload, port) for _ in range(repeats)])
+            first_request_ms = max(first_request_ms, elapsed) if preload else first_request_ms
+            print(f"first /user/{{email}}: workers={workers} preload={'on ' if preload else 'off'} "
+                  f"{elapsed:.0f} ms")
+
+    failures = [name for name in budget["lazy_modules"] if name in modules]
+    if import_ms > budget["import_main_ms"]:
+        failures.append(f"import main {import_ms:.0f} ms")
+    if first_request_ms > budget["first_request_ms"]:
+        failures.append(f"first request {first_request_ms:.0f} ms")
+    if check and failures:
+        print("over budget: " + ", ".join(failures))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--port", type=int, default=5057)
+    parser.add_argument("--check", action="store_true")
+    arguments = parser.parse_args()
+    sys.exit(asyncio.run(run(arguments.workers, arguments.repeats, arguments.port, arguments.check)))
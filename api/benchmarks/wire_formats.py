@@ -0,0 +1,89 @@
+"""
+Compare the JSON, MessagePack and Arrow encodings of a list of users.
+
+Run from the api directory:
+
+    python -m benchmarks.wire_formats --rows 1000 10000 --repeat 20
+
+Users are built the way the repository returns them and encoded with
+responses.encode_users, as the list routes do. Decoding is timed the way a
+consumer would do it: orjson or msgpack into Python objects, and pyarrow
+into an Arrow table.
+"""
+import argparse
+import time
+from typing import Callable, List
+
+import msgpack
+import orjson
+import pyarrow.ipc
+
+from responses import ARROW, JSON, MSGPACK, encode_users
+from user_repository import User
+
+DECODERS = {
+    JSON: orjson.loads,  # pylint: disable=no-member
+    MSGPACK: msgpack.unpackb,
+    ARROW: lambda payload: pyarrow.ipc.open_stream(payload).read_all(),
+}
+
+
+def make_users(rows: int) -> List[User]:
+    """
+    Build the benchmark data set without validation, like the repository.
+
+    Args:
+        rows (int): Number of users to generate.
+
+    Returns:
+        List[User]: The generated users.
+    """
+    return [User.model_construct(email=f"bench{i}@test.com", name=f"Bench User {i}",
+                                 country=f"Country{i % 50}",
+                                 status="Student" if i % 2 else "Worker", password="password")
+            for i in range(rows)]
+
+
+def best_ms(function: Callable[[], object], repeat: int) -> float:
+    """
+    Time a call several times.
+
+    Args:
+        function (Callable[[], object]): The call to time.
+        repeat (int): Number of timed calls.
+
+    Returns:
+        float: The fastest call, in milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def run(rows: List[int], repeat: int) -> None:
+    """
+    Encode and decode every data set in every format and print the results.
+
+    Args:
+        rows (List[int]): Sizes of the data sets.
+        repeat (int): Number of timed calls per measure.
+    """
+    for count in rows:
+        users = make_users(count)
+        for media_type, decode in DECODERS.items():
+            payload = encode_users(users, media_type)
+            encode_ms = best_ms(lambda: encode_users(users, media_type), repeat)  # pylint: disable=cell-var-from-loop
+            decode_ms = best_ms(lambda: decode(payload), repeat)  # pylint: disable=cell-var-from-loop
+            print(f"rows={count:<7} format={media_type:<37} size={len(payload) / 1024:9.1f} KiB  "
+                  f"encode={encode_ms:7.2f} ms  decode={decode_ms:7.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    arguments = parser.parse_args()
+    run(arguments.rows, arguments.repeat)
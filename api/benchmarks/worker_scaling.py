@@ -0,0 +1,117 @@
+"""
+Measure how the throughput of the production server scales with its workers.
+
+Run from the api directory with DB_STRING set:
+
+    python -m benchmarks.worker_scaling --workers 1 2 4 --seconds 10
+
+For every worker count a gunicorn server is started with gunicorn.conf.py
+and loaded with concurrent GET requests over HTTP, on /user/{email} unless
+--path is given.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from user_repository import User, open_user_repository
+
+BENCH_EMAIL = "worker-scaling@test.com"
+
+
+async def seed() -> None:
+    """
+    Create the user the benchmark reads.
+    """
+    async with open_user_repository() as repository:
+        await repository.upsert(User(email=BENCH_EMAIL, name="Worker Scaling", country="Country1",
+                                     status="Student", password="password"))
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 30) -> None:
+    """
+    Wait until the server answers.
+
+    Args:
+        client (httpx.AsyncClient): Client bound to the server.
+        timeout (float): Seconds to wait at most.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.get("/metrics")
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def load(base_url: str, path: str, concurrency: int, seconds: float) -> float:
+    """
+    Send requests from concurrent clients for a while.
+
+    Args:
+        base_url (str): The server URL.
+        path (str): The path requested.
+        concurrency (int): Requests in flight at any time.
+        seconds (float): Duration of the measure.
+
+    Returns:
+        float: Completed requests per second.
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        await wait_until_ready(client)
+        completed = 0
+        deadline = time.monotonic() + seconds
+
+        async def client_loop():
+            nonlocal completed
+            while time.monotonic() < deadline:
+                response = await client.get(path)
+                assert response.status_code == 200
+                completed += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        return completed / (time.monotonic() - started)
+
+
+def run(workers: int, path: str, concurrency: int, seconds: float, port: int) -> None:
+    """
+    Start a server with some workers, load it and stop it gracefully.
+
+    Args:
+        workers (int): Number of worker processes.
+        path (str): The path requested.
+        concurrency (int): Requests in flight at any time.
+        seconds (float): Duration of the measure.
+        port (int): Port the server listens on.
+    """
+    environment = {**os.environ, "WEB_CONCURRENCY": str(workers), "BIND": f"127.0.0.1:{port}"}
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "main:app", "--config", "gunicorn.conf.py"],
+                              env=environment, stderr=subprocess.DEVNULL)
+    try:
+        throughput = asyncio.run(load(f"http://127.0.0.1:{port}", path, concurrency, seconds))
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"path={path} workers={workers} concurrency={concurrency} throughput={throughput:.1f} req/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--path", default=f"/user/{BENCH_EMAIL}")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=5055)
+    arguments = parser.parse_args()
+    asyncio.run(seed())
+    for worker_count in arguments.workers:
+        run(worker_count, arguments.path, arguments.concurrency, arguments.seconds, arguments.port)
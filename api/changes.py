@@ -0,0 +1,380 @@
+"""
+Push feed of user changes, served as server-sent events by /changes/stream.
+
+A trigger announces every inserted, updated or deleted row of user_table,
+and every truncation, on the user_changes channel when its transaction
+commits; a statement writing too many rows is announced by a single reset
+instead. Each process opens one listening connection per database, only
+while it has subscribers or watchers, and copies every notification into
+the bounded queue of each subscriber. A subscriber whose queue is full is
+too slow to keep up: it is sent an overflow event and disconnected instead
+of holding events in memory. Watchers are callbacks of the process itself,
+such as the user cache, called with each change as it arrives.
+"""
+import asyncio
+import logging
+import os
+from typing import Callable, List, Optional, Set
+
+import orjson
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+# Channel the user_table_notify_change trigger of the user_change_notifications revision notifies.
+CHANGES_CHANNEL = "user_changes"
+CHANGE_QUEUE_SIZE = int(os.getenv("CHANGE_QUEUE_SIZE", "1000"))
+CHANGE_HEARTBEAT_SECONDS = float(os.getenv("CHANGE_HEARTBEAT_SECONDS", "15"))
+CHANGE_CONNECT_TIMEOUT = float(os.getenv("CHANGE_CONNECT_TIMEOUT", "5"))
+MAX_RECONNECT_DELAY = 5.0
+
+KEEPALIVE = b": keepalive\n\n"
+# Sent after the listening connection was lost and opened again: changes may have been missed.
+RESET = b"event: reset\ndata: {}\n\n"
+# Sent before disconnecting a subscriber that fell behind.
+OVERFLOW = b"event: overflow\ndata: {}\n\n"
+
+
+class ChangeFeedUnavailable(Exception):
+    """
+    Raised when the listening connection cannot be opened.
+    """
+
+
+def _feed_db_strings() -> List[str]:
+    """
+    The databases users are written to: every shard, or DB_STRING.
+
+    Returns:
+        List[str]: Their connection strings.
+    """
+    if os.getenv("SHARD_DB_STRINGS"):
+        # sharding builds on user_repository, so it is only imported when shards are configured.
+        from sharding import parse_db_strings  # pylint: disable=import-outside-toplevel
+        return list(parse_db_strings(os.environ["SHARD_DB_STRINGS"]).values())
+    return [os.getenv("DB_STRING", "")]
+
+
+# Passed to watchers when a listening connection is lost: changes are not heard until it is back.
+LOST_CHANGE = {"op": "lost"}
+# Passed to watchers once it is opened again: changes may have been missed meanwhile.
+RESET_CHANGE = {"op": "reset"}
+
+
+def change_frame(change: dict, payload: str) -> bytes:
+    """
+    Build the server-sent event of a notification.
+
+    Args:
+        change (dict): The parsed notification.
+        payload (str): The JSON document sent by the trigger.
+
+    Returns:
+        bytes: The event, named after the operation and identified by the row
+            version; a truncation has no version and no id.
+    """
+    event = f"event: {change['op']}\ndata: {payload}\n\n"
+    if "version" in change:
+        event = f"id: {change['version']}\n" + event
+    return event.encode()
+
+
+class Subscription:
+    """
+    The events waiting to be sent to one subscriber.
+
+    The queue holds encoded events; None marks a subscriber that was
+    disconnected for falling behind.
+    """
+
+    def __init__(self, queue_size: int):
+        """
+        Start with an empty queue.
+
+        Args:
+            queue_size (int): Events the subscriber may fall behind by.
+        """
+        self.queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(queue_size)
+
+
+class _Listener:
+    """
+    The listening connection to one database, reopened when it is lost.
+    """
+
+    def __init__(self, feed: "ChangeFeed", db_string: str):
+        """
+        Start listening in the background.
+
+        Args:
+            feed (ChangeFeed): Receives the notifications.
+            db_string (str): The SQLAlchemy connection string of the database.
+        """
+        self.feed = feed
+        self.dsn = make_url(db_string).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.ready: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _connect(self):
+        """
+        Open a connection listening on CHANGES_CHANNEL.
+
+        Returns:
+            asyncpg.Connection: The connection.
+        """
+        # The driver is only loaded once someone subscribes.
+        import asyncpg  # pylint: disable=import-outside-toplevel
+
+        connection = await asyncpg.connect(self.dsn, timeout=CHANGE_CONNECT_TIMEOUT)
+        await connection.add_listener(CHANGES_CHANNEL, self.feed.on_notification)
+        return connection
+
+    async def _run(self) -> None:
+        """
+        Listen until cancelled, reconnecting with backoff.
+
+        Failing to connect the first time fails ready and ends the listener.
+        """
+        delay = 0.1
+        while True:
+            try:
+                connection = await self._connect()
+            except Exception as error:  # pylint: disable=broad-except
+                if not self.ready.done():
+                    self.ready.set_exception(ChangeFeedUnavailable(str(error)))
+                    return
+                logger.warning("Change feed reconnection failed: %s", error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            if self.ready.done():
+                self.feed.reconnects += 1
+                self.feed.reset()
+            else:
+                self.ready.set_result(None)
+            delay = 0.1
+            try:
+                await lost.wait()
+                logger.warning("Change feed connection lost, reconnecting")
+                self.feed.lose()
+            finally:
+                if not connection.is_closed():
+                    connection.terminate()
+
+
+class ChangeFeed:
+    """
+    Fans the user change notifications out to the subscribers of a process.
+    """
+
+    def __init__(self, queue_size: int = CHANGE_QUEUE_SIZE,
+                 db_strings: Callable[[], List[str]] = _feed_db_strings):
+        """
+        Start with no subscriber, no watcher and no connection.
+
+        Args:
+            queue_size (int): Events each subscriber may fall behind by.
+            db_strings (Callable[[], List[str]]): The databases to listen to.
+        """
+        self.queue_size = queue_size
+        self.db_strings = db_strings
+        self._subscriptions: Set[Subscription] = set()
+        self._watchers: List[Callable[[dict], None]] = []
+        self._listeners: List[_Listener] = []
+        self.published = 0
+        self.disconnected = 0
+        self.reconnects = 0
+
+    async def subscribe(self) -> Subscription:
+        """
+        Add a subscriber, connecting first if it is the only one.
+
+        The subscriber receives every change committed once this returns.
+
+        Returns:
+            Subscription: The events of the subscriber.
+
+        Raises:
+            ChangeFeedUnavailable: If a database could not be listened to.
+        """
+        subscription = Subscription(self.queue_size)
+        self._subscriptions.add(subscription)
+        try:
+            await self._listen()
+        except BaseException:
+            self.unsubscribe(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Remove a subscriber, closing the connections if nobody else listens.
+
+        Args:
+            subscription (Subscription): The subscriber to remove.
+        """
+        self._subscriptions.discard(subscription)
+        self._close_if_unused()
+
+    async def watch(self, callback: Callable[[dict], None]) -> None:
+        """
+        Call back with every change, connecting first if nobody listens yet.
+
+        The callback receives each notification as a dict, LOST_CHANGE when a
+        connection is lost and RESET_CHANGE when it was opened again and
+        changes may have been missed. It runs on the event loop and must not
+        block.
+
+        Args:
+            callback (Callable[[dict], None]): Called with each change.
+
+        Raises:
+            ChangeFeedUnavailable: If a database could not be listened to.
+        """
+        self._watchers.append(callback)
+        try:
+            await self._listen()
+        except BaseException:
+            self.unwatch(callback)
+            raise
+
+    def unwatch(self, callback: Callable[[dict], None]) -> None:
+        """
+        Stop calling back, closing the connections if nobody else listens.
+
+        Args:
+            callback (Callable[[dict], None]): A callback passed to watch.
+        """
+        if callback in self._watchers:
+            self._watchers.remove(callback)
+        self._close_if_unused()
+
+    async def _listen(self) -> None:
+        """
+        Open the listening connections unless they are open, and wait for them.
+
+        Raises:
+            ChangeFeedUnavailable: If a database could not be listened to.
+        """
+        if not self._listeners:
+            self._listeners = [_Listener(self, db_string) for db_string in self.db_strings()]
+        listeners = self._listeners
+        try:
+            await asyncio.gather(*(asyncio.shield(listener.ready) for listener in listeners))
+        except ChangeFeedUnavailable:
+            # A listener that could not connect has ended, so the next caller starts over.
+            if self._listeners is listeners:
+                for listener in listeners:
+                    listener.task.cancel()
+                self._listeners = []
+            raise
+
+    def _close_if_unused(self) -> None:
+        """
+        Close the connections once there is no subscriber and no watcher.
+        """
+        if not self._subscriptions and not self._watchers:
+            for listener in self._listeners:
+                listener.task.cancel()
+            self._listeners = []
+
+    def on_notification(self, _connection, _pid: int, _channel: str, payload: str) -> None:
+        """
+        Hand a notification to every watcher and every subscriber.
+
+        Args:
+            _connection (asyncpg.Connection): The listening connection.
+            _pid (int): The backend that sent the notification.
+            _channel (str): CHANGES_CHANNEL.
+            payload (str): The JSON document sent by the trigger.
+        """
+        self.published += 1
+        change = orjson.loads(payload)  # pylint: disable=no-member
+        for watcher in list(self._watchers):
+            watcher(change)
+        if self._subscriptions:
+            self.broadcast(change_frame(change, payload))
+
+    def lose(self) -> None:
+        """
+        Tell every watcher that changes are not heard until the connection is back.
+        """
+        for watcher in list(self._watchers):
+            watcher(LOST_CHANGE)
+
+    def reset(self) -> None:
+        """
+        Tell every watcher and every subscriber that changes may have been missed.
+        """
+        for watcher in list(self._watchers):
+            watcher(RESET_CHANGE)
+        self.broadcast(RESET)
+
+    def broadcast(self, frame: bytes) -> None:
+        """
+        Queue an event for every subscriber, disconnecting those whose queue is full.
+
+        Args:
+            frame (bytes): The encoded event.
+        """
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self.disconnected += 1
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(None)
+                self.unsubscribe(subscription)
+
+    def snapshot(self) -> dict:
+        """
+        Describe the feed.
+
+        Returns:
+            dict: Subscribers, watchers, open connections, notifications received,
+                subscribers disconnected for falling behind and reconnections.
+        """
+        return {"subscribers": len(self._subscriptions), "watchers": len(self._watchers),
+                "connections": len(self._listeners),
+                "published": self.published, "disconnected": self.disconnected,
+                "reconnects": self.reconnects}
+
+
+change_feed = ChangeFeed()
+
+
+async def stream_changes(feed: ChangeFeed, subscription: Subscription,
+                         heartbeat: float = CHANGE_HEARTBEAT_SECONDS):
+    """
+    Send the events of a subscriber until it disconnects or falls behind.
+
+    Events already queued are sent together, and a comment is sent after
+    heartbeat seconds without events so that proxies keep the stream open.
+
+    Args:
+        feed (ChangeFeed): The feed the subscriber was added to.
+        subscription (Subscription): The subscriber.
+        heartbeat (float): Seconds between keepalive comments.
+
+    Returns:
+        AsyncIterator[bytes]: The event stream.
+    """
+    try:
+        while True:
+            try:
+                frame = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield KEEPALIVE
+                continue
+            frames = [frame]
+            while frames[-1] is not None and not subscription.queue.empty():
+                frames.append(subscription.queue.get_nowait())
+            if frames[-1] is None:
+                yield b"".join(frames[:-1]) + OVERFLOW
+                return
+            yield b"".join(frames)
+    finally:
+        feed.unsubscribe(subscription)
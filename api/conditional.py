@@ -0,0 +1,57 @@
+from typing import Optional
+
+from starlette.responses import Response
+from starlette.status import HTTP_304_NOT_MODIFIED
+
+
+def make_etag(kind: str, marker: int) -> str:
+    """
+    Build a weak entity tag from a version marker.
+
+    Args:
+        kind (str): Short prefix naming the marker ("u" for a user version,
+            "g" for the user_table generation).
+        marker (int): The version marker.
+
+    Returns:
+        str: The entity tag.
+    """
+    return f'W/"{kind}{marker}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an entity tag.
+
+    Tags are compared with the weak comparison function of RFC 9110.
+
+    Args:
+        if_none_match (Optional[str]): The If-None-Match request header.
+        etag (str): The current entity tag of the resource.
+
+    Returns:
+        bool: True if the client already holds the current representation.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque_tag
+               for candidate in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    """
+    Build an empty 304 Not Modified response.
+
+    It carries the Vary header of the 200 responses it stands for, so that a
+    cache revalidating one representation does not serve it for another.
+
+    Args:
+        etag (str): The current entity tag of the resource.
+
+    Returns:
+        Response: The 304 response.
+    """
+    return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Vary": "Accept"})
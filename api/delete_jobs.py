@@ -0,0 +1,130 @@
+import asyncio
+import uuid
+from typing import AsyncContextManager, Callable, Dict, Optional
+
+from pydantic import BaseModel, Field
+
+from user_cache import coherent_factory
+from user_repository import UserFilter, UserRepository, open_user_repository
+
+
+class DeleteJobRequest(BaseModel):
+    """
+    Pydantic model for starting a delete-by-filter job.
+
+    Attributes:
+        user_filter (UserFilter): The users to delete; the limit is ignored.
+        batch_size (int): Users deleted per transaction.
+        pause (float): Seconds to wait between two batches.
+    """
+    user_filter: UserFilter
+    batch_size: int = Field(default=1000, ge=1, le=100_000)
+    pause: float = Field(default=0.1, ge=0)
+
+
+class DeleteJobStatus(BaseModel):
+    """
+    Pydantic model describing the progress of a delete-by-filter job.
+
+    Attributes:
+        job_id (str): Identifier of the job.
+        state (str): "running", "done" or "failed".
+        deleted (int): Users deleted so far.
+        batches (int): Batches committed so far.
+        last_id (int): Greatest id deleted so far; the job resumes after it.
+        error (Optional[str]): The error that stopped the job, if any.
+    """
+    job_id: str
+    state: str = "running"
+    deleted: int = 0
+    batches: int = 0
+    last_id: int = 0
+    error: Optional[str] = None
+
+
+class DeleteJobs:
+    """
+    Runs delete-by-filter jobs in the background and keeps their status.
+
+    Each batch is deleted through a repository of its own, so a job never
+    holds a transaction open across batches or pauses.
+    """
+
+    def __init__(self, repository_factory: Callable[[], AsyncContextManager[UserRepository]]):
+        """
+        Initialize an empty job registry.
+
+        Args:
+            repository_factory (Callable[[], AsyncContextManager[UserRepository]]):
+                Opens the repository used for one batch.
+        """
+        self._repository_factory = repository_factory
+        self._jobs: Dict[str, DeleteJobStatus] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def start(self, request: DeleteJobRequest) -> DeleteJobStatus:
+        """
+        Start a job in the background.
+
+        Args:
+            request (DeleteJobRequest): The users to delete and the batching settings.
+
+        Returns:
+            DeleteJobStatus: The status of the new job.
+        """
+        status = DeleteJobStatus(job_id=uuid.uuid4().hex)
+        self._jobs[status.job_id] = status
+        task = asyncio.create_task(self._run(request, status))
+        self._tasks[status.job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(status.job_id, None))
+        return status
+
+    def get(self, job_id: str) -> Optional[DeleteJobStatus]:
+        """
+        Look up the status of a job.
+
+        Args:
+            job_id (str): Identifier of the job.
+
+        Returns:
+            Optional[DeleteJobStatus]: The status, or None for an unknown job.
+        """
+        return self._jobs.get(job_id)
+
+    async def wait(self, job_id: str) -> None:
+        """
+        Wait until a job has finished.
+
+        Args:
+            job_id (str): Identifier of the job.
+        """
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+
+    async def _run(self, request: DeleteJobRequest, status: DeleteJobStatus) -> None:
+        """
+        Delete batches until no matching user is left.
+
+        Args:
+            request (DeleteJobRequest): The users to delete and the batching settings.
+            status (DeleteJobStatus): Updated after every batch.
+        """
+        try:
+            while True:
+                async with self._repository_factory() as repository:
+                    deleted, last_id = await repository.delete_batch(
+                        request.user_filter, status.last_id, request.batch_size)
+                if last_id is None:
+                    break
+                status.deleted += deleted
+                status.batches += 1
+                status.last_id = last_id
+                await asyncio.sleep(request.pause)
+            status.state = "done"
+        except Exception as error:  # pylint: disable=broad-except
+            status.state = "failed"
+            status.error = str(error)
+
+
+delete_jobs = DeleteJobs(coherent_factory(open_user_repository))
@@ -0,0 +1,222 @@
+"""
+Export user_table as CSV or Parquet.
+
+Run from the api directory with DB_STRING set:
+
+    python -m export --format parquet --output users.parquet --by-country Country1
+
+Rows are read through a server-side cursor in chunks and encoded chunk by
+chunk, so memory stays bounded whatever the size of the table.
+"""
+import argparse
+import asyncio
+import csv
+import io
+import logging
+import os
+import sys
+import time
+from contextlib import ExitStack
+from typing import AsyncContextManager, AsyncIterator, Callable, List
+
+from user_repository import EXPORT_COLUMNS, UserFilter, UserRepository, open_user_repository
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COLUMNS = ["email", "name", "country", "status"]
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+MEDIA_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+class ExportStats:
+    """
+    Counts the exported rows and measures the export rate.
+    """
+
+    def __init__(self):
+        """
+        Start measuring.
+        """
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Seconds since the export started.
+        """
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        """
+        Exported rows per second so far.
+        """
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+async def encode_csv(chunks: AsyncIterator[List[tuple]], columns: List[str],
+                     stats: ExportStats) -> AsyncIterator[bytes]:
+    """
+    Encode chunks of rows as CSV, header first.
+
+    Args:
+        chunks (AsyncIterator[List[tuple]]): The rows, chunk by chunk.
+        columns (List[str]): The column names.
+        stats (ExportStats): Updated with the number of encoded rows.
+
+    Returns:
+        AsyncIterator[bytes]: One piece of the document per chunk.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for chunk in chunks:
+        writer.writerows(chunk)
+        stats.rows += len(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+class _Drain(io.RawIOBase):
+    """
+    Write-only file that hands out what was written since the last take.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer.extend(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        """
+        Empty the buffer.
+
+        Returns:
+            bytes: The bytes written since the last call.
+        """
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+async def encode_parquet(chunks: AsyncIterator[List[tuple]], columns: List[str],
+                         stats: ExportStats) -> AsyncIterator[bytes]:
+    """
+    Encode chunks of rows as a Parquet file, one Arrow record batch per chunk.
+
+    Args:
+        chunks (AsyncIterator[List[tuple]]): The rows, chunk by chunk.
+        columns (List[str]): The column names.
+        stats (ExportStats): Updated with the number of encoded rows.
+
+    Returns:
+        AsyncIterator[bytes]: One piece of the file per chunk, then the footer.
+    """
+    # pyarrow is only needed by Parquet exports, so it is not loaded at startup.
+    import pyarrow  # pylint: disable=import-outside-toplevel
+    import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+
+    schema = pyarrow.schema([(column, pyarrow.int64() if column in ("id", "version") else pyarrow.string())
+                             for column in columns])
+    sink = _Drain()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode="w"), schema)
+    async for chunk in chunks:
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+        stats.rows += len(chunk)
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+ENCODERS = {"csv": encode_csv, "parquet": encode_parquet}
+
+
+async def export_users(repository_factory: Callable[[], AsyncContextManager[UserRepository]],
+                       user_filter: UserFilter, columns: List[str], export_format: str,
+                       chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Stream the users matching a filter in the given format.
+
+    Args:
+        repository_factory (Callable[[], AsyncContextManager[UserRepository]]):
+            Opens the repository read for the whole export.
+        user_filter (UserFilter): The filter criteria, applied by the database.
+        columns (List[str]): Names from EXPORT_COLUMNS, in output order.
+        export_format (str): "csv" or "parquet".
+        chunk_size (int): Rows read and encoded at a time.
+
+    Returns:
+        AsyncIterator[bytes]: The encoded document, piece by piece.
+    """
+    stats = ExportStats()
+    async with repository_factory() as repository:
+        chunks = repository.stream_rows(user_filter, columns, chunk_size)
+        async for data in ENCODERS[export_format](chunks, columns, stats):
+            if data:
+                yield data
+    logger.info("Exported %d rows as %s in %.2fs (%.0f rows/s)",
+                stats.rows, export_format, stats.elapsed, stats.rows_per_second)
+
+
+def parse_columns(columns: str) -> List[str]:
+    """
+    Parse a comma-separated column list.
+
+    Args:
+        columns (str): Column names separated by commas.
+
+    Returns:
+        List[str]: The column names.
+
+    Raises:
+        ValueError: If a name is not in EXPORT_COLUMNS.
+    """
+    names = [name.strip() for name in columns.split(",") if name.strip()]
+    unknown = [name for name in names if name not in EXPORT_COLUMNS]
+    if not names or unknown:
+        raise ValueError(f"Columns must be taken from {', '.join(EXPORT_COLUMNS)}")
+    return names
+
+
+async def main(arguments: argparse.Namespace) -> None:
+    """
+    Write an export to a file or to the standard output.
+
+    The number of rows and the export rate are logged to the standard error.
+
+    Args:
+        arguments (argparse.Namespace): The parsed command line.
+    """
+    user_filter = UserFilter(limit=arguments.limit, by_name=arguments.by_name,
+                             by_country=arguments.by_country, status=arguments.status)
+    with ExitStack() as stack:
+        output = sys.stdout.buffer
+        if arguments.output != "-":
+            output = stack.enter_context(open(arguments.output, "wb"))
+        async for data in export_users(open_user_repository, user_filter, parse_columns(arguments.columns),
+                                       arguments.format, arguments.chunk_size):
+            output.write(data)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--format", choices=sorted(ENCODERS), default="csv")
+    parser.add_argument("--output", default="-", help="file to write, - for the standard output")
+    parser.add_argument("--columns", default=",".join(DEFAULT_COLUMNS))
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--by-name")
+    parser.add_argument("--by-country")
+    parser.add_argument("--status")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,272 @@
+"""
+Per-process cache of /find results, keyed by the normalized UserFilter.
+
+Dashboards send the same few filters over and over. A result is cached under
+its criteria alone: the query string order does not matter since the key is
+built from the parsed filter, and the limit is not part of it. A result
+read with a limit serves any smaller limit, and a result that holds every
+matching user serves any limit. /find has no ORDER BY, so the first users
+of a larger result are as good an answer as any.
+
+Results are kept as orjson arrays of rows, without field names, within a
+budget of FIND_CACHE_BYTES, and the least recently used are evicted first.
+A change evicts only the results whose criteria the row matches, before or
+after the change; a change whose values are unknown evicts everything.
+"""
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, List, NamedTuple, Optional, Tuple
+
+import orjson
+
+from user_repository import User, UserFilter
+
+FIND_CACHE_BYTES = int(os.getenv("FIND_CACHE_BYTES", "0"))
+FIND_CACHE_TTL = float(os.getenv("FIND_CACHE_TTL", "60"))
+# Changes remembered to reject the results of reads that were in flight when they arrived.
+RECENT_CHANGES = 1024
+
+ROW_FIELDS = ("email", "name", "country", "status", "password")
+CRITERIA = (("by_name", "name"), ("by_country", "country"), ("status", "status"))
+
+FilterKey = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+class _Result(NamedTuple):
+    """
+    A cached result.
+    """
+    payload: bytes
+    # The limit it was read with, or None if it holds every matching user.
+    limit: Optional[int]
+    generation: int
+    expires: float
+
+
+def filter_key(user_filter: UserFilter) -> FilterKey:
+    """
+    Normalize the criteria of a filter, leaving the limit out.
+
+    Args:
+        user_filter (UserFilter): The filter criteria.
+
+    Returns:
+        FilterKey: The criteria, in a fixed order.
+    """
+    return user_filter.by_name, user_filter.by_country, user_filter.status
+
+
+def key_matches(key: FilterKey, row: dict) -> bool:
+    """
+    Check the values of a row against the criteria of a key.
+
+    Args:
+        key (FilterKey): The criteria.
+        row (dict): The name, country and status of a user.
+
+    Returns:
+        bool: True if the row satisfies every given criterion.
+    """
+    return all(value is None or value == row[field]
+               for value, (_, field) in zip(key, CRITERIA))
+
+
+def changed_rows(change: dict) -> Optional[List[dict]]:
+    """
+    The values a change affects: the row, and its previous values for an update.
+
+    The notifications of the database carry both. A process that upserted or
+    updated a user knows the new values at best, so its change is unknown.
+
+    Args:
+        change (dict): A change heard on the invalidation bus.
+
+    Returns:
+        Optional[List[dict]]: The values, or None if they are not known.
+    """
+    if any(field not in change for _, field in CRITERIA):
+        return None
+    if change["op"] in ("insert", "delete"):
+        return [change]
+    if "old" not in change:
+        return None
+    return [change] if change["old"] is None else [change, change["old"]]
+
+
+class FindCache:
+    """
+    A byte-bounded LRU cache of /find results.
+    """
+
+    def __init__(self, max_bytes: int = FIND_CACHE_BYTES, ttl: float = FIND_CACHE_TTL):
+        """
+        Start empty, at generation 0.
+
+        Args:
+            max_bytes (int): Serialized bytes kept at most.
+            ttl (float): Seconds a result is served for.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._results: "OrderedDict[FilterKey, _Result]" = OrderedDict()
+        self._recent: Deque[Tuple[int, Optional[List[dict]]]] = deque(maxlen=RECENT_CHANGES)
+        # Reads that started before this generation may have missed a change.
+        self._floor = 0
+        self.generation = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rejected = 0
+
+    def get(self, user_filter: UserFilter) -> Optional[Tuple[List[User], int]]:
+        """
+        Look up the result of a filter.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            Optional[Tuple[List[User], int]]: The users and the generation of
+                the collection read before them, or None if not cached.
+        """
+        key = filter_key(user_filter)
+        result = self._results.get(key)
+        if (result is None or result.expires < time.monotonic()
+                or (result.limit is not None
+                    and (user_filter.limit is None or user_filter.limit > result.limit))):
+            self.misses += 1
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        rows = orjson.loads(result.payload)  # pylint: disable=no-member
+        if user_filter.limit is not None:
+            rows = rows[:user_filter.limit]
+        users = [User.model_construct(email=email, name=name, country=country, status=status,
+                                      password=password)
+                 for email, name, country, status, password in rows]
+        return users, result.generation
+
+    def token(self) -> int:
+        """
+        Take the generation before reading from the database.
+
+        Returns:
+            int: The token to pass to fill.
+        """
+        return self.generation
+
+    def fill(self, user_filter: UserFilter, users: List[User], generation: int, token: int) -> bool:
+        """
+        Cache the result of a read, unless a change it may have missed arrived since it started.
+
+        A result read with a smaller limit does not replace one read with a larger limit.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+            users (List[User]): The users read.
+            generation (int): The generation of the collection read before the users.
+            token (int): The token taken before the read.
+
+        Returns:
+            bool: Whether the result was cached.
+        """
+        key = filter_key(user_filter)
+        if token < self._floor or any(rows is None or any(key_matches(key, row) for row in rows)
+                                      for changed_at, rows in self._recent if changed_at > token):
+            self.rejected += 1
+            return False
+        complete = user_filter.limit is None or len(users) < user_filter.limit
+        limit = None if complete else user_filter.limit
+        cached = self._results.get(key)
+        if (cached is not None and cached.expires >= time.monotonic()
+                and (cached.limit is None or (limit is not None and limit <= cached.limit))):
+            return False
+        payload = orjson.dumps([[getattr(user, field) for field in ROW_FIELDS]  # pylint: disable=no-member
+                                for user in users])
+        if len(payload) > self.max_bytes:
+            return False
+        self._discard(key)
+        self._results[key] = _Result(payload, limit, generation, time.monotonic() + self.ttl)
+        self.bytes += len(payload)
+        while self.bytes > self.max_bytes:
+            self._discard(next(iter(self._results)))
+            self.evictions += 1
+        return True
+
+    def _discard(self, key: FilterKey) -> None:
+        """
+        Remove a result if it is cached.
+
+        Args:
+            key (FilterKey): Its criteria.
+        """
+        result = self._results.pop(key, None)
+        if result is not None:
+            self.bytes -= len(result.payload)
+
+    def on_change(self, change: dict) -> None:
+        """
+        Evict the results a changed row may enter or leave, or all if its values are unknown.
+
+        Args:
+            change (dict): The change, with the name, country and status of the
+                row and, for an update, its previous values under old.
+        """
+        rows = changed_rows(change)
+        if rows is None:
+            self.clear()
+            return
+        self.generation += 1
+        self._record(rows)
+        for key in [key for key in self._results if any(key_matches(key, row) for row in rows)]:
+            self._discard(key)
+            self.invalidations += 1
+
+    @staticmethod
+    def knows(change: dict) -> bool:
+        """
+        Tell whether on_change evicts exactly what a change makes stale.
+
+        Args:
+            change (dict): A change heard on the invalidation bus.
+
+        Returns:
+            bool: Whether the values of the row are known.
+        """
+        return changed_rows(change) is not None
+
+    def clear(self) -> None:
+        """
+        Evict every result, and reject the fills of every read in flight.
+        """
+        self.generation += 1
+        self._record(None)
+        self.invalidations += len(self._results)
+        self._results.clear()
+        self.bytes = 0
+
+    def _record(self, rows: Optional[List[dict]]) -> None:
+        """
+        Remember a change for the reads in flight.
+
+        Args:
+            rows (Optional[List[dict]]): The values it affects, or None for every user.
+        """
+        if len(self._recent) == self._recent.maxlen:
+            self._floor = self._recent[0][0]
+        self._recent.append((self.generation, rows))
+
+    def snapshot(self) -> dict:
+        """
+        Describe the cache.
+
+        Returns:
+            dict: Cached results and their size, hits, misses, LRU evictions,
+                results evicted by changes and fills rejected.
+        """
+        return {"results": len(self._results), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations, "rejected": self.rejected}
@@ -0,0 +1,30 @@
+"""
+Gunicorn settings of the production server, see server.py.
+
+Every setting can be overridden with an environment variable.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "server.Worker"
+# The app is imported once in the master and the workers are forked from it,
+# so they start serving without importing it again.
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+accesslog = os.getenv("ACCESS_LOG")
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+    """
+    Load the database driver before the workers are forked.
+
+    It is otherwise imported by the first request of every worker.
+    """
+    if preload_app:
+        import asyncpg  # pylint: disable=import-outside-toplevel,unused-import
@@ -0,0 +1,216 @@
+"""
+Dictionary encoding of the status and country columns of user_table.
+
+Both columns are PostgreSQL enums: every distinct value is stored once in
+the catalog and each row only holds a fixed-size reference to it, while the
+API keeps reading and writing plain strings. A value is added to its enum the
+first time it is written. The labels known to exist are cached per engine,
+so writing a known value or filtering on one costs no extra query. A label
+holds at most MAX_LABEL_BYTES bytes, which the models validate before a
+value reaches the database.
+"""
+import weakref
+from typing import Annotated, Any, Callable, Dict, Iterable, Mapping, Optional, Sequence, Set
+
+from pydantic import AfterValidator
+
+from sqlalchemy import cast, text
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.types import String, TypeDecorator
+
+from partitioning import quote
+
+ENUM_TYPES = {"status": "user_status", "country": "user_country"}
+# NAMEDATALEN - 1: PostgreSQL rejects longer enum labels.
+MAX_LABEL_BYTES = 63
+# Raised by ADD VALUE IF NOT EXISTS when another connection adds the same label at the same time.
+DUPLICATE_LABEL_SQLSTATES = {"42710", "23505"}
+
+
+def check_label(value: str) -> str:
+    """
+    Validate that a value fits in an enum label.
+
+    Args:
+        value (str): The status or country.
+
+    Returns:
+        str: The value.
+
+    Raises:
+        ValueError: If its UTF-8 encoding is longer than MAX_LABEL_BYTES.
+    """
+    if len(value.encode("utf-8")) > MAX_LABEL_BYTES:
+        raise ValueError(f"must be at most {MAX_LABEL_BYTES} bytes long")
+    return value
+
+
+# A status or country, stored as a label of its enum.
+Label = Annotated[str, AfterValidator(check_label)]
+
+
+class EnumLabel(TypeDecorator):  # pylint: disable=abstract-method,too-many-ancestors
+    """
+    A string stored in a PostgreSQL enum.
+
+    Bound values are cast to the enum on the server, whose labels come back
+    as strings, so no mapping happens in Python.
+    """
+    impl = String
+    cache_ok = True
+
+    def __init__(self, type_name: str):
+        """
+        Initialize with the name of the enum.
+
+        Args:
+            type_name (str): The name of the PostgreSQL enum type.
+        """
+        super().__init__()
+        self.type_name = type_name
+
+    def bind_expression(self, bindparam):
+        """
+        Cast a bound string to the enum.
+
+        Args:
+            bindparam (BindParameter): The bound parameter.
+
+        Returns:
+            ColumnElement: The cast parameter.
+        """
+        return cast(bindparam, ENUM(name=self.type_name, create_type=False))
+
+
+class LabelCache:
+    """
+    Remembers the labels of the enums of each database.
+
+    Labels are only ever added, so a cached label stays valid; an unknown one
+    is looked up in the catalog, then added if it is being written.
+    """
+
+    def __init__(self):
+        """
+        Start with no label known.
+        """
+        # Keyed by connection pool, which get_engine and its read-only view share.
+        self._labels: "weakref.WeakKeyDictionary[Any, Dict[str, Set[str]]]" = \
+            weakref.WeakKeyDictionary()
+
+    async def _load(self, session: AsyncSession,
+                    execute: Optional[Callable] = None) -> Dict[str, Set[str]]:
+        """
+        Read the labels of the enums from the catalog.
+
+        Args:
+            session (AsyncSession): A session on the database.
+            execute (Optional[Callable]): Runs a statement on it, session.execute by default.
+
+        Returns:
+            Dict[str, Set[str]]: The labels keyed by column.
+        """
+        result = await (execute or session.execute)(text(
+            "SELECT enumtypid::regtype::text, enumlabel FROM pg_enum "
+            "WHERE enumtypid IN (to_regtype(:status), to_regtype(:country))"), ENUM_TYPES)
+        names = {type_name: column for column, type_name in ENUM_TYPES.items()}
+        labels: Dict[str, Set[str]] = {column: set() for column in ENUM_TYPES}
+        for type_name, label in result:
+            labels[names[type_name.rsplit(".", 1)[-1]]].add(label)
+        self._labels[session.bind.sync_engine.pool] = labels
+        return labels
+
+    def _known(self, session: AsyncSession) -> Dict[str, Set[str]]:
+        """
+        The labels cached for the database of a session.
+
+        Args:
+            session (AsyncSession): A session on the database.
+
+        Returns:
+            Dict[str, Set[str]]: The labels keyed by column, empty if none is cached.
+        """
+        return self._labels.get(session.bind.sync_engine.pool, {})
+
+    async def exist(self, session: AsyncSession, values: Mapping[str, Optional[str]],
+                    execute: Optional[Callable] = None) -> bool:
+        """
+        Tell whether values can be compared with their columns.
+
+        Comparing an enum with a label it does not have is an error, so a
+        filter on an unknown label matches nothing and is not sent.
+
+        Args:
+            session (AsyncSession): A session on the database.
+            values (Mapping[str, Optional[str]]): Values keyed by column, None for no value.
+            execute (Optional[Callable]): Runs a statement on the session, session.execute by
+                default.
+
+        Returns:
+            bool: True if every value is a label of its column's enum.
+        """
+        values = {column: value for column, value in values.items() if value is not None}
+        known = self._known(session)
+        if all(value in known.get(column, ()) for column, value in values.items()):
+            return True
+        known = await self._load(session, execute)
+        return all(value in known[column] for column, value in values.items())
+
+    async def ensure(self, session: AsyncSession, rows: Sequence[Mapping[str, Any]],
+                     execute: Optional[Callable] = None) -> None:
+        """
+        Add the values about to be written that their enums do not have yet.
+
+        New labels are added on a connection of their own in autocommit,
+        since a label added in a transaction cannot be used before it commits.
+        A label added at the same time by another process is not an error.
+
+        Args:
+            session (AsyncSession): The session that will write the rows.
+            rows (Sequence[Mapping[str, Any]]): The values written, keyed by column.
+            execute (Optional[Callable]): Runs a statement on the session, session.execute by
+                default.
+
+        Raises:
+            DBAPIError: If a label cannot be added, e.g. when it is too long.
+        """
+        wanted = {column: {row[column] for row in rows if row.get(column) is not None}
+                  for column in ENUM_TYPES}
+        known = self._known(session)
+        if all(values <= known.get(column, set()) for column, values in wanted.items()):
+            return
+        known = await self._load(session, execute)
+        missing = {column: values - known[column] for column, values in wanted.items()}
+        if not any(missing.values()):
+            return
+        async with session.bind.connect() as connection:
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+            for column, labels in missing.items():
+                for label in sorted(labels):
+                    try:
+                        await connection.execute(text(f"ALTER TYPE {ENUM_TYPES[column]} "
+                                                      f"ADD VALUE IF NOT EXISTS {quote(label)}"))
+                    except DBAPIError as error:
+                        if getattr(error.orig, "sqlstate", None) not in DUPLICATE_LABEL_SQLSTATES:
+                            raise
+        await self._load(session, execute)
+
+
+label_cache = LabelCache()
+
+
+def enum_type_ddl(column: str, labels: Iterable[str]) -> str:
+    """
+    Build the statement creating the enum of a column.
+
+    Args:
+        column (str): "status" or "country".
+        labels (Iterable[str]): The initial labels, in order.
+
+    Returns:
+        str: The statement.
+    """
+    labels = ", ".join(quote(label) for label in labels)
+    return f"CREATE TYPE {ENUM_TYPES[column]} AS ENUM ({labels})"
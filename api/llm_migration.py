@@ -0,0 +1,549 @@
+"""
+Migrate a tree of SQLAlchemy 1.4 modules to SQLAlchemy 2 with a language model.
+
+Run from the api directory:
+
+    GOOGLE_API_KEY=... python -m llm_migration src/ migrated/ --concurrency 8 --rate 60
+
+These are the steps of LLM_migration_SQLAlchemy_using_gemini.ipynb, applied
+to every Python module importing sqlalchemy under the source directory:
+the code is read, put into the prompt of the chosen approach, sent to the
+model, and the answer is written at the same relative path under the output
+directory. Files are migrated concurrently, with at most --concurrency
+requests in flight and no more than --rate requests per minute. A timeout or
+an overloaded model (the 500 errors gemini-1.5-pro answers on timeouts) is
+retried with exponential backoff. Files whose output already exists are
+skipped unless --force is given, so a run can be resumed.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# The prompts of the notebook, kept word for word.
+# pylint: disable=line-too-long
+MIGRATION_INSTRUCTIONS = '''The Python code bellow uses the library sqlalchemy with version 1. Migrate it so that it works with version 2 of sqlalchemy.
+Make the code compatible with python’s asyncio. Use python’s typing module to add type hints to the code. Your answer must only contain code. Do not explain it. Do not add markdown backticks for code. Do not add extra functionality to the code. Do not remove code that is not being changed. If there’s no need to change the code, answer only with the code itself. The first line of code must have a comment "### START CODE ###". The last line of code must have a comment "### END CODE ###".
+
+'''
+
+NEW_ZERO_SHOT_MIGRATION_INSTRUCTIONS = '''The Python code below uses the library SQLAlchemy version 1.4. It's a user repository file. Migrate it so that it works with version 2 of SQLAlchemy. Make the code compatible with Python’s asyncio. Use Python’s typing module to add type hints to the code. Your answer must only contain code. Do not explain it. Do not add markdown backticks for code. Do not add extra functionality to the code. Do not remove code that is not being changed. If there’s no need to change the code, answer only with the code itself. Please try to implement the migrated methods; do not leave necessary methods unimplemented, and do not forget all the necessary imports. The first line of code must have a comment "### START CODE ###". The last line of code must have a comment "### END CODE ###". Here is the code to migrate:
+### START CODE ###
+'''
+
+ONE_SHOT_EXAMPLE = """Before migration:
+
+from typing import List from sqlalchemy.orm import sessionmaker, declarative_base from sqlalchemy import Column, Integer, String, create_engine from sqlalchemy.future import select
+
+DATABASE_URL = "sqlite:///./test.db"
+
+engine = create_engine(DATABASE_URL, echo=True) SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine) Base = declarative_base()
+
+class User(Base): tablename = "users"
+
+mathematica
+
+id = Column(Integer, primary_key=True, index=True)
+name = Column(String, index=True)
+
+def get_user_by_id(session: SessionLocal, user_id: int) -> User: with session() as db_session: result = db_session.execute(select(User).filter(User.id == user_id)) return result.scalars().one_or_none()
+
+def get_all_users(session: SessionLocal) -> List[User]: with session() as db_session: result = db_session.execute(select(User)) return result.scalars().all()
+
+After migration:
+
+from typing import List from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine from sqlalchemy.orm import sessionmaker, declarative_base, mapped_column from sqlalchemy import Integer, String from sqlalchemy.future import select
+
+DATABASE_URL = "sqlite+aiosqlite:///./test.db"
+
+engine = create_async_engine(DATABASE_URL, echo=True) SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession) Base = declarative_base()
+
+class User(Base): tablename = "users"
+
+mathematica
+
+id = mapped_column(Integer, primary_key=True, index=True)
+name = mapped_column(String, index=True)
+
+async def get_user_by_id(session: AsyncSession, user_id: int) -> User: async with session() as db_session: result = await db_session.execute(select(User).filter(User.id == user_id)) return result.scalar_one_or_none()
+
+async def get_all_users(session: AsyncSession) -> List[User]: async with session() as db_session: result = await db_session.execute(select(User)) return result.scalars().all()"""
+
+CHAIN_OF_THOUGHT_MIGRATION_GUIDE = """
+Use the steps below as a guide for the migration. You don’t
+need to follow them exactly as described, but they should be
+able to help with the migration:
+1. Update the used database engine, if any, so that you’re using
+‘create_async_engine‘ instead of ‘create_engine‘.
+2. If any tables and their columns are declared, update their
+declarations so that they use ‘mapped_columns‘ instead of
+‘schema.Column‘ and ensure they are correctly typed with the
+Mapped annotation, making sure to import the correct types
+from the library.
+3. Ensure that all queries, if any, are updated to use the new 2.0
+style of querying, such as using ‘select()‘ instead of ‘query()‘.
+4. Update functions that use ‘sessionmaker‘ to use ‘session‘ instead.
+5. Update the code to use async functions and await calls where
+necessary.
+6. Implement type hinting for all functions and variables and update old type hinting to ensure they are correct.
+7. Ensure there are no missing import statements.
+8. Remove any unused imports or variable declarations.
+9. Make sure the code works.
+"""
+# pylint: enable=line-too-long
+
+START_CODE = "### START CODE ###"
+END_CODE = "### END CODE ###"
+APPROACHES = ("zero-shot", "one-shot", "chain-of-thought")
+# Status codes of an overloaded model or of a request that timed out on its side.
+RETRIED_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class ModelUnavailable(Exception):
+    """
+    Raised by a model client when a request timed out or the model is overloaded.
+
+    The request is retried after a backoff; any other error fails the file at once.
+    """
+
+
+class IncompleteAnswer(Exception):
+    """
+    Raised when the answer of the model lacks the end marker, e.g. when cut by the token limit.
+    """
+
+
+def read_python_code(file_path: str) -> str:
+    """
+    Read a Python module to pass it to the model in the prompt.
+
+    Args:
+        file_path (str): Path of the module.
+
+    Returns:
+        str: The code of the module.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def write_python_code(file_path: str, code: str) -> None:
+    """
+    Write migrated code, creating the directories of its path.
+
+    Args:
+        file_path (str): Path of the migrated module.
+        code (str): The migrated code.
+    """
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write(code)
+
+
+def build_prompt(code: str, approach: str = "zero-shot") -> str:
+    """
+    Assemble the prompt of an approach of the notebook around the code to migrate.
+
+    Args:
+        code (str): The code to migrate.
+        approach (str): "zero-shot", "one-shot" or "chain-of-thought".
+
+    Returns:
+        str: The prompt.
+    """
+    if approach == "one-shot":
+        return f"{MIGRATION_INSTRUCTIONS}\n here  is an example of code before and after " \
+               f"migration follow it {ONE_SHOT_EXAMPLE} , Here is the code to migrate: " \
+               f"{START_CODE}  {code}"
+    if approach == "chain-of-thought":
+        return f"{MIGRATION_INSTRUCTIONS}\n {CHAIN_OF_THOUGHT_MIGRATION_GUIDE} , " \
+               f"Here is the code to migrate: {START_CODE}  : {code}"
+    return f"{NEW_ZERO_SHOT_MIGRATION_INSTRUCTIONS}{code}"
+
+
+def extract_code(answer: str) -> str:
+    """
+    Take the code out of the answer of the model, between its markers.
+
+    Markdown fences are dropped, since the models add them despite the instructions.
+
+    Args:
+        answer (str): The text generated by the model.
+
+    Returns:
+        str: The migrated code, ending with a newline.
+
+    Raises:
+        IncompleteAnswer: If the answer has no END_CODE marker.
+    """
+    start, end = answer.find(START_CODE), answer.rfind(END_CODE)
+    if end < 0:
+        raise IncompleteAnswer("The answer has no end of code marker")
+    code = answer[start + len(START_CODE) if 0 <= start < end else 0:end]
+    lines = [line for line in code.strip("\n").splitlines() if not line.startswith("```")]
+    return "\n".join(lines).strip("\n") + "\n"
+
+
+class ModelClient:
+    """
+    Interface of the language models the migration is sent to.
+    """
+
+    async def generate(self, prompt: str) -> str:
+        """
+        Generate the answer to a prompt.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            ModelUnavailable: If the request timed out or the model is overloaded.
+        """
+
+    async def close(self) -> None:
+        """
+        Release the connections of the client.
+        """
+
+
+class GeminiModelClient(ModelClient):
+    """
+    Generates with a Gemini model through the google-generativeai SDK, as the notebook does.
+    """
+
+    def __init__(self, model_name: str, api_key: str, timeout: float):
+        """
+        Configure the SDK and load the model.
+
+        Args:
+            model_name (str): The model variant, e.g. "gemini-1.5-flash".
+            api_key (str): The Gemini API key.
+            timeout (float): Seconds a generation may take.
+        """
+        # The SDK is only needed with this client, so it is only imported when it is used.
+        import google.generativeai as genai  # pylint: disable=import-outside-toplevel,import-error
+
+        genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(model_name)
+        self._timeout = timeout
+
+    async def generate(self, prompt: str) -> str:
+        """
+        Generate the answer to a prompt with generate_content_async.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            ModelUnavailable: If the deadline passed or the service is overloaded.
+        """
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel,import-error
+
+        try:
+            response = await self._model.generate_content_async(
+                prompt, request_options={"timeout": self._timeout})
+        except (exceptions.DeadlineExceeded, exceptions.InternalServerError,
+                exceptions.ServiceUnavailable, exceptions.TooManyRequests) as error:
+            raise ModelUnavailable(str(error)) from error
+        return response.text
+
+
+class HTTPModelClient(ModelClient):
+    """
+    Generates by posting {"prompt": ...} to a URL answering {"text": ...}.
+
+    A local stub server stands in for the model with it in tests, and a
+    proxy in front of any other model can serve it.
+    """
+
+    def __init__(self, url: str, timeout: float):
+        """
+        Initialize without connecting.
+
+        Args:
+            url (str): The URL of the generation endpoint.
+            timeout (float): Seconds a generation may take.
+        """
+        self._url = url
+        self._client = httpx.AsyncClient(timeout=timeout)
+
+    async def generate(self, prompt: str) -> str:
+        """
+        Post the prompt and return the generated text.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            ModelUnavailable: On a timeout, or a status in RETRIED_STATUS_CODES.
+            httpx.HTTPStatusError: On any other error status.
+        """
+        try:
+            response = await self._client.post(self._url, json={"prompt": prompt})
+        except httpx.TimeoutException as error:
+            raise ModelUnavailable(f"Timed out after {self._client.timeout.read}s") from error
+        if response.status_code in RETRIED_STATUS_CODES:
+            raise ModelUnavailable(f"{response.status_code} {response.text[:200]}")
+        response.raise_for_status()
+        return response.json()["text"]
+
+    async def close(self) -> None:
+        """
+        Close the connections of the client.
+        """
+        await self._client.aclose()
+
+
+class TokenBucket:
+    """
+    Admits up to `rate` requests per second on average, in bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        Start with a full bucket.
+
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): Tokens the bucket holds at most.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Take a token, waiting for it to be added when the bucket is empty.
+
+        Waiters are served in arrival order, since they queue on the lock.
+        """
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens, self._updated = 1, time.monotonic()
+            self._tokens -= 1
+
+
+class MigrationReport:
+    """
+    Outcome of a migration run, by source path.
+
+    Attributes:
+        migrated (List[str]): The files migrated.
+        skipped (List[str]): The files whose output already existed.
+        failed (Dict[str, str]): The error of each file that could not be migrated.
+        attempts (int): Requests sent to the model, retries included.
+    """
+
+    def __init__(self):
+        """
+        Start with an empty report.
+        """
+        self.migrated: List[str] = []
+        self.skipped: List[str] = []
+        self.failed: Dict[str, str] = {}
+        self.attempts = 0
+
+
+def find_modules(source: str, output: Optional[str] = None) -> List[str]:
+    """
+    List the Python modules importing sqlalchemy under a directory, in a stable order.
+
+    Args:
+        source (str): The source directory.
+        output (Optional[str]): The output directory, left out if it is inside the source.
+
+    Returns:
+        List[str]: The paths of the modules, relative to the source.
+    """
+    output = os.path.abspath(output) if output else None
+    modules = []
+    for directory, subdirectories, files in os.walk(source):
+        subdirectories[:] = sorted(name for name in subdirectories
+                                   if os.path.abspath(os.path.join(directory, name)) != output)
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            if name.endswith(".py") and "sqlalchemy" in read_python_code(path):
+                modules.append(os.path.relpath(path, source))
+    return modules
+
+
+class Migrator:
+    """
+    Migrates the modules of a tree concurrently through a model client.
+    """
+
+    def __init__(self, client: ModelClient, concurrency: int, bucket: TokenBucket,
+                 retries: int = 5, backoff: float = 2.0, approach: str = "zero-shot"):
+        """
+        Initialize with the limits of the run.
+
+        Args:
+            client (ModelClient): The model the prompts are sent to.
+            concurrency (int): Requests in flight at most.
+            bucket (TokenBucket): Paces the requests, retries included.
+            retries (int): Retries of a request on ModelUnavailable.
+            backoff (float): Seconds before the first retry, doubled on each next one.
+            approach (str): The prompt approach, one of APPROACHES.
+        """
+        # pylint: disable=too-many-arguments
+        self.client = client
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+        self.approach = approach
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.report = MigrationReport()
+
+    async def generate(self, prompt: str) -> str:
+        """
+        Generate with the model, retrying with backoff while it is unavailable.
+
+        The backoff is spent outside the concurrency limit, so other files use the slot.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            ModelUnavailable: If the last retry failed too.
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    await self.bucket.acquire()
+                    self.report.attempts += 1
+                    return await self.client.generate(prompt)
+            except ModelUnavailable as error:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning("Model unavailable (%s), retrying in %.1fs", error, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def migrate_file(self, source_path: str, output_path: str) -> None:
+        """
+        Read, migrate and write one module.
+
+        Args:
+            source_path (str): Path of the module to migrate.
+            output_path (str): Path of the migrated module.
+        """
+        code = await asyncio.to_thread(read_python_code, source_path)
+        answer = await self.generate(build_prompt(code, self.approach))
+        await asyncio.to_thread(write_python_code, output_path, extract_code(answer))
+
+    async def migrate_tree(self, source: str, output: str, force: bool = False) -> MigrationReport:
+        """
+        Migrate every module importing sqlalchemy under a directory.
+
+        A file that fails is reported and does not stop the others.
+
+        Args:
+            source (str): The source directory.
+            output (str): The directory the migrated modules are written to.
+            force (bool): Migrate again the modules whose output already exists.
+
+        Returns:
+            MigrationReport: The outcome of each module.
+        """
+
+        async def migrate(module: str) -> None:
+            output_path = os.path.join(output, module)
+            if not force and os.path.exists(output_path):
+                self.report.skipped.append(module)
+                return
+            try:
+                await self.migrate_file(os.path.join(source, module), output_path)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logger.error("Failed to migrate %s: %r", module, error)
+                self.report.failed[module] = repr(error)
+            else:
+                logger.info("Migrated %s", module)
+                self.report.migrated.append(module)
+
+        modules = await asyncio.to_thread(find_modules, source, output)
+        await asyncio.gather(*(migrate(module) for module in modules))
+        return self.report
+
+
+def create_model_client(arguments: argparse.Namespace) -> ModelClient:
+    """
+    Create the model client selected on the command line.
+
+    Args:
+        arguments (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        ModelClient: An HTTPModelClient with --url, a GeminiModelClient otherwise.
+    """
+    if arguments.url:
+        return HTTPModelClient(arguments.url, arguments.timeout)
+    return GeminiModelClient(arguments.model, os.environ["GOOGLE_API_KEY"], arguments.timeout)
+
+
+async def main(arguments: argparse.Namespace) -> int:
+    """
+    Migrate the source tree given on the command line.
+
+    Args:
+        arguments (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        int: The exit status, 1 if any module failed.
+    """
+    client = create_model_client(arguments)
+    migrator = Migrator(client, arguments.concurrency,
+                        TokenBucket(arguments.rate / 60, arguments.burst), arguments.retries,
+                        arguments.backoff, arguments.approach)
+    try:
+        report = await migrator.migrate_tree(arguments.source, arguments.output, arguments.force)
+    finally:
+        await client.close()
+    logger.info("%d migrated, %d skipped, %d failed, %d requests", len(report.migrated),
+                len(report.skipped), len(report.failed), report.attempts)
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("source", help="directory of the modules to migrate")
+    parser.add_argument("output", help="directory the migrated modules are written to")
+    parser.add_argument("--approach", choices=APPROACHES, default="zero-shot")
+    parser.add_argument("--model", default="gemini-1.5-flash")
+    parser.add_argument("--url", help="generation endpoint of an HTTP model instead of Gemini")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at most")
+    parser.add_argument("--rate", type=float, default=60, help="requests per minute at most")
+    parser.add_argument("--burst", type=float, default=1, help="requests sent at once when idle")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=2.0, help="seconds before a retry")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per request")
+    parser.add_argument("--force", action="store_true", help="migrate existing outputs again")
+    sys.exit(asyncio.run(main(parser.parse_args())))
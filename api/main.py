@@ -1,13 +1,97 @@
-from typing import Optional, List
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Optional, List, AsyncGenerator, Any
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.params import Depends
-from starlette.responses import RedirectResponse
-from starlette.status import HTTP_201_CREATED, HTTP_404_NOT_FOUND
+from pydantic import ValidationError
+from starlette.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.status import (HTTP_201_CREATED, HTTP_202_ACCEPTED, HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST,
+                              HTTP_404_NOT_FOUND, HTTP_415_UNSUPPORTED_MEDIA_TYPE, HTTP_503_SERVICE_UNAVAILABLE)
 
-from user_repository import UserRepository, create_user_repository, UserFilter, User
+from admission import READ, WRITE, admission_controller, admit
+from batching import BatchingUserRepository, user_loader
+from changes import ChangeFeedUnavailable, change_feed, stream_changes
+from conditional import etag_matches, make_etag, not_modified
+from delete_jobs import DeleteJobRequest, DeleteJobStatus, delete_jobs
+from export import DEFAULT_COLUMNS, MEDIA_TYPES, export_users, parse_columns
+from responses import (JSON, MSGPACK, UnsupportedMediaType, decode_body, negotiate,
+                       user_list_response, user_response)
+from single_flight import SingleFlightUserRepository, user_flights
+from spool import CREATE_SPOOL_DIR, TICKET_PENDING, CreateTicketStatus, create_spool, ticket_time
+from user_cache import (CACHES_ENABLED, FIND_CACHE_BYTES, USER_CACHE_SIZE, CachingUserRepository,
+                        find_cache, invalidation_bus, user_cache)
+from user_repository import (CHANGES_PAGE_SIZE, UserRepository, create_user_repository, UserFilter, User,
+                             EmailBatch, UserBatch, UserChanges, UserUpdate, create_read_only_user_repository,
+                             get_user_repository_factory, repository_stats)
 
-app = FastAPI(swagger_ui_default_parameters={"tryItOutEnabled": True})
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncGenerator[None, Any]:
+    """
+    Drains the /create/ spool while the app runs, when CREATE_SPOOL_DIR is set.
+
+    Segments left by stopped workers are replayed on start; the entries not
+    drained yet on shutdown are replayed on the next start.
+
+    :param _: The application.
+    :return: An asynchronous generator yielding while the app runs.
+    """
+    if CREATE_SPOOL_DIR:
+        await create_spool.start()
+    try:
+        yield
+    finally:
+        if create_spool.running:
+            await create_spool.stop()
+
+
+app = FastAPI(swagger_ui_default_parameters={"tryItOutEnabled": True}, lifespan=lifespan)
+
+BATCH_USER_LOOKUPS = os.getenv("BATCH_USER_LOOKUPS", "0") == "1"
+COUNT_BUDGET_MS = int(os.getenv("COUNT_BUDGET_MS", "50"))
+
+
+async def create_read_user_repository(
+        user_repository: UserRepository = Depends(create_read_only_user_repository)
+) -> AsyncGenerator[UserRepository, Any]:
+    """
+    Decorate the request's read-only repository for the read routes.
+
+    Its statements run in autocommit, without BEGIN and COMMIT. Identical
+    concurrent reads share one query. With BATCH_USER_LOOKUPS=1, lookups by
+    email made during the same event-loop tick are also grouped into one
+    query. With USER_CACHE_SIZE set, lookups by email are served from the
+    user cache of the process first.
+
+    :param user_repository: Dependency injection for the user repository.
+    :return: An asynchronous generator yielding the decorated repository.
+    """
+    if BATCH_USER_LOOKUPS:
+        user_repository = BatchingUserRepository(user_repository, user_loader)
+    if USER_CACHE_SIZE:
+        # Inside single-flight: a cached read never comes from a query started before its token.
+        user_repository = CachingUserRepository(user_repository, user_cache, invalidation_bus)
+    yield SingleFlightUserRepository(user_repository, user_flights)
+
+
+async def create_write_user_repository(
+        user_repository: UserRepository = Depends(create_user_repository)
+) -> AsyncGenerator[UserRepository, Any]:
+    """
+    Decorate the request's repository for the write routes.
+
+    With USER_CACHE_SIZE or FIND_CACHE_BYTES set, what the writes make stale is
+    evicted from the caches of every process once the transaction is committed.
+
+    :param user_repository: Dependency injection for the user repository.
+    :return: An asynchronous generator yielding the decorated repository.
+    """
+    if CACHES_ENABLED:
+        user_repository = CachingUserRepository(user_repository, user_cache, invalidation_bus)
+    yield user_repository
 
 
 @app.get("/")
@@ -20,9 +104,33 @@ async def root():
     return RedirectResponse(url="/docs")
 
 
-@app.post("/create/", status_code=HTTP_201_CREATED)
+@app.get("/metrics")
+async def metrics():
+    """
+    Reports the state of the admission controller, of the read de-duplication, of
+    the request repositories, of the change feed and of the user cache.
+
+    :return: Limit, in-flight and queued operations and rejection counts per route class,
+        the number of started and shared reads, the number of batched lookups, the
+        number of request repositories that never touched the database, the
+        subscribers of /changes/stream, the hits and invalidations of the user
+        and /find caches and the entries appended to and drained from the /create/ spool.
+    """
+    return {
+        "admission": admission_controller.snapshot(),
+        "single_flight": user_flights.snapshot(),
+        "batching": user_loader.snapshot(),
+        "repository": repository_stats.snapshot(),
+        "changes": change_feed.snapshot(),
+        "cache": user_cache.snapshot(),
+        "find_cache": find_cache.snapshot(),
+        "spool": create_spool.snapshot(),
+    }
+
+
+@app.post("/create/", status_code=HTTP_201_CREATED, dependencies=[Depends(admit(WRITE))])
 async def create(user_data: User,
-                 user_repository: UserRepository = Depends(create_user_repository)):
+                 user_repository: UserRepository = Depends(create_write_user_repository)):
     """
     Create a new user with the provided information.
 
@@ -31,48 +139,377 @@ async def create(user_data: User,
         user_repository (UserRepository): Dependency injection of the user repository
 
     Returns:
-        dict: Success message indicating that the user was created.
+        dict: Success message indicating that the user was created. When
+            CREATE_SPOOL_DIR is set, an HTTP 202 with the ticket to pass to
+            GET /create/{ticket} once the user is spooled to disk.
 
     """
-    user = User(
-        email=user_data.email,
-        password=user_data.password,
-        name=user_data.name,
-        country=user_data.country,
-        status=user_data.status
-    )
+    if create_spool.running:
+        ticket = await create_spool.append(user_data)
+        return JSONResponse({"message": "User creation accepted", "ticket": ticket},
+                            status_code=HTTP_202_ACCEPTED)
 
     async with user_repository as repo:
-        await repo.save(user)
+        await repo.save(user_data)
 
     return {"message": "User created successfully!"}
 
 
-@app.get("/user/{email}", response_model=Optional[User])
-async def get(email: str, user_repository: UserRepository = Depends(create_user_repository)):
+@app.get("/create/{ticket}", response_model=CreateTicketStatus, dependencies=[Depends(admit(READ))])
+async def get_create_ticket(ticket: str,
+                            user_repository: UserRepository = Depends(create_read_user_repository)):
+    """
+    Reports what became of a creation accepted with an HTTP 202.
+
+    A ticket is pending until its batch is committed, then created,
+    duplicate when the email was already taken, or failed when the user
+    could not be stored. Outcomes are kept for TICKET_RETENTION_HOURS.
+
+    :param ticket: The ticket returned by /create/.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The state of the ticket, or raises an HTTP 404 for an unknown or expired ticket.
+    """
+    created_at = ticket_time(ticket)
+    if created_at is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Ticket not found")
+    if create_spool.is_pending(ticket):
+        return CreateTicketStatus(ticket=ticket, state=TICKET_PENDING)
+    async with user_repository as repo:
+        outcome = await repo.get_ticket_outcome(ticket)
+    if outcome is None:
+        # Another worker may still hold it in its spool.
+        if datetime.now(timezone.utc) - created_at > create_spool.retention:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Ticket not found")
+        outcome = TICKET_PENDING
+    return CreateTicketStatus(ticket=ticket, state=outcome)
+
+
+@app.post("/upsert/", response_model=User, dependencies=[Depends(admit(WRITE))])
+async def upsert(user_data: User,
+                 user_repository: UserRepository = Depends(create_write_user_repository)):
+    """
+    Creates a user, or updates the user with the same email, in one statement.
+
+    :param user_data: Pydantic model containing user details.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The stored user.
+    """
+    async with user_repository as repo:
+        user = await repo.upsert(user_data)
+    return user_response(user)
+
+
+async def read_user_batch(request: Request) -> UserBatch:
+    """
+    Parse a UserBatch sent as JSON or as MessagePack, by Content-Type.
+
+    :param request: The incoming request.
+    :return: The validated batch, or raises an HTTP 415 for another content type,
+        an HTTP 400 for a malformed body and a 422 for an invalid batch.
+    """
+    try:
+        document = decode_body(await request.body(), request.headers.get("content-type"))
+    except UnsupportedMediaType as error:
+        raise HTTPException(status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(error)) from error
+    except ValueError as error:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(error)) from error
+    try:
+        return UserBatch.model_validate(document)
+    except ValidationError as error:
+        raise RequestValidationError(error.errors(include_url=False), body=document) from error
+
+
+USER_BATCH_SCHEMA = {key: value for key, value
+                     in UserBatch.model_json_schema(ref_template="#/components/schemas/{model}").items()
+                     if key != "$defs"}
+
+
+@app.post("/upsert/batch", response_model=List[User], dependencies=[Depends(admit(WRITE))],
+          openapi_extra={"requestBody": {"required": True, "content": {
+              JSON: {"schema": USER_BATCH_SCHEMA}, MSGPACK: {"schema": USER_BATCH_SCHEMA}}}})
+async def upsert_batch(request: Request, user_batch: UserBatch = Depends(read_user_batch),
+                       user_repository: UserRepository = Depends(create_write_user_repository)):
+    """
+    Creates or updates several users; when an email repeats, the last user wins.
+
+    The batch can be sent as JSON or as MessagePack, and the stored users are
+    returned in the format negotiated from the Accept header, like /find.
+
+    :param request: The incoming request, read for Accept.
+    :param user_batch: The users to write, at most MAX_BATCH_EMAILS.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The stored users.
+    """
+    async with user_repository as repo:
+        users = await repo.upsert_many(user_batch.users)
+    return await user_list_response(users, media_type=negotiate(request.headers.get("accept")))
+
+
+@app.get("/user/{email}", response_model=Optional[User], dependencies=[Depends(admit(READ))])
+async def get(email: str, request: Request,
+              user_repository: UserRepository = Depends(create_read_user_repository)):
     """
     Retrieves a user by email.
 
+    The response carries an ETag built from the user's version. When the
+    If-None-Match header already holds it, a 304 is returned after looking up
+    the version only.
+
     :param email: Email of the user.
+    :param request: The incoming request, read for If-None-Match.
     :param user_repository: Dependency injection for the user repository.
-    :return: The user object or raises an HTTP 404 if not found.
+    :return: The user object, a 304 response, or raises an HTTP 404 if not found.
     """
+    if_none_match = request.headers.get("if-none-match")
     async with user_repository as repo:
-        user = await repo.get_by_email(email)
-        if not user:
+        if if_none_match:
+            version = await repo.get_version(email)
+            if version is not None and etag_matches(if_none_match, make_etag("u", version)):
+                return not_modified(make_etag("u", version))
+        versioned_user = await repo.get_versioned_by_email(email)
+        if not versioned_user:
             raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User not found")
-        return user
+        user, version = versioned_user
+        return user_response(user, headers={"ETag": make_etag("u", version)})
+
+
+@app.patch("/user/{email}", response_model=User, dependencies=[Depends(admit(WRITE))])
+async def update(email: str, changes: UserUpdate,
+                 user_repository: UserRepository = Depends(create_write_user_repository)):
+    """
+    Updates the given fields of a user with a single UPDATE statement.
+
+    :param email: Email of the user.
+    :param changes: The fields to change; fields left out keep their value.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The updated user or raises an HTTP 404 if not found.
+    """
+    async with user_repository as repo:
+        user = await repo.update(email, changes)
+    if not user:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User not found")
+    return user_response(user)
+
+
+@app.patch("/users", dependencies=[Depends(admit(WRITE))])
+async def update_where(changes: UserUpdate, user_filter: UserFilter = Depends(),
+                       user_repository: UserRepository = Depends(create_write_user_repository)):
+    """
+    Updates the given fields of every user matching the filter criteria.
+
+    :param changes: The fields to change; fields left out keep their value.
+    :param user_filter: Filter criteria; at least one of by_name, by_country and status is required.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The number of updated users.
+    """
+    if user_filter.by_name is None and user_filter.by_country is None and user_filter.status is None:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                            detail="At least one filter criterion is required")
+    async with user_repository as repo:
+        updated = await repo.update_where(user_filter, changes)
+    return {"updated": updated}
+
+
+@app.delete("/user/{email}", status_code=HTTP_204_NO_CONTENT, dependencies=[Depends(admit(WRITE))])
+async def delete(email: str,
+                 user_repository: UserRepository = Depends(create_write_user_repository)):
+    """
+    Deletes a user by email.
+
+    :param email: Email of the user.
+    :param user_repository: Dependency injection for the user repository.
+    :return: An empty response or raises an HTTP 404 if not found.
+    """
+    async with user_repository as repo:
+        deleted = await repo.delete(email)
+    if not deleted:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User not found")
+    return Response(status_code=HTTP_204_NO_CONTENT)
+
+
+@app.post("/delete-jobs", response_model=DeleteJobStatus, status_code=HTTP_202_ACCEPTED,
+          dependencies=[Depends(admit(WRITE))])
+async def start_delete_job(request: DeleteJobRequest):
+    """
+    Starts deleting every user matching the filter in the background.
+
+    Users are deleted in id-ordered batches of batch_size, each in its own
+    transaction, with a pause between batches.
+
+    :param request: The filter, at least one criterion is required, and the batching settings.
+    :return: The status of the job.
+    """
+    user_filter = request.user_filter
+    if user_filter.by_name is None and user_filter.by_country is None and user_filter.status is None:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                            detail="At least one filter criterion is required")
+    return delete_jobs.start(request)
+
+
+@app.get("/delete-jobs/{job_id}", response_model=DeleteJobStatus,
+         dependencies=[Depends(admit(READ))])
+async def get_delete_job(job_id: str):
+    """
+    Reports the progress of a delete job.
+
+    :param job_id: Identifier returned when the job was started.
+    :return: The status of the job or raises an HTTP 404 if unknown.
+    """
+    status = delete_jobs.get(job_id)
+    if not status:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Delete job not found")
+    return status
+
 
+@app.post("/users/batch", response_model=List[User], dependencies=[Depends(admit(READ))])
+async def get_batch(request: Request, email_batch: EmailBatch,
+                    user_repository: UserRepository = Depends(create_read_user_repository)):
+    """
+    Retrieves the users with any of the given emails in one query.
+
+    The users are returned as JSON, MessagePack or an Arrow IPC stream,
+    negotiated from the Accept header like /find.
+
+    :param request: The incoming request, read for Accept.
+    :param email_batch: The emails to resolve, at most MAX_BATCH_EMAILS.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The users found; emails without a user are left out.
+    """
+    async with user_repository as repo:
+        users = await repo.get_many_by_email(email_batch.emails)
+    return await user_list_response(users, media_type=negotiate(request.headers.get("accept")))
 
-@app.get("/find", response_model=List[User])
-async def find(user_filter: UserFilter = Depends(),
-               user_repository: UserRepository = Depends(create_user_repository)):
+
+@app.get("/find", response_model=List[User], dependencies=[Depends(admit(READ))])
+async def find(request: Request, user_filter: UserFilter = Depends(), count: bool = False,
+               user_repository: UserRepository = Depends(create_read_user_repository)):
     """
     Retrieves a list of users based on the filter criteria.
 
+    The response carries an ETag built from the generation of the user
+    collection, read before the rows. When the If-None-Match header already
+    holds it, a 304 is returned without querying the rows.
+
+    With count=true, the number of users matching the filter, whatever the
+    limit, is returned in X-Total-Count, and X-Total-Count-Exact says whether
+    it is exact or estimated. An exact count is only attempted when the query
+    is cheap, and for at most COUNT_BUDGET_MS. Use limit=0 to get the count
+    alone.
+
+    The users are returned as JSON by default. An Accept header naming
+    application/msgpack returns a MessagePack array of the same user maps,
+    and application/vnd.apache.arrow.stream an Arrow IPC stream with one
+    column per field.
+
+    With FIND_CACHE_BYTES set, results are cached per process without the
+    database being queried at all, not even for the generation: the ETag of
+    a cached result is the generation read before it, which still describes
+    its rows since no change they could be affected by was heard.
+
+    :param request: The incoming request, read for If-None-Match and Accept.
     :param user_filter: Filter criteria for finding users.
+    :param count: Whether to return the number of matching users in the headers.
     :param user_repository: Dependency injection for the user repository.
-    :return: A list of users matching the filter criteria.
+    :return: A list of users matching the filter criteria, or a 304 response.
     """
+    media_type = negotiate(request.headers.get("accept"))
+    cacheable = (FIND_CACHE_BYTES and not count and user_filter.limit != 0
+                 and await invalidation_bus.start())
+    if cacheable:
+        cached = find_cache.get(user_filter)
+        if cached is not None:
+            users, generation = cached
+            etag = make_etag("g", generation)
+            if etag_matches(request.headers.get("if-none-match"), etag):
+                return not_modified(etag)
+            return await user_list_response(users, headers={"ETag": etag}, media_type=media_type)
     async with user_repository as repo:
-        return await repo.get(user_filter)
+        # Taken before the generation: a query shared under it may have started before this request.
+        token = find_cache.token()
+        generation = await repo.get_generation()
+        etag = make_etag("g", generation)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+        headers = {"ETag": etag}
+        if count:
+            total = await repo.count(user_filter, COUNT_BUDGET_MS / 1000)
+            headers.update({"X-Total-Count": str(total.count),
+                            "X-Total-Count-Exact": "true" if total.exact else "false"})
+        users = await repo.get(user_filter) if user_filter.limit != 0 else []
+    if cacheable:
+        find_cache.fill(user_filter, users, generation, token)
+    return await user_list_response(users, headers=headers, media_type=media_type)
+
+
+@app.get("/export", dependencies=[Depends(admit(READ))])
+async def export(export_format: str = Query("csv", alias="format", pattern="^(csv|parquet)$"),
+                 columns: str = ",".join(DEFAULT_COLUMNS), user_filter: UserFilter = Depends(),
+                 repository_factory=Depends(get_user_repository_factory)):
+    """
+    Streams the users matching the filter criteria as CSV or Parquet.
+
+    Rows are read through a server-side cursor and encoded chunk by chunk,
+    so memory use does not grow with the size of the export. Admission holds
+    a read slot until the response starts, not while it streams.
+
+    :param export_format: "csv" or "parquet".
+    :param columns: Comma-separated columns among id, email, name, country, status and version.
+    :param user_filter: Filter criteria, applied by the database.
+    :param repository_factory: Opens the repository read while the response streams.
+    :return: The streamed export.
+    """
+    try:
+        column_names = parse_columns(columns)
+    except ValueError as error:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(error)) from error
+    return StreamingResponse(
+        export_users(repository_factory, user_filter, column_names, export_format),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="users.{export_format}"'})
+
+
+@app.get("/changes", response_model=UserChanges, dependencies=[Depends(admit(READ))])
+async def list_changes(since: Optional[str] = None,
+                       limit: int = Query(CHANGES_PAGE_SIZE, ge=1, le=CHANGES_PAGE_SIZE),
+                       user_repository: UserRepository = Depends(create_read_user_repository)):
+    """
+    Retrieves the users created or updated after a cursor, in the order they were written.
+
+    Start without since, then pass the cursor of each page as since to get the
+    next one. When more is false, the consumer is up to date and can poll
+    again later with the same cursor. Deleted users are not reported.
+
+    :param since: The cursor returned with the previous page.
+    :param limit: Maximum number of changes, at most CHANGES_PAGE_SIZE.
+    :param user_repository: Dependency injection for the user repository.
+    :return: The changes and the cursor of the next page, or raises an HTTP 400 for a malformed cursor.
+    """
+    async with user_repository as repo:
+        try:
+            return await repo.get_changes(since, limit)
+        except ValueError as error:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(error)) from error
+
+
+@app.get("/changes/stream")
+async def changes_stream():
+    """
+    Streams the users created, updated or deleted from now on as server-sent events.
+
+    Each event is named insert, update or delete, has the user's version as
+    id and the email, name, country, status and version of the user as data;
+    a delete carries the values the user had. A truncate event, without id,
+    means every user was removed. A reset event means changes may have been
+    missed: the feed lost its database connection, or a single statement
+    wrote too many rows to announce them one by one. A client that falls more
+    than CHANGE_QUEUE_SIZE events behind is sent an overflow event and
+    disconnected.
+
+    :return: The event stream, or raises an HTTP 503 if the database cannot be listened to.
+    """
+    try:
+        subscription = await change_feed.subscribe()
+    except ChangeFeedUnavailable as error:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=str(error)) from error
+    return StreamingResponse(stream_changes(change_feed, subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -7,6 +7,8 @@ from sqlalchemy import create_engine
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 from user_repository import SQL_BASE
+# Declares create_ticket on SQL_BASE.
+import tickets  # noqa: F401  pylint: disable=unused-import
 
 config = context.config
 
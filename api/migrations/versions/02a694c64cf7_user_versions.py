@@ -0,0 +1,68 @@
+"""user versions and table generation
+
+Revision ID: 02a694c64cf7
+Revises: 1feb50653430
+Create Date: 2026-10-19 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '02a694c64cf7'
+down_revision = '1feb50653430'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE SEQUENCE user_version_seq")
+    op.add_column('user_table', sa.Column('version', sa.BigInteger(), server_default='0', nullable=False))
+    op.execute("UPDATE user_table SET version = nextval('user_version_seq')")
+    op.create_table('user_table_generation',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('generation', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("INSERT INTO user_table_generation (id, generation) VALUES (1, 1)")
+
+    # Every written row gets a fresh value from a sequence, so a version is
+    # never reused, even when an email is deleted and created again.
+    op.execute("""
+        CREATE FUNCTION user_table_stamp_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('user_version_seq');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_version BEFORE INSERT OR UPDATE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_stamp_version()
+    """)
+    # The generation is bumped inside the writing transaction, so it becomes
+    # visible together with the rows it describes, whichever process wrote them.
+    op.execute("""
+        CREATE FUNCTION user_table_bump_generation() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_table_generation (id, generation) VALUES (1, 1)
+            ON CONFLICT (id) DO UPDATE SET generation = user_table_generation.generation + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_generation AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON user_table
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_bump_generation()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER user_table_generation ON user_table")
+    op.execute("DROP FUNCTION user_table_bump_generation()")
+    op.execute("DROP TRIGGER user_table_version ON user_table")
+    op.execute("DROP FUNCTION user_table_stamp_version()")
+    op.drop_table('user_table_generation')
+    op.drop_column('user_table', 'version')
+    op.execute("DROP SEQUENCE user_version_seq")
@@ -0,0 +1,37 @@
+"""create tickets
+
+Adds create_ticket, the outcome of every user created from the /create/
+spool: created, or duplicate when the email was already taken. It is
+written in the transaction creating the users, so a spooled batch replayed
+after a crash keeps the outcome it had and is not created twice.
+
+Revision ID: 3b9d7e2f8a61
+Revises: 6f1e0b7a2c94
+Create Date: 2026-10-19 19:02:11.904371
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d7e2f8a61'
+down_revision = '6f1e0b7a2c94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'create_ticket',
+        sa.Column('ticket', sa.String(length=64), primary_key=True),
+        sa.Column('email', sa.String(length=128), nullable=False),
+        sa.Column('outcome', sa.String(length=16), nullable=False),
+        sa.Column('resolved_at', sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.text('now()')),
+    )
+    op.create_index('create_ticket_resolved_at', 'create_ticket', ['resolved_at'])
+
+
+def downgrade() -> None:
+    op.drop_table('create_ticket')
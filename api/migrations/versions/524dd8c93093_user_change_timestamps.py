@@ -0,0 +1,70 @@
+"""user change timestamps and cursor
+
+Adds created_at and updated_at to user_table, and change_xid, the id of the
+transaction that last wrote the row. The version trigger now also stamps
+updated_at and change_xid, and the user_table_change_cursor index on
+(change_xid, version) serves the pages of /changes. Users already in the
+table get the time of the upgrade as created_at and come first in the feed.
+
+Revision ID: 524dd8c93093
+Revises: bccf2fb10c57
+Create Date: 2026-10-19 16:10:37.514892
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '524dd8c93093'
+down_revision = 'bccf2fb10c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Constant defaults only change the catalog, the rows are not rewritten.
+    op.execute("""
+        ALTER TABLE user_table
+            ADD COLUMN created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            ADD COLUMN updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            ADD COLUMN change_xid BIGINT NOT NULL DEFAULT 0
+    """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_stamp_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('user_version_seq');
+            NEW.updated_at := now();
+            NEW.change_xid := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    # Built without blocking writes to user_table. An index cannot be built concurrently on a
+    # partitioned table, so each partition gets its own, attached to one on the parent alone.
+    with op.get_context().autocommit_block():
+        partitions = op.get_bind().execute(sa.text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits "
+            "WHERE inhparent = 'user_table'::regclass ORDER BY 1")).scalars().all()
+        if not partitions:
+            op.execute("CREATE INDEX CONCURRENTLY user_table_change_cursor ON user_table (change_xid, version)")
+        else:
+            op.execute("CREATE INDEX user_table_change_cursor ON ONLY user_table (change_xid, version)")
+            for number, partition in enumerate(partitions):
+                op.execute(f"CREATE INDEX CONCURRENTLY user_table_change_cursor_{number} "
+                           f"ON {partition} (change_xid, version)")
+                op.execute(f"ALTER INDEX user_table_change_cursor "
+                           f"ATTACH PARTITION user_table_change_cursor_{number}")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX user_table_change_cursor")
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_stamp_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('user_version_seq');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("ALTER TABLE user_table DROP COLUMN created_at, DROP COLUMN updated_at, DROP COLUMN change_xid")
@@ -0,0 +1,62 @@
+"""user update old values
+
+Updates announced on the user_changes channel also carry the name, country
+and status the row had before, under old, so that caches of query results
+can tell which results the row leaves as well as which it joins. Inserts
+and deletes carry a null old.
+
+Revision ID: 6f1e0b7a2c94
+Revises: d53c4e9f5138
+Create Date: 2026-10-19 18:21:40.118356
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1e0b7a2c94'
+down_revision = 'd53c4e9f5138'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_notify_change() RETURNS trigger AS $$
+        DECLARE
+            changed user_table%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                PERFORM pg_notify('user_changes', '{"op" : "truncate"}');
+                RETURN NULL;
+            END IF;
+            changed := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+            PERFORM pg_notify('user_changes', json_build_object(
+                'op', lower(TG_OP), 'email', changed.email, 'name', changed.name,
+                'country', changed.country, 'status', changed.status, 'version', changed.version,
+                'old', CASE WHEN TG_OP = 'UPDATE' THEN json_build_object(
+                    'name', OLD.name, 'country', OLD.country, 'status', OLD.status) END)::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def downgrade() -> None:
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_notify_change() RETURNS trigger AS $$
+        DECLARE
+            changed user_table%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                PERFORM pg_notify('user_changes', '{"op" : "truncate"}');
+                RETURN NULL;
+            END IF;
+            changed := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+            PERFORM pg_notify('user_changes', json_build_object(
+                'op', lower(TG_OP), 'email', changed.email, 'name', changed.name,
+                'country', changed.country, 'status', changed.status, 'version', changed.version)::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
@@ -0,0 +1,80 @@
+"""dictionary encoded status and country
+
+Turns the status and country columns of user_table into the user_status and
+user_country enums, seeded with the values already in the table. It stops
+before changing anything if a value is longer than an enum label can be. With
+the country layout, country is the partition key and cannot change type, so the
+table is rebuilt with the same partitions instead.
+
+Revision ID: 880720e0bd5e
+Revises: a6e8570b36e3
+Create Date: 2026-10-19 14:21:06.774213
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+from labels import ENUM_TYPES, MAX_LABEL_BYTES, enum_type_ddl
+from partitioning import COUNTRY, TEXT_TYPES, drop_email_guard_ddl, rebuild_ddl
+
+
+# revision identifiers, used by Alembic.
+revision = '880720e0bd5e'
+down_revision = 'a6e8570b36e3'
+branch_labels = None
+depends_on = None
+
+
+def partition_countries():
+    """
+    Return the countries with a partition of their own, or None if user_table is not partitioned by country.
+    """
+    bind = op.get_bind()
+    strategy = bind.execute(sa.text(
+        "SELECT partstrat FROM pg_partitioned_table WHERE partrelid = 'user_table'::regclass")).scalar()
+    if strategy != "l":
+        return None
+    bounds = bind.execute(sa.text("""
+        SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'user_table'::regclass ORDER BY c.relname
+    """)).scalars().all()
+    return [match.group(1).replace("''", "'")
+            for bound in bounds for match in [re.search(r"IN \('(.*)'\)", bound)] if match]
+
+
+def change_types(types) -> None:
+    """
+    Give the status and country columns the given types, keeping their values.
+    """
+    countries = partition_countries()
+    if countries is not None:
+        for statement in drop_email_guard_ddl() + rebuild_ddl(COUNTRY, countries=countries, types=types):
+            op.execute(statement)
+        return
+    for column, column_type in types.items():
+        op.execute(f"ALTER TABLE user_table ALTER COLUMN {column} TYPE {column_type} "
+                   f"USING {column}::{column_type}")
+
+
+def upgrade() -> None:
+    # Countries given a partition must be labels even when no user has them yet.
+    partitioned = {"status": [], "country": partition_countries() or []}
+    labels = {column: set(partitioned[column]) | set(op.get_bind().execute(sa.text(
+        f"SELECT DISTINCT {column} FROM user_table WHERE {column} IS NOT NULL")).scalars())
+        for column in ENUM_TYPES}
+    too_long = sorted(f"{column}={label!r}" for column, values in labels.items()
+                      for label in values if len(label.encode("utf-8")) > MAX_LABEL_BYTES)
+    if too_long:
+        raise RuntimeError(f"Values longer than {MAX_LABEL_BYTES} bytes cannot become enum labels, "
+                           f"shorten them first: {', '.join(too_long)}")
+    for column in ENUM_TYPES:
+        op.execute(enum_type_ddl(column, sorted(labels[column])))
+    change_types(ENUM_TYPES)
+
+
+def downgrade() -> None:
+    change_types(TEXT_TYPES)
+    for type_name in ENUM_TYPES.values():
+        op.execute(f"DROP TYPE {type_name}")
@@ -0,0 +1,57 @@
+"""striped table generation
+
+Every writing statement used to bump the single row of user_table_generation
+and hold its lock until commit, which queued all writers behind each other
+and let multi-statement writers deadlock. Each backend now bumps the row of
+its own stripe, pg_backend_pid() % 256, so a transaction only ever locks one
+row and writers only wait for each other when their backends share a stripe.
+The generation is the sum of the stripes: it is read in the reader's snapshot
+and grows with every committed write, like the single counter did.
+
+Revision ID: 9c41d7a2e5b3
+Revises: 3b9d7e2f8a61
+Create Date: 2026-10-19 21:40:17.526830
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41d7a2e5b3'
+down_revision = '3b9d7e2f8a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The existing row 1 keeps its count as part of stripe 1, so the
+    # generation carries on from where it was.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_bump_generation() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_table_generation (id, generation) VALUES (pg_backend_pid() % 256, 1)
+            ON CONFLICT (id) DO UPDATE SET generation = user_table_generation.generation + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def downgrade() -> None:
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_bump_generation() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_table_generation (id, generation) VALUES (1, 1)
+            ON CONFLICT (id) DO UPDATE SET generation = user_table_generation.generation + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    # Folding the stripes into row 1 keeps the generation from going back.
+    op.execute("LOCK TABLE user_table_generation IN EXCLUSIVE MODE")
+    op.execute("""
+        INSERT INTO user_table_generation (id, generation)
+        SELECT 1, coalesce(sum(generation), 0) + 1 FROM user_table_generation
+        ON CONFLICT (id) DO UPDATE SET generation = EXCLUDED.generation
+    """)
+    op.execute("DELETE FROM user_table_generation WHERE id <> 1")
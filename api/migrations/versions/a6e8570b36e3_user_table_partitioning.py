@@ -0,0 +1,60 @@
+"""user table partitioning
+
+Opt-in: the revision only changes the layout of user_table when a
+partitioned one is asked for, e.g.
+
+    alembic -x partitioning=hash -x partitions=16 upgrade head
+    alembic -x partitioning=country -x countries=France,Germany upgrade head
+
+Without -x partitioning, USER_TABLE_PARTITIONING is used. The country layout
+gives a partition to every country listed, or to every country found in the
+table, and keeps the others in a default partition. To change the layout of
+an upgraded database, downgrade this revision and upgrade it again.
+
+Revision ID: a6e8570b36e3
+Revises: 02a694c64cf7
+Create Date: 2026-10-19 10:04:27.552913
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+from partitioning import HASH_PARTITIONS, NONE, USER_TABLE_PARTITIONING, drop_email_guard_ddl, rebuild_ddl
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e8570b36e3'
+down_revision = '02a694c64cf7'
+branch_labels = None
+depends_on = None
+
+
+def rebuild(layout: str, partitions: int = HASH_PARTITIONS, countries=()) -> None:
+    """
+    Copy user_table into a new table of the given layout, keeping ids, versions and generation.
+    """
+    for statement in rebuild_ddl(layout, partitions, countries):
+        op.execute(statement)
+
+
+def upgrade() -> None:
+    arguments = context.get_x_argument(as_dictionary=True)
+    layout = arguments.get("partitioning", USER_TABLE_PARTITIONING)
+    if layout == NONE:
+        return
+    if "countries" in arguments:
+        countries = [country for country in arguments["countries"].split(",") if country]
+    else:
+        countries = op.get_bind().execute(sa.text(
+            "SELECT DISTINCT country FROM user_table WHERE country IS NOT NULL ORDER BY country")).scalars().all()
+    rebuild(layout, int(arguments.get("partitions", HASH_PARTITIONS)), countries)
+
+
+def downgrade() -> None:
+    partitioned = op.get_bind().execute(sa.text(
+        "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = 'user_table'::regclass")).scalar()
+    if not partitioned:
+        return
+    for statement in drop_email_guard_ddl():
+        op.execute(statement)
+    rebuild(NONE)
@@ -0,0 +1,42 @@
+"""user change notifications
+
+Every row inserted into or updated in user_table is announced on the
+user_changes channel with pg_notify. The notification is delivered when the
+writing transaction commits, to every session listening on the channel.
+
+Revision ID: bccf2fb10c57
+Revises: 880720e0bd5e
+Create Date: 2026-10-19 15:02:48.190377
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'bccf2fb10c57'
+down_revision = '880720e0bd5e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The password is left out: listeners only need what /find returns to tell what changed.
+    op.execute("""
+        CREATE FUNCTION user_table_notify_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('user_changes', json_build_object(
+                'op', lower(TG_OP), 'email', NEW.email, 'name', NEW.name,
+                'country', NEW.country, 'status', NEW.status, 'version', NEW.version)::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_changes AFTER INSERT OR UPDATE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_notify_change()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER user_table_changes ON user_table")
+    op.execute("DROP FUNCTION user_table_notify_change()")
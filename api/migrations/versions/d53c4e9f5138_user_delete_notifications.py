@@ -0,0 +1,67 @@
+"""user delete notifications
+
+Deleted rows are announced on the user_changes channel too, with the values
+they had, and a truncation of user_table is announced once with the
+truncate operation, so processes caching users hear about every write.
+
+Revision ID: d53c4e9f5138
+Revises: 524dd8c93093
+Create Date: 2026-10-19 17:05:12.640221
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd53c4e9f5138'
+down_revision = '524dd8c93093'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_notify_change() RETURNS trigger AS $$
+        DECLARE
+            changed user_table%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                PERFORM pg_notify('user_changes', '{"op" : "truncate"}');
+                RETURN NULL;
+            END IF;
+            changed := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+            PERFORM pg_notify('user_changes', json_build_object(
+                'op', lower(TG_OP), 'email', changed.email, 'name', changed.name,
+                'country', changed.country, 'status', changed.status, 'version', changed.version)::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("DROP TRIGGER user_table_changes ON user_table")
+    op.execute("""
+        CREATE TRIGGER user_table_changes AFTER INSERT OR UPDATE OR DELETE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_notify_change()
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_changes_truncate AFTER TRUNCATE ON user_table
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_notify_change()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER user_table_changes_truncate ON user_table")
+    op.execute("DROP TRIGGER user_table_changes ON user_table")
+    op.execute("""
+        CREATE OR REPLACE FUNCTION user_table_notify_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('user_changes', json_build_object(
+                'op', lower(TG_OP), 'email', NEW.email, 'name', NEW.name,
+                'country', NEW.country, 'status', NEW.status, 'version', NEW.version)::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_changes AFTER INSERT OR UPDATE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_notify_change()
+    """)
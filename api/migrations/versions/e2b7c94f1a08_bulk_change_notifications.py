@@ -0,0 +1,91 @@
+"""bulk change notifications
+
+Changes are announced once per statement instead of once per row, from the
+transition tables of the statement. A statement writing more than
+NOTIFY_MAX_ROWS rows, such as a PATCH /users or a delete job, sends a single
+reset notification with the number of rows instead of one per row: the
+listeners drop what they cached, as after a lost connection, rather than
+going through every row.
+
+Revision ID: e2b7c94f1a08
+Revises: 9c41d7a2e5b3
+Create Date: 2026-10-19 22:31:05.417962
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7c94f1a08'
+down_revision = '9c41d7a2e5b3'
+branch_labels = None
+depends_on = None
+
+# The default CHANGE_QUEUE_SIZE: a subscriber would be disconnected for
+# falling behind on more events anyway.
+NOTIFY_MAX_ROWS = 1000
+
+
+def upgrade() -> None:
+    op.execute(f"""
+        CREATE FUNCTION user_table_notify_changes() RETURNS trigger AS $$
+        DECLARE
+            written BIGINT;
+        BEGIN
+            -- Each transition table only exists for the events that have it.
+            IF TG_OP = 'DELETE' THEN
+                SELECT count(*) INTO written FROM old_rows;
+            ELSE
+                SELECT count(*) INTO written FROM new_rows;
+            END IF;
+            IF written > {NOTIFY_MAX_ROWS} THEN
+                PERFORM pg_notify('user_changes', json_build_object(
+                    'op', 'reset', 'statement', lower(TG_OP), 'rows', written)::text);
+            ELSIF TG_OP = 'UPDATE' THEN
+                PERFORM pg_notify('user_changes', json_build_object(
+                    'op', 'update', 'email', n.email, 'name', n.name, 'country', n.country,
+                    'status', n.status, 'version', n.version, 'old', json_build_object(
+                        'name', o.name, 'country', o.country, 'status', o.status))::text)
+                FROM new_rows n JOIN old_rows o ON o.id = n.id ORDER BY n.version;
+            ELSIF TG_OP = 'INSERT' THEN
+                PERFORM pg_notify('user_changes', json_build_object(
+                    'op', 'insert', 'email', n.email, 'name', n.name, 'country', n.country,
+                    'status', n.status, 'version', n.version, 'old', NULL)::text)
+                FROM new_rows n ORDER BY n.version;
+            ELSE
+                PERFORM pg_notify('user_changes', json_build_object(
+                    'op', 'delete', 'email', o.email, 'name', o.name, 'country', o.country,
+                    'status', o.status, 'version', o.version, 'old', NULL)::text)
+                FROM old_rows o ORDER BY o.version;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("DROP TRIGGER user_table_changes ON user_table")
+    op.execute("""
+        CREATE TRIGGER user_table_changes_insert AFTER INSERT ON user_table
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_notify_changes()
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_changes_update AFTER UPDATE ON user_table
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_notify_changes()
+    """)
+    op.execute("""
+        CREATE TRIGGER user_table_changes_delete AFTER DELETE ON user_table
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_notify_changes()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER user_table_changes_delete ON user_table")
+    op.execute("DROP TRIGGER user_table_changes_update ON user_table")
+    op.execute("DROP TRIGGER user_table_changes_insert ON user_table")
+    op.execute("DROP FUNCTION user_table_notify_changes()")
+    op.execute("""
+        CREATE TRIGGER user_table_changes AFTER INSERT OR UPDATE OR DELETE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_notify_change()
+    """)
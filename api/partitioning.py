@@ -0,0 +1,245 @@
+"""
+Layouts of user_table: one heap table, or a partitioned table.
+
+- "none": a single table, the default.
+- "hash": hash partitions on email. Email stays globally unique and lookups
+  by email read a single partition.
+- "country": one list partition per country plus a default partition.
+  Filters on country read a single partition. PostgreSQL only allows unique
+  constraints that contain the partition key, so the global uniqueness of
+  email is enforced by the user_table_email guard table instead.
+
+The layout is chosen when the user_table_partitioning revision is applied,
+e.g. ``alembic -x partitioning=country upgrade head``, and the API processes
+must run with the same USER_TABLE_PARTITIONING value.
+"""
+import os
+from typing import List, Mapping, Optional, Sequence
+
+NONE = "none"
+HASH = "hash"
+COUNTRY = "country"
+LAYOUTS = (NONE, HASH, COUNTRY)
+
+USER_TABLE_PARTITIONING = os.getenv("USER_TABLE_PARTITIONING", NONE)
+HASH_PARTITIONS = 8
+
+COLUMNS = ("id", "email", "password", "name", "status", "country", "version")
+# Types of the status and country columns before they were dictionary encoded.
+TEXT_TYPES = {"status": "VARCHAR", "country": "VARCHAR(128)"}
+
+
+def table_ddl(layout: str, id_sequence: str, partitions: int = HASH_PARTITIONS,
+              countries: Sequence[str] = (),
+              types: Optional[Mapping[str, str]] = None) -> List[str]:
+    """
+    Build the statements creating user_table and its partitions, without constraints.
+
+    Constraints are created by constraint_ddl once the rows are copied.
+
+    Args:
+        layout (str): One of LAYOUTS.
+        id_sequence (str): The sequence the ids are taken from.
+        partitions (int): Number of hash partitions.
+        countries (Sequence[str]): Countries given a partition of their own.
+        types (Optional[Mapping[str, str]]): Types of the status and country
+            columns, TEXT_TYPES by default.
+
+    Returns:
+        List[str]: The statements, in order.
+
+    Raises:
+        ValueError: If the layout is unknown.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown user_table layout {layout!r}, "
+                         f"expected one of {', '.join(LAYOUTS)}")
+    if types is None:
+        types = TEXT_TYPES
+    # Partition keys must be NOT NULL to be part of the primary key.
+    country = f"{types['country']} NOT NULL" if layout == COUNTRY else types["country"]
+    partition_by = {NONE: "", HASH: " PARTITION BY HASH (email)",
+                    COUNTRY: " PARTITION BY LIST (country)"}
+    statements = [f"""
+        CREATE TABLE user_table (
+            id INTEGER NOT NULL DEFAULT nextval('{id_sequence}'),
+            email VARCHAR(128) NOT NULL,
+            password VARCHAR(128) NOT NULL,
+            name VARCHAR(128),
+            status {types['status']},
+            country {country},
+            version BIGINT NOT NULL DEFAULT 0
+        ){partition_by[layout]}
+    """]
+    if layout == HASH:
+        statements.extend(f"CREATE TABLE user_table_p{remainder} PARTITION OF user_table "
+                          f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+                          for remainder in range(partitions))
+    elif layout == COUNTRY:
+        statements.extend(f"CREATE TABLE user_table_c{index} PARTITION OF user_table "
+                          f"FOR VALUES IN ({quote(name)})"
+                          for index, name in enumerate(countries))
+        statements.append("CREATE TABLE user_table_default PARTITION OF user_table DEFAULT")
+    return statements
+
+
+def constraint_ddl(layout: str) -> List[str]:
+    """
+    Build the statements creating the keys of user_table.
+
+    On a partitioned table they are created on every partition.
+
+    Args:
+        layout (str): One of LAYOUTS.
+
+    Returns:
+        List[str]: The statements, in order.
+    """
+    if layout == NONE:
+        return ["ALTER TABLE user_table ADD CONSTRAINT user_table_pkey PRIMARY KEY (id)",
+                "ALTER TABLE user_table ADD CONSTRAINT user_table_email_key UNIQUE (email)"]
+    if layout == HASH:
+        return ["ALTER TABLE user_table ADD CONSTRAINT user_table_pkey PRIMARY KEY (id, email)",
+                "ALTER TABLE user_table ADD CONSTRAINT user_table_email_key UNIQUE (email)"]
+    return ["ALTER TABLE user_table ADD CONSTRAINT user_table_pkey PRIMARY KEY (id, country)",
+            "ALTER TABLE user_table ADD CONSTRAINT user_table_email_key UNIQUE (email, country)"]
+
+
+def email_guard_ddl() -> List[str]:
+    """
+    Build the statements keeping emails unique across the country partitions.
+
+    Every insert into user_table inserts its email into user_table_email, so a
+    second user with the same email fails with a unique violation whatever its
+    country. A user moved to another country is deleted and inserted again,
+    which keeps its guard row.
+
+    Returns:
+        List[str]: The statements, in order.
+    """
+    return [
+        "CREATE TABLE user_table_email (email VARCHAR(128) PRIMARY KEY)",
+        "INSERT INTO user_table_email (email) SELECT email FROM user_table",
+        """
+        CREATE FUNCTION user_table_guard_email() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_table_email (email) VALUES (NEW.email);
+            ELSIF TG_OP = 'DELETE' THEN
+                DELETE FROM user_table_email WHERE email = OLD.email;
+            ELSE
+                TRUNCATE user_table_email;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER user_table_email AFTER INSERT OR DELETE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_guard_email()
+        """,
+        """
+        CREATE TRIGGER user_table_email_truncate AFTER TRUNCATE ON user_table
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_guard_email()
+        """,
+    ]
+
+
+def drop_email_guard_ddl() -> List[str]:
+    """
+    Build the statements removing the user_table_email guard.
+
+    Returns:
+        List[str]: The statements, in order.
+    """
+    return ["DROP TRIGGER IF EXISTS user_table_email ON user_table",
+            "DROP TRIGGER IF EXISTS user_table_email_truncate ON user_table",
+            "DROP FUNCTION IF EXISTS user_table_guard_email()",
+            "DROP TABLE IF EXISTS user_table_email"]
+
+
+def rebuild_ddl(layout: str, partitions: int = HASH_PARTITIONS, countries: Sequence[str] = (),
+                types: Optional[Mapping[str, str]] = None) -> List[str]:
+    """
+    Build the statements copying user_table into a new table of the given layout.
+
+    Ids, versions and the generation are kept, and the version and generation
+    triggers are recreated, as well as every other trigger of the table, such
+    as the change notifications. The email guard of the country layout must
+    have been dropped beforehand.
+
+    Args:
+        layout (str): One of LAYOUTS.
+        partitions (int): Number of hash partitions.
+        countries (Sequence[str]): Countries given a partition of their own.
+        types (Optional[Mapping[str, str]]): Types of the status and country
+            columns, TEXT_TYPES by default.
+
+    Returns:
+        List[str]: The statements, in order.
+    """
+    if types is None:
+        types = TEXT_TYPES
+    columns = ", ".join(COLUMNS)
+    selected = ", ".join(f"{column}::{types[column]}" if column in types else column
+                         for column in COLUMNS)
+    statements = ["DROP TRIGGER user_table_generation ON user_table",
+                  "DROP TRIGGER user_table_version ON user_table",
+                  "ALTER TABLE user_table RENAME TO user_table_old",
+                  # The partitions of the old table keep their names, which the new ones may need.
+                  """
+                  DO $$
+                  DECLARE
+                      partition TEXT;
+                  BEGIN
+                      FOR partition IN SELECT inhrelid::regclass::text FROM pg_inherits
+                                       WHERE inhparent = 'user_table_old'::regclass LOOP
+                          EXECUTE format('ALTER TABLE %I RENAME TO %I', partition, partition || '_old');
+                      END LOOP;
+                  END
+                  $$
+                  """,
+                  "ALTER SEQUENCE user_table_id_seq OWNED BY NONE"]
+    statements.extend(table_ddl(layout, "user_table_id_seq", partitions, countries, types))
+    statements.append(f"INSERT INTO user_table ({columns}) SELECT {selected} FROM user_table_old")
+    # The triggers added by later revisions, such as the change notifications, are copied as they
+    # are once the rows are in, so copying the rows does not announce them.
+    statements.append("""
+        DO $$
+        DECLARE
+            definition TEXT;
+        BEGIN
+            FOR definition IN SELECT pg_get_triggerdef(oid) FROM pg_trigger
+                              WHERE tgrelid = 'user_table_old'::regclass AND NOT tgisinternal LOOP
+                EXECUTE regexp_replace(definition, ' ON \\S+ ', ' ON user_table ');
+            END LOOP;
+        END
+        $$
+    """)
+    statements.append("DROP TABLE user_table_old")
+    statements.extend(constraint_ddl(layout))
+    statements.append("ALTER SEQUENCE user_table_id_seq OWNED BY user_table.id")
+    if layout == COUNTRY:
+        statements.extend(email_guard_ddl())
+    statements.append("""
+        CREATE TRIGGER user_table_version BEFORE INSERT OR UPDATE ON user_table
+        FOR EACH ROW EXECUTE FUNCTION user_table_stamp_version()
+    """)
+    statements.append("""
+        CREATE TRIGGER user_table_generation AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON user_table
+        FOR EACH STATEMENT EXECUTE FUNCTION user_table_bump_generation()
+    """)
+    return statements
+
+
+def quote(value: str) -> str:
+    """
+    Quote a string as a SQL literal.
+
+    Args:
+        value (str): The string.
+
+    Returns:
+        str: The literal.
+    """
+    return "'" + value.replace("'", "''") + "'"
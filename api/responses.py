@@ -0,0 +1,185 @@
+import os
+from typing import Any, List, Optional
+
+import msgpack
+import orjson
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from user_repository import User
+
+LARGE_PAYLOAD_ROWS = int(os.getenv("LARGE_PAYLOAD_ROWS", "2000"))
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+# Media types a list of users can be returned as, with the aliases clients send for them.
+LIST_MEDIA_TYPES = {JSON: JSON, MSGPACK: MSGPACK, "application/x-msgpack": MSGPACK,
+                    ARROW: ARROW, "*/*": JSON, "application/*": JSON}
+USER_FIELDS = tuple(User.model_fields)
+
+
+class UnsupportedMediaType(ValueError):
+    """
+    Raised when a request body is in a format that cannot be parsed.
+    """
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """
+    Choose the media type of a list of users from an Accept header.
+
+    The supported type with the highest quality wins, the first listed on a
+    tie. JSON is returned when the header is missing or names nothing
+    supported.
+
+    Args:
+        accept (Optional[str]): The Accept request header.
+
+    Returns:
+        str: JSON, MSGPACK or ARROW.
+    """
+    best, best_quality = JSON, 0.0
+    for item in (accept or "").split(","):
+        media_range, *parameters = item.split(";")
+        media_type = LIST_MEDIA_TYPES.get(media_range.strip().lower())
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > best_quality:
+            best, best_quality = media_type, quality
+    return best
+
+
+def encode_user(user: User) -> bytes:
+    """
+    Serialize a single user to JSON bytes.
+
+    Args:
+        user (User): The user to serialize.
+
+    Returns:
+        bytes: The JSON document.
+    """
+    return orjson.dumps(user.__dict__)
+
+
+def encode_users(users: List[User], media_type: str = JSON) -> bytes:
+    """
+    Serialize a list of users.
+
+    Users coming from the repository are already valid, so their field
+    dictionaries are handed to the encoder as they are instead of being
+    validated and encoded again against the response model.
+
+    Args:
+        users (List[User]): The users to serialize.
+        media_type (str): JSON, MSGPACK or ARROW.
+
+    Returns:
+        bytes: A JSON or MessagePack array of user maps, or an Arrow IPC
+            stream holding one record batch with a column per field.
+    """
+    if media_type == MSGPACK:
+        return msgpack.packb([user.__dict__ for user in users])
+    if media_type == ARROW:
+        return _encode_arrow(users)
+    return orjson.dumps([user.__dict__ for user in users])
+
+
+def _encode_arrow(users: List[User]) -> bytes:
+    """
+    Serialize a list of users as an Arrow IPC stream.
+
+    Args:
+        users (List[User]): The users to serialize.
+
+    Returns:
+        bytes: The stream, with one string column per field of User.
+    """
+    # pyarrow is only needed by Arrow responses, so it is not loaded at startup.
+    import pyarrow  # pylint: disable=import-outside-toplevel
+    import pyarrow.ipc  # pylint: disable=import-outside-toplevel
+
+    batch = pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array([user.__dict__[field] for user in users], type=pyarrow.string())
+         for field in USER_FIELDS], names=list(USER_FIELDS))
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def decode_body(body: bytes, content_type: Optional[str]) -> Any:
+    """
+    Parse a JSON or MessagePack request body.
+
+    Args:
+        body (bytes): The request body.
+        content_type (Optional[str]): The Content-Type request header; JSON when missing.
+
+    Returns:
+        Any: The decoded document.
+
+    Raises:
+        UnsupportedMediaType: If the content type is neither JSON nor MessagePack.
+        ValueError: If the body is malformed.
+    """
+    media_type = (content_type or JSON).split(";")[0].strip().lower()
+    if media_type in (MSGPACK, "application/x-msgpack"):
+        try:
+            return msgpack.unpackb(body)
+        except (msgpack.UnpackException, ValueError) as error:
+            raise ValueError(f"Malformed MessagePack body: {error}") from error
+    if media_type == JSON:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError as error:
+            raise ValueError(f"Malformed JSON body: {error}") from error
+    raise UnsupportedMediaType(f"Unsupported content type {media_type}, "
+                               f"expected {JSON} or {MSGPACK}")
+
+
+def user_response(user: User, headers: Optional[dict] = None) -> Response:
+    """
+    Build a JSON response for a single user.
+
+    Args:
+        user (User): The user to return.
+        headers (Optional[dict]): Extra response headers.
+
+    Returns:
+        Response: The encoded response, which varies with the Accept header
+            like the user list responses.
+    """
+    return Response(content=encode_user(user), media_type="application/json",
+                    headers={**(headers or {}), "Vary": "Accept"})
+
+
+async def user_list_response(users: List[User], headers: Optional[dict] = None,
+                             media_type: str = JSON) -> Response:
+    """
+    Build a response for a list of users.
+
+    Lists of at least LARGE_PAYLOAD_ROWS users are encoded in the thread pool
+    so that a big payload does not stall the event loop.
+
+    Args:
+        users (List[User]): The users to return.
+        headers (Optional[dict]): Extra response headers.
+        media_type (str): JSON, MSGPACK or ARROW, usually chosen by negotiate.
+
+    Returns:
+        Response: The encoded response, which varies with the Accept header.
+    """
+    if len(users) >= LARGE_PAYLOAD_ROWS:
+        content = await run_in_threadpool(encode_users, users, media_type)
+    else:
+        content = encode_users(users, media_type)
+    return Response(content=content, media_type=media_type,
+                    headers={**(headers or {}), "Vary": "Accept"})
@@ -0,0 +1,19 @@
+"""
+Production server.
+
+The image's prod target runs ``gunicorn main:app -c gunicorn.conf.py``: a
+gunicorn master supervising WEB_CONCURRENCY worker processes, each one
+serving the app with uvicorn on uvloop and httptools.
+"""
+from uvicorn.workers import UvicornWorker
+
+
+class Worker(UvicornWorker):
+    """
+    Uvicorn worker for gunicorn using uvloop and httptools.
+
+    On SIGTERM a worker stops accepting connections and finishes the
+    requests in flight before exiting; gunicorn kills it after
+    graceful_timeout seconds.
+    """
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools", "lifespan": "on"}
@@ -0,0 +1,794 @@
+"""
+Spread user_table over several PostgreSQL databases.
+
+Shards are configured with SHARD_DB_STRINGS, a comma-separated list of
+name=connection-string pairs, and every user lives on the shard its email is
+mapped to by a consistent hash ring of the shard names, so adding a shard
+only moves about 1/N of the users.
+
+To change the shards online:
+
+1. Restart the API with the new SHARD_DB_STRINGS and the old list in
+   SHARD_PREVIOUS_DB_STRINGS. Lookups fall back to the previous owner of an
+   email and writes go to its new owner.
+2. Run ``python -m sharding rebalance`` from the api directory to move the
+   users to their new shard.
+3. Restart the API without SHARD_PREVIOUS_DB_STRINGS.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+from datetime import datetime
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Row, delete, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from labels import label_cache
+from user_repository import (UPSERT_CONFLICT_COLUMNS, SQLUserRepository, User, UserChanges,
+                             UserCount, UserFilter, UserInDB, UserRepository, UserUpdate,
+                             get_engine, get_read_only_engine)
+
+logger = logging.getLogger(__name__)
+
+RING_REPLICAS = 100
+REBALANCE_BATCH_ROWS = 1000
+MOVED_COLUMNS = ("email", "password", "name", "status", "country")
+
+
+def parse_db_strings(value: str) -> Dict[str, str]:
+    """
+    Parse a comma-separated list of name=connection-string pairs.
+
+    Args:
+        value (str): The list, e.g. "a=postgresql+asyncpg://...,b=postgresql+asyncpg://...".
+
+    Returns:
+        Dict[str, str]: Connection strings keyed by shard name.
+
+    Raises:
+        ValueError: If a pair has no name.
+    """
+    shards = {}
+    for pair in filter(None, (pair.strip() for pair in value.split(","))):
+        name, separator, db_string = pair.partition("=")
+        if not separator or not name:
+            raise ValueError(f"Shard {pair!r} must be given as name=connection-string")
+        shards[name.strip()] = db_string.strip()
+    return shards
+
+
+def _hash(key: str) -> int:
+    """
+    Hash a key onto the ring.
+
+    Args:
+        key (str): The key.
+
+    Returns:
+        int: A 64-bit position, stable across processes.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping emails to shard names.
+
+    Every shard is placed on the ring at RING_REPLICAS pseudo-random points
+    and owns the keys that hash right before them, so a shard added or
+    removed only takes or gives back its own share of the keys.
+    """
+
+    def __init__(self, names: Iterable[str], replicas: int = RING_REPLICAS):
+        """
+        Place the shards on the ring.
+
+        Args:
+            names (Iterable[str]): The shard names.
+            replicas (int): Points per shard.
+        """
+        points = sorted((_hash(f"{name}#{replica}"), name)
+                        for name in names for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, key: str) -> str:
+        """
+        Find the shard owning a key.
+
+        Args:
+            key (str): The key, an email.
+
+        Returns:
+            str: The shard name.
+        """
+        return self._names[bisect.bisect(self._points, _hash(key)) % len(self._points)]
+
+
+class ShardedUserRepository(UserRepository):  # pylint: disable=too-many-public-methods
+    """
+    UserRepository spread over one repository per shard.
+
+    Operations on one email go to the shard owning it; the others run on
+    every shard in parallel and merge the results. While a rebalance is in
+    progress, lookups that miss on the new owner are retried on the previous
+    one, and users found on both are taken from the new owner.
+
+    Ids and versions are given by each shard, so they are only unique within
+    a shard.
+    """
+
+    def __init__(self, shards: Dict[str, UserRepository], ring: HashRing,
+                 previous_ring: Optional[HashRing] = None):
+        """
+        Initialize with the shard repositories.
+
+        Args:
+            shards (Dict[str, UserRepository]): Repositories keyed by shard name,
+                covering the shards of both rings.
+            ring (HashRing): Where users live, and are written.
+            previous_ring (Optional[HashRing]): Where users lived before the
+                rebalance in progress, if any.
+        """
+        self._shards = shards
+        self._names = sorted(shards)
+        self._ring = ring
+        self._previous_ring = previous_ring
+
+    async def __aenter__(self):
+        """
+        Enter the context of every shard repository.
+
+        Returns:
+            ShardedUserRepository: The repository instance.
+        """
+        for repository in self._shards.values():
+            await repository.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit the context of every shard repository.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        await asyncio.gather(*(repository.__aexit__(exc_type, exc_value, exc_traceback)
+                               for repository in self._shards.values()))
+
+    @property
+    def queries(self) -> int:
+        """
+        Number of queries run on every shard.
+        """
+        return sum(getattr(repository, "queries", 0) for repository in self._shards.values())
+
+    def _owner(self, email: str) -> UserRepository:
+        """
+        Find the repository owning an email.
+
+        Args:
+            email (str): The email.
+
+        Returns:
+            UserRepository: The repository of its shard.
+        """
+        return self._shards[self._ring.owner(email)]
+
+    def _previous_owner(self, email: str) -> Optional[UserRepository]:
+        """
+        Find the repository that owned an email before the rebalance in progress.
+
+        Args:
+            email (str): The email.
+
+        Returns:
+            Optional[UserRepository]: Its repository, or None when it did not change.
+        """
+        if self._previous_ring is None:
+            return None
+        previous = self._previous_ring.owner(email)
+        return None if previous == self._ring.owner(email) else self._shards[previous]
+
+    async def _each(self, method: str, *args) -> List[Any]:
+        """
+        Call a method on every shard in parallel.
+
+        Args:
+            method (str): The name of the UserRepository method.
+            *args: Its arguments.
+
+        Returns:
+            List[Any]: The results, in shard name order.
+        """
+        return await asyncio.gather(*(getattr(self._shards[name], method)(*args)
+                                      for name in self._names))
+
+    async def save(self, user: User) -> None:
+        """
+        Save a user on the shard where it lives, so a duplicate email is still rejected.
+
+        Args:
+            user (User): The user to save.
+        """
+        previous = self._previous_owner(user.email)
+        if previous is not None and await previous.get_version(user.email) is not None:
+            await previous.save(user)
+        else:
+            await self._owner(user.email).save(user)
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by email from its shard.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        versioned_user = await self.get_versioned_by_email(email)
+        return versioned_user[0] if versioned_user else None
+
+    async def get(self, user_filter: UserFilter) -> List[User]:
+        """
+        Query every shard in parallel and merge the users found.
+
+        Each shard returns at most limit users and the merged list is cut to
+        the limit again.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            List[User]: List of users matching the filter criteria.
+        """
+        users: Dict[str, User] = {}
+        for name, found in zip(self._names, await self._each("get", user_filter)):
+            for user in found:
+                if user.email not in users or self._ring.owner(user.email) == name:
+                    users[user.email] = user
+        return list(users.values())[:user_filter.limit]
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email from its shard.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        versioned_user = await self._owner(email).get_versioned_by_email(email)
+        previous = self._previous_owner(email)
+        if versioned_user is None and previous is not None:
+            versioned_user = await previous.get_versioned_by_email(email)
+        return versioned_user
+
+    async def get_version(self, email: str) -> Optional[int]:
+        """
+        Retrieve the version of a user from its shard.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            Optional[int]: The version, or None if the user does not exist.
+        """
+        version = await self._owner(email).get_version(email)
+        previous = self._previous_owner(email)
+        if version is None and previous is not None:
+            version = await previous.get_version(email)
+        return version
+
+    async def get_generation(self) -> int:
+        """
+        Add up the generations of the shards.
+
+        Every shard generation only grows, so their sum changes whenever any
+        shard is written.
+
+        Returns:
+            int: The current generation.
+        """
+        return sum(await self._each("get_generation"))
+
+    async def get_many_by_email(self, emails: List[str]) -> List[User]:
+        """
+        Retrieve the users with any of the given emails, one query per shard.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            List[User]: The users found, emails without a user are left out.
+        """
+        return [user for user, _ in (await self.get_many_versioned_by_email(emails)).values()]
+
+    async def get_many_versioned_by_email(self, emails: List[str]) -> Dict[str, Tuple[User, int]]:
+        """
+        Retrieve users and their versions, one query per shard in parallel.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            Dict[str, Tuple[User, int]]: The users found and their versions, keyed by email.
+        """
+        found = await self._gather_by_shard(emails, self._ring)
+        if self._previous_ring is not None:
+            missing = [email for email in emails if email not in found]
+            found.update(await self._gather_by_shard(missing, self._previous_ring))
+        return found
+
+    async def _gather_by_shard(self, emails: List[str],
+                               ring: HashRing) -> Dict[str, Tuple[User, int]]:
+        """
+        Look up emails on the shards a ring maps them to.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+            ring (HashRing): The ring choosing the shards.
+
+        Returns:
+            Dict[str, Tuple[User, int]]: The users found and their versions, keyed by email.
+        """
+        by_shard: Dict[str, List[str]] = {}
+        for email in emails:
+            by_shard.setdefault(ring.owner(email), []).append(email)
+        found: Dict[str, Tuple[User, int]] = {}
+        results = await asyncio.gather(*(self._shards[name].get_many_versioned_by_email(batch)
+                                         for name, batch in by_shard.items()))
+        for result in results:
+            found.update(result)
+        return found
+
+    async def upsert(self, user: User) -> User:
+        """
+        Create or update a user on the shard owning its email.
+
+        Args:
+            user (User): The user to write.
+
+        Returns:
+            User: The stored user.
+        """
+        return await self._owner(user.email).upsert(user)
+
+    async def upsert_many(self, users: List[User]) -> List[User]:
+        """
+        Create or update several users, one statement per shard in parallel.
+
+        Args:
+            users (List[User]): The users to write.
+
+        Returns:
+            List[User]: The stored users.
+        """
+        by_shard: Dict[str, List[User]] = {}
+        for user in users:
+            by_shard.setdefault(self._ring.owner(user.email), []).append(user)
+        stored = await asyncio.gather(*(self._shards[name].upsert_many(shard_users)
+                                        for name, shard_users in by_shard.items()))
+        return [user for shard_users in stored for user in shard_users]
+
+    async def update(self, email: str, changes: UserUpdate) -> Optional[User]:
+        """
+        Update the given fields of a user on its shard.
+
+        Args:
+            email (str): The email of the user to update.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            Optional[User]: The updated user, or None if not found.
+        """
+        user = await self._owner(email).update(email, changes)
+        previous = self._previous_owner(email)
+        if user is None and previous is not None:
+            user = await previous.update(email, changes)
+        return user
+
+    async def update_where(self, user_filter: UserFilter, changes: UserUpdate) -> int:
+        """
+        Update the given fields of every user matching a filter on every shard.
+
+        Without a limit the shards are updated in parallel; with one, they are
+        updated one after the other until the limit is used up.
+
+        Args:
+            user_filter (UserFilter): The filter criteria; the limit caps the number
+                of updated users.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            int: The number of updated users.
+        """
+        if user_filter.limit is None:
+            return sum(await self._each("update_where", user_filter, changes))
+        updated = 0
+        for name in self._names:
+            remaining = user_filter.model_copy(update={"limit": user_filter.limit - updated})
+            if remaining.limit <= 0:
+                break
+            updated += await self._shards[name].update_where(remaining, changes)
+        return updated
+
+    async def count(self, user_filter: UserFilter, budget: float) -> UserCount:
+        """
+        Count the matching users of every shard in parallel and add the counts up.
+
+        During a rebalance a user may be counted on two shards, so the total
+        is then only an estimate.
+
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            budget (float): Seconds each shard may spend on an exact count.
+
+        Returns:
+            UserCount: The total and whether it is exact.
+        """
+        counts = await self._each("count", user_filter, budget)
+        return UserCount(count=sum(count.count for count in counts),
+                         exact=self._previous_ring is None and all(count.exact for count in counts))
+
+    async def get_changes(self, since: Optional[str], limit: int) -> UserChanges:
+        """
+        Get the changes of every shard in parallel after a cursor.
+
+        The cursor holds the position of each shard, as "<shard>=<cursor>"
+        pairs separated by semicolons, and each shard fills an equal share of
+        the page. Changes are in order within a shard only, and users moved by
+        a rebalance show up again on their new shard.
+
+        Args:
+            since (Optional[str]): The cursor returned with the previous page, None for
+                the first page.
+            limit (int): Maximum number of changes.
+
+        Returns:
+            UserChanges: The changes and the cursor of the next page.
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        positions = {}
+        for pair in filter(None, (since or "").split(";")):
+            name, separator, cursor = pair.partition("=")
+            if not separator:
+                raise ValueError(f"Malformed change cursor {since!r}")
+            positions[name] = cursor
+        share = max(1, limit // len(self._names))
+        pages = await asyncio.gather(*(self._shards[name].get_changes(positions.get(name), share)
+                                       for name in self._names))
+        cursor = ";".join(f"{name}={page.cursor}" for name, page in zip(self._names, pages))
+        return UserChanges(changes=[change for page in pages for change in page.changes],
+                           cursor=cursor, more=any(page.more for page in pages))
+
+    async def delete(self, email: str) -> bool:
+        """
+        Delete a user from its shard, and from its previous shard during a rebalance.
+
+        Args:
+            email (str): The email of the user to delete.
+
+        Returns:
+            bool: True if the user existed.
+        """
+        previous = self._previous_owner(email)
+        if previous is None:
+            return await self._owner(email).delete(email)
+        return any(await asyncio.gather(self._owner(email).delete(email), previous.delete(email)))
+
+    async def delete_batch(self, user_filter: UserFilter, after_id: int,
+                           batch_size: int) -> Tuple[int, Optional[int]]:
+        """
+        Delete the next batch of users matching a filter, one shard after the other.
+
+        The cursor packs the shard index and the id within that shard as
+        id * shards + index, so a job resumes on the shard it stopped at.
+
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            after_id (int): The cursor returned by the previous batch, 0 to start.
+            batch_size (int): Maximum number of users to delete.
+
+        Returns:
+            Tuple[int, Optional[int]]: The number of deleted users and the
+            cursor of the next batch, None when nothing was left to delete.
+        """
+        shards = len(self._names)
+        local_after_id, index = divmod(after_id, shards)
+        for index in range(index, shards):
+            deleted, last_id = await self._shards[self._names[index]].delete_batch(
+                user_filter, local_after_id, batch_size)
+            if last_id is not None:
+                return deleted, last_id * shards + index
+            local_after_id = 0
+        return 0, None
+
+    async def create_ticketed(self, tickets: Dict[str, User]) -> Dict[str, str]:
+        """
+        Create the users of spooled tickets, one transaction per shard in parallel.
+
+        Each ticket goes to the shard owning its email, or during a rebalance
+        to the previous owner when the user is still there, so a duplicate
+        email is still reported.
+
+        Args:
+            tickets (Dict[str, User]): The users to create by ticket, in spooling order.
+
+        Returns:
+            Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+        """
+        not_moved = {}
+        if self._previous_ring is not None:
+            not_moved = await self._gather_by_shard([user.email for user in tickets.values()],
+                                                    self._previous_ring)
+        by_shard: Dict[str, Dict[str, User]] = {}
+        for ticket, user in tickets.items():
+            ring = self._previous_ring if user.email in not_moved else self._ring
+            by_shard.setdefault(ring.owner(user.email), {})[ticket] = user
+        outcomes: Dict[str, str] = {}
+        for shard_outcomes in await asyncio.gather(*(self._shards[name].create_ticketed(shard)
+                                                     for name, shard in by_shard.items())):
+            outcomes.update(shard_outcomes)
+        return {ticket: outcomes[ticket] for ticket in tickets}
+
+    async def fail_ticketed(self, tickets: Dict[str, User]) -> None:
+        """
+        Record spooled tickets as failed on the shards owning their emails, in parallel.
+
+        Args:
+            tickets (Dict[str, User]): The users that could not be created, by ticket.
+        """
+        by_shard: Dict[str, Dict[str, User]] = {}
+        for ticket, user in tickets.items():
+            by_shard.setdefault(self._ring.owner(user.email), {})[ticket] = user
+        await asyncio.gather(*(self._shards[name].fail_ticketed(shard)
+                               for name, shard in by_shard.items()))
+
+    async def get_ticket_outcome(self, ticket: str) -> Optional[str]:
+        """
+        Look the outcome of a spooled ticket up on every shard in parallel.
+
+        Args:
+            ticket (str): The ticket.
+
+        Returns:
+            Optional[str]: TICKET_CREATED, TICKET_DUPLICATE or TICKET_FAILED, or None if
+                not recorded.
+        """
+        outcomes = await self._each("get_ticket_outcome", ticket)
+        return next((outcome for outcome in outcomes if outcome), None)
+
+    async def prune_ticket_outcomes(self, before: datetime) -> int:
+        """
+        Forget the outcomes recorded before a time on every shard in parallel.
+
+        Args:
+            before (datetime): The oldest outcome to keep.
+
+        Returns:
+            int: The number of outcomes forgotten.
+        """
+        return sum(await self._each("prune_ticket_outcomes", before))
+
+    async def stream_rows(self, user_filter: UserFilter, columns: List[str],
+                          chunk_size: int) -> AsyncIterator[List[tuple]]:
+        """
+        Stream the matching users of every shard, one shard after the other.
+
+        Args:
+            user_filter (UserFilter): The filter criteria; the limit applies to all shards.
+            columns (List[str]): Names from EXPORT_COLUMNS, in output order.
+            chunk_size (int): Maximum number of rows per chunk.
+
+        Returns:
+            AsyncIterator[List[tuple]]: The chunks of rows.
+        """
+        remaining = user_filter.limit
+        for name in self._names:
+            shard_filter = user_filter.model_copy(update={"limit": remaining})
+            async for chunk in self._shards[name].stream_rows(shard_filter, columns, chunk_size):
+                yield chunk
+                if remaining is not None:
+                    remaining -= len(chunk)
+            if remaining is not None and remaining <= 0:
+                return
+
+
+def _shard_settings() -> Tuple[Dict[str, str], Optional[Dict[str, str]]]:
+    """
+    Read the shards from the environment.
+
+    Returns:
+        Tuple[Dict[str, str], Optional[Dict[str, str]]]: The shards of the ring,
+        and those of the previous ring during a rebalance.
+    """
+    previous = os.getenv("SHARD_PREVIOUS_DB_STRINGS")
+    return (parse_db_strings(os.getenv("SHARD_DB_STRINGS", "")),
+            parse_db_strings(previous) if previous else None)
+
+
+@asynccontextmanager
+async def open_sharded_user_repository(
+        shards: Optional[Dict[str, str]] = None,
+        previous_shards: Optional[Dict[str, str]] = None,
+        read_only: bool = False) -> AsyncIterator[ShardedUserRepository]:
+    """
+    Open a ShardedUserRepository with one session per shard.
+
+    Args:
+        shards (Optional[Dict[str, str]]): Connection strings keyed by shard name,
+            SHARD_DB_STRINGS by default.
+        previous_shards (Optional[Dict[str, str]]): The shards before the rebalance
+            in progress, SHARD_PREVIOUS_DB_STRINGS by default.
+        read_only (bool): Whether the shards are only read, in autocommit.
+
+    Returns:
+        AsyncIterator[ShardedUserRepository]: A context manager yielding the repository.
+    """
+    if shards is None:
+        shards, previous_shards = _shard_settings()
+    db_strings = {**(previous_shards or {}), **shards}
+    async with AsyncExitStack() as stack:
+        engine = get_read_only_engine if read_only else get_engine
+        sessions = {name: await stack.enter_async_context(AsyncSession(engine(db_string)))
+                    for name, db_string in db_strings.items()}
+        repository = ShardedUserRepository(
+            {name: SQLUserRepository(session, read_only) for name, session in sessions.items()},
+            HashRing(shards), HashRing(previous_shards) if previous_shards else None)
+        async with repository:
+            yield repository
+
+
+async def _move_batch(source: AsyncSession, target: AsyncSession, rows: List[Row]) -> int:
+    """
+    Move users from one shard to another.
+
+    The users are copied without overwriting a newer row written on the
+    target through the new ring, then deleted from the source if they did not
+    change in the meantime. A copy whose source changed is undone, unless the
+    target was written since, and retried by the next pass.
+
+    Args:
+        source (AsyncSession): Session on the shard the users live on.
+        target (AsyncSession): Session on their new shard.
+        rows (List[Row]): The users to move, with their version.
+
+    Returns:
+        int: The number of users moved.
+    """
+    values = [{column: getattr(row, column) for column in MOVED_COLUMNS} for row in rows]
+    await label_cache.ensure(target, values)
+    copied = dict((await target.execute(
+        insert(UserInDB).values(values)
+        .on_conflict_do_nothing(index_elements=UPSERT_CONFLICT_COLUMNS)
+        .returning(UserInDB.email, UserInDB.version))).all())
+    await target.commit()
+
+    # Users already on the target were written there through the new ring, which wins.
+    unchanged = [(row.email, row.version) for row in rows if row.email in copied]
+    superseded = [row.email for row in rows if row.email not in copied]
+    deleted = set((await source.execute(
+        delete(UserInDB).where(or_(tuple_(UserInDB.email, UserInDB.version).in_(unchanged),
+                                   UserInDB.email.in_(superseded)))
+        .returning(UserInDB.email).execution_options(synchronize_session=False))).scalars())
+    await source.commit()
+
+    changed = [(email, version) for email, version in copied.items() if email not in deleted]
+    if changed:
+        await target.execute(
+            delete(UserInDB).where(tuple_(UserInDB.email, UserInDB.version).in_(changed))
+            .execution_options(synchronize_session=False))
+        await target.commit()
+    return len(deleted)
+
+
+async def _rebalance_shard(name: str, db_string: str, ring: HashRing, shards: Dict[str, str],
+                           batch_size: int) -> Tuple[int, int]:
+    """
+    Scan a shard in id order and move its misplaced users in batches.
+
+    Args:
+        name (str): The name of the shard.
+        db_string (str): Its connection string.
+        ring (HashRing): The new ring.
+        shards (Dict[str, str]): Connection strings of the new ring.
+        batch_size (int): Users read and moved per batch.
+
+    Returns:
+        Tuple[int, int]: The number of misplaced users found and moved.
+    """
+    misplaced = moved = 0
+    last_id = 0
+    async with AsyncSession(get_engine(db_string)) as source:
+        while True:
+            rows = (await source.execute(
+                select(UserInDB.id, UserInDB.version,
+                       *(UserInDB.__table__.c[column] for column in MOVED_COLUMNS))
+                .where(UserInDB.id > last_id).order_by(UserInDB.id).limit(batch_size))).all()
+            await source.commit()
+            if not rows:
+                return misplaced, moved
+            last_id = rows[-1].id
+            by_target: Dict[str, List[Row]] = {}
+            for row in rows:
+                if ring.owner(row.email) != name:
+                    by_target.setdefault(ring.owner(row.email), []).append(row)
+            for owner, owner_rows in by_target.items():
+                misplaced += len(owner_rows)
+                async with AsyncSession(get_engine(shards[owner])) as target:
+                    moved += await _move_batch(source, target, owner_rows)
+
+
+async def rebalance(shards: Dict[str, str], previous_shards: Optional[Dict[str, str]] = None,
+                    batch_size: int = REBALANCE_BATCH_ROWS) -> int:
+    """
+    Move every user to the shard the ring maps it to, while the API keeps serving.
+
+    Each shard is scanned in id order and its misplaced users are moved in
+    batches, each one committed on its own. Passes are repeated until one
+    finds nothing left to move.
+
+    Args:
+        shards (Dict[str, str]): Connection strings of the new ring.
+        previous_shards (Optional[Dict[str, str]]): Connection strings of shards
+            that are being removed or renamed.
+        batch_size (int): Users moved per batch.
+
+    Returns:
+        int: The number of users moved.
+    """
+    ring = HashRing(shards)
+    db_strings = {**(previous_shards or {}), **shards}
+    moved = 0
+    while True:
+        misplaced = 0
+        for name, db_string in sorted(db_strings.items()):
+            shard_misplaced, shard_moved = await _rebalance_shard(name, db_string, ring, shards,
+                                                                  batch_size)
+            misplaced += shard_misplaced
+            moved += shard_moved
+            logger.info("Shard %s scanned: %d misplaced users, %d moved",
+                        name, shard_misplaced, shard_moved)
+        if not misplaced:
+            return moved
+
+
+async def main(arguments: argparse.Namespace) -> None:
+    """
+    Run a command of the sharding tool.
+
+    Args:
+        arguments (argparse.Namespace): The parsed command line.
+    """
+    shards, previous_shards = _shard_settings()
+    if arguments.command == "rebalance":
+        moved = await rebalance(shards, previous_shards, arguments.batch_size)
+        print(f"{moved} users moved")
+    else:
+        ring = HashRing(shards)
+        for name, db_string in sorted({**(previous_shards or {}), **shards}.items()):
+            async with AsyncSession(get_engine(db_string)) as session:
+                emails = (await session.execute(select(UserInDB.email))).scalars().all()
+            misplaced = sum(1 for email in emails if ring.owner(email) != name)
+            print(f"{name}: {len(emails)} users, {misplaced} to move")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["rebalance", "status"])
+    parser.add_argument("--batch-size", type=int, default=REBALANCE_BATCH_ROWS)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,178 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple, TypeVar
+
+from user_repository import User, UserFilter, UserRepository, UserRepositoryDecorator
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time and shares its result.
+
+    Callers arriving while a call for their key is in flight wait for that
+    call instead of starting their own. Each caller waits through a shield, so
+    a cancelled caller does not cancel the call for the others.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty group of flights.
+        """
+        self._flights: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.shared = 0
+
+    def flight(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> Tuple["asyncio.Task[T]", bool]:
+        """
+        Join the call in flight for a key, or start it.
+
+        Args:
+            key (Hashable): Identifies identical calls.
+            function (Callable[[], Awaitable[T]]): Starts the call when none is in flight.
+
+        Returns:
+            Tuple[asyncio.Task[T], bool]: The call and whether this caller started it.
+        """
+        task = self._flights.get(key)
+        if task is not None:
+            self.shared += 1
+            return task, False
+
+        task = asyncio.ensure_future(function())
+        self._flights[key] = task
+        self.started += 1
+        task.add_done_callback(lambda done: self._land(key, done))
+        return task, True
+
+    def _land(self, key: Hashable, task: asyncio.Task) -> None:
+        """
+        Forget a finished call.
+
+        Args:
+            key (Hashable): The key of the call.
+            task (asyncio.Task): The finished call.
+        """
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller went away.
+            task.exception()
+
+    def snapshot(self) -> dict:
+        """
+        Describe the group.
+
+        Returns:
+            dict: Calls in flight, started and shared.
+        """
+        return {"in_flight": len(self._flights), "started": self.started, "shared": self.shared}
+
+
+user_flights = SingleFlight()
+
+
+class SingleFlightUserRepository(UserRepositoryDecorator):
+    """
+    UserRepository decorator that de-duplicates identical concurrent reads.
+
+    The first request for a key runs the query on its own repository and
+    the requests that arrive while it is running share its result. A leading
+    request that is cancelled waits for its queries in __aexit__, so its
+    session stays open until the requests sharing them have their result.
+
+    List reads are keyed by the generation the request read last, so a
+    request only shares a query started after it read that generation and
+    the ETag it builds never describes older rows.
+    """
+
+    def __init__(self, repository: UserRepository, flights: SingleFlight):
+        """
+        Initialize with the repository that runs the queries.
+
+        Args:
+            repository (UserRepository): The decorated repository.
+            flights (SingleFlight): The group shared by all requests.
+        """
+        super().__init__(repository)
+        self._flights = flights
+        self._led: Set[asyncio.Task] = set()
+        self._generation: Optional[int] = None
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Wait for the queries this request leads, then exit the decorated repository.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        if self._led:
+            await asyncio.shield(asyncio.gather(*self._led, return_exceptions=True))
+        await self._repository.__aexit__(exc_type, exc_value, exc_traceback)
+
+    async def _share(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run a read through the single-flight group.
+
+        Args:
+            key (Hashable): Identifies identical reads.
+            function (Callable[[], Awaitable[T]]): Runs the read on this repository.
+
+        Returns:
+            T: The shared result.
+        """
+        task, leader = self._flights.flight(key, function)
+        if leader:
+            self._led.add(task)
+            task.add_done_callback(self._led.discard)
+        return await asyncio.shield(task)
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by email, sharing identical concurrent reads.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        return await self._share(("get_by_email", email), lambda: self._repository.get_by_email(email))
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email, sharing identical concurrent reads.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        return await self._share(("get_versioned_by_email", email),
+                                 lambda: self._repository.get_versioned_by_email(email))
+
+    async def get(self, user_filter: UserFilter) -> List[User]:
+        """
+        Get a list of users, sharing identical concurrent reads.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            List[User]: List of users matching the filter criteria.
+        """
+        key = ("get", self._generation) + tuple(user_filter.model_dump().items())
+        return await self._share(key, lambda: self._repository.get(user_filter))
+
+    async def get_generation(self) -> int:
+        """
+        Retrieve the generation through the decorated repository.
+
+        Returns:
+            int: The current generation.
+        """
+        self._generation = await self._repository.get_generation()
+        return self._generation
@@ -0,0 +1,558 @@
+"""
+Write-behind queue for /create/, enabled by CREATE_SPOOL_DIR.
+
+/create/ appends the validated user to a local spool and answers 202 with a
+ticket once the entry is on disk. Entries arriving within SPOOL_FSYNC_MS of
+each other are written and fsynced together. A background task drains the
+spool to the database in batches of up to SPOOL_BATCH_SIZE, and the outcome
+of every ticket, created or duplicate, is recorded in create_ticket in the
+same transaction as the users, so replaying an entry is harmless. A batch
+failing on its data is split until the entry at fault is alone; that entry
+is recorded as failed and dropped, and the others are created.
+
+The spool is a directory of append-only segment files of JSON lines. Each
+worker appends to segments of its own and holds an exclusive flock on them
+while it runs. On start, and every SPOOL_ADOPT_SECONDS, a worker adopts the
+segments nobody holds, left by a worker that stopped or crashed, and
+replays their entries; a line torn by a crash was never acknowledged and is
+skipped. A segment is deleted once every entry in it is drained.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import re
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import AsyncContextManager, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import orjson
+from pydantic import BaseModel
+from sqlalchemy.exc import DBAPIError
+
+from user_cache import coherent_factory
+from user_repository import User, UserRepository, open_user_repository
+
+logger = logging.getLogger(__name__)
+
+CREATE_SPOOL_DIR = os.getenv("CREATE_SPOOL_DIR", "")
+SPOOL_FSYNC_MS = float(os.getenv("SPOOL_FSYNC_MS", "2"))
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", "1000"))
+SPOOL_DRAIN_DELAY_MS = float(os.getenv("SPOOL_DRAIN_DELAY_MS", "100"))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+SPOOL_ADOPT_SECONDS = float(os.getenv("SPOOL_ADOPT_SECONDS", "30"))
+TICKET_RETENTION_HOURS = float(os.getenv("TICKET_RETENTION_HOURS", "24"))
+MAX_DRAIN_DELAY = 5.0
+
+SEGMENT_SUFFIX = ".spool"
+# The creation time in hexadecimal seconds, then a random part.
+TICKET_PATTERN = re.compile(r"^([0-9a-f]{1,16})-[0-9a-f]{32}$")
+
+TICKET_PENDING = "pending"
+# SQLSTATE classes of the errors caused by the entries of a batch, data exceptions and
+# integrity constraint violations, which retrying the same batch cannot fix.
+ENTRY_ERROR_CLASSES = {"22", "23"}
+
+
+class CreateTicketStatus(BaseModel):
+    """
+    Pydantic model describing a spooled creation.
+
+    Attributes:
+        ticket (str): The ticket returned by /create/.
+        state (str): "pending", "created", "duplicate" when the email was already taken,
+            or "failed" when the user could not be stored.
+    """
+    ticket: str
+    state: str
+
+
+def is_entry_error(error: Exception) -> bool:
+    """
+    Tell whether an error was caused by the data of a batch rather than by the database.
+
+    Args:
+        error (Exception): The error raised while creating the batch.
+
+    Returns:
+        bool: True for an error whose SQLSTATE is in ENTRY_ERROR_CLASSES.
+    """
+    sqlstate = getattr(getattr(error, "orig", None), "sqlstate", None) or ""
+    return isinstance(error, DBAPIError) and sqlstate[:2] in ENTRY_ERROR_CLASSES
+
+
+def new_ticket() -> str:
+    """
+    Draw a ticket.
+
+    Returns:
+        str: The ticket, starting with its creation time.
+    """
+    return f"{int(time.time()):x}-{uuid.uuid4().hex}"
+
+
+def ticket_time(ticket: str) -> Optional[datetime]:
+    """
+    Read the creation time of a ticket.
+
+    Args:
+        ticket (str): The ticket.
+
+    Returns:
+        Optional[datetime]: The time, or None if it is not a ticket.
+    """
+    match = TICKET_PATTERN.match(ticket)
+    if match is None:
+        return None
+    return datetime.fromtimestamp(int(match.group(1), 16), timezone.utc)
+
+
+class _Segment:
+    """
+    A segment file of the spool, locked by this process.
+    """
+
+    def __init__(self, path: str, descriptor: int, size: int):
+        """
+        Wrap an open and locked segment.
+
+        Args:
+            path (str): The path of the file.
+            descriptor (int): The file descriptor holding the lock.
+            size (int): The bytes already in the file.
+        """
+        self.path = path
+        self.descriptor = descriptor
+        self.size = size
+        # Entries appended or replayed and not drained yet.
+        self.pending = 0
+
+    def write(self, data: bytes) -> None:
+        """
+        Append to the file and flush it to disk; blocks, run it in a thread.
+
+        Args:
+            data (bytes): Whole lines.
+        """
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.descriptor, view):]
+        os.fsync(self.descriptor)
+        self.size += len(data)
+
+    def remove(self) -> None:
+        """
+        Delete the file, then release the lock.
+        """
+        os.unlink(self.path)
+        os.close(self.descriptor)
+
+
+class _Entry:
+    """
+    A spooled creation waiting to be drained.
+    """
+    __slots__ = ("ticket", "user", "segment")
+
+    def __init__(self, ticket: str, user: User, segment: _Segment):
+        self.ticket = ticket
+        self.user = user
+        self.segment = segment
+        segment.pending += 1
+
+
+class CreateSpool:
+    """
+    Spools creations to local segment files and drains them to the database.
+    """
+
+    def __init__(self, directory: str,  # pylint: disable=too-many-arguments
+                 repository_factory: Callable[[], AsyncContextManager[UserRepository]],
+                 fsync_ms: float = SPOOL_FSYNC_MS, batch_size: int = SPOOL_BATCH_SIZE,
+                 drain_delay_ms: float = SPOOL_DRAIN_DELAY_MS,
+                 segment_bytes: int = SPOOL_SEGMENT_BYTES,
+                 retention_hours: float = TICKET_RETENTION_HOURS):
+        """
+        Configure a stopped spool.
+
+        Args:
+            directory (str): The spool directory, shared by the workers of a host.
+            repository_factory (Callable[[], AsyncContextManager[UserRepository]]):
+                Opens the repository used for one batch.
+            fsync_ms (float): Milliseconds appends wait for others to share their fsync.
+            batch_size (int): Entries created per transaction at most.
+            drain_delay_ms (float): Milliseconds entries wait to fill a batch.
+            segment_bytes (int): Size after which appends go to a new segment.
+            retention_hours (float): Hours the outcome of a ticket is kept for.
+        """
+        self.directory = directory
+        self._repository_factory = repository_factory
+        self.fsync_delay = fsync_ms / 1000
+        self.batch_size = batch_size
+        self.drain_delay = drain_delay_ms / 1000
+        self.segment_bytes = segment_bytes
+        self.retention = timedelta(hours=retention_hours)
+        self._segments: Dict[str, _Segment] = {}
+        self._active: Optional[_Segment] = None
+        self._waiting: List[Tuple[str, User, bytes, "asyncio.Future[None]"]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._entries: Deque[_Entry] = deque()
+        self._pending: Set[str] = set()
+        self._ready = asyncio.Event()
+        # Checked after every await of the drain loop: a cancellation can be lost by wait_for.
+        self._stopping = False
+        self._drain_task: Optional[asyncio.Task] = None
+        self.appended = 0
+        self.fsyncs = 0
+        self.replayed = 0
+        self.drained = 0
+        self.batches = 0
+        self.failures = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether start was called and stop was not.
+        """
+        return self._drain_task is not None
+
+    async def start(self) -> None:
+        """
+        Adopt the orphan segments and start draining.
+        """
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._ready = asyncio.Event()
+        self._stopping = False
+        await self._adopt()
+        self._drain_task = asyncio.create_task(self._drain())
+
+    async def stop(self) -> None:
+        """
+        Finish the appends in flight, stop draining and release the segments.
+
+        Entries not drained yet stay in their segments, for the next worker to replay.
+        """
+        if self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+        if self._drain_task is not None:
+            self._stopping = True
+            self._ready.set()
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+            self._drain_task = None
+        self._active = None
+        for segment in list(self._segments.values()):
+            if segment.pending == 0:
+                segment.remove()
+            else:
+                os.close(segment.descriptor)
+        self._segments.clear()
+        self._entries.clear()
+        self._pending.clear()
+
+    async def append(self, user: User) -> str:
+        """
+        Spool the creation of a user.
+
+        Args:
+            user (User): The validated user.
+
+        Returns:
+            str: Its ticket, once the entry is on disk.
+        """
+        ticket = new_ticket()
+        line = orjson.dumps({"ticket": ticket, "user": user.model_dump()}) + b"\n"  # pylint: disable=no-member
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((ticket, user, line, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        await future
+        return ticket
+
+    def is_pending(self, ticket: str) -> bool:
+        """
+        Tell whether a ticket of this process is not drained yet.
+
+        Args:
+            ticket (str): The ticket.
+
+        Returns:
+            bool: True if it waits in the spool of this process.
+        """
+        return ticket in self._pending
+
+    async def _flush(self) -> None:
+        """
+        Write and fsync the waiting appends together, until none is left.
+        """
+        try:
+            while self._waiting:
+                await asyncio.sleep(self.fsync_delay)
+                waiting, self._waiting = self._waiting, []
+                try:
+                    segment = await self._segment_for_append()
+                    data = b"".join(line for _, _, line, _ in waiting)
+                    await asyncio.to_thread(segment.write, data)
+                except Exception as error:  # pylint: disable=broad-except
+                    for _, _, _, future in waiting:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                self.fsyncs += 1
+                self.appended += len(waiting)
+                for ticket, user, _, future in waiting:
+                    self._entries.append(_Entry(ticket, user, segment))
+                    self._pending.add(ticket)
+                    if not future.done():
+                        future.set_result(None)
+                self._ready.set()
+        finally:
+            self._flush_task = None
+
+    async def _segment_for_append(self) -> _Segment:
+        """
+        The segment to append to, starting a new one when it is full.
+
+        Returns:
+            _Segment: The active segment.
+        """
+        if self._active is not None and self._active.size >= self.segment_bytes:
+            previous, self._active = self._active, None
+            self._release_if_drained(previous)
+        if self._active is None:
+            self._active = await asyncio.to_thread(self._create_segment)
+            self._segments[self._active.path] = self._active
+        return self._active
+
+    def _create_segment(self) -> _Segment:
+        """
+        Create a segment, locked before it gets the name other workers look for.
+
+        Returns:
+            _Segment: The new segment.
+        """
+        name = f"{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        temporary = os.path.join(self.directory, f".{name}.tmp")
+        descriptor = os.open(temporary, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o600)
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+        path = os.path.join(self.directory, name + SEGMENT_SUFFIX)
+        os.rename(temporary, path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        return _Segment(path, descriptor, 0)
+
+    def _lock_orphans(self) -> List[Tuple[str, int, bytes]]:
+        """
+        Lock the segments nobody holds and read them; blocks, run it in a thread.
+
+        Returns:
+            List[Tuple[str, int, bytes]]: The path, locked descriptor and content
+                of each, oldest segment first.
+        """
+        orphans = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(SEGMENT_SUFFIX) or path in self._segments:
+                continue
+            try:
+                descriptor = os.open(path, os.O_RDWR | os.O_APPEND)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(descriptor)
+                continue
+            if os.fstat(descriptor).st_nlink == 0:
+                # Drained and deleted by its owner after it was listed.
+                os.close(descriptor)
+                continue
+            with open(descriptor, "rb", closefd=False) as file:
+                orphans.append((path, descriptor, file.read()))
+        return orphans
+
+    async def _adopt(self) -> None:
+        """
+        Take the segments nobody holds over and queue their entries.
+        """
+        for path, descriptor, data in await asyncio.to_thread(self._lock_orphans):
+            segment = _Segment(path, descriptor, len(data))
+            self._segments[path] = segment
+            for entry in self._replay(data, path):
+                user = User.model_validate(entry["user"])
+                self._entries.append(_Entry(entry["ticket"], user, segment))
+                self._pending.add(entry["ticket"])
+                self.replayed += 1
+            self._release_if_drained(segment)
+        if self._entries:
+            self._ready.set()
+
+    @staticmethod
+    def _replay(data: bytes, path: str) -> List[dict]:
+        """
+        Parse the entries of a segment.
+
+        Args:
+            data (bytes): Its content.
+            path (str): Its path, for the logs.
+
+        Returns:
+            List[dict]: The entries; a torn last line is skipped.
+        """
+        lines = data.split(b"\n")
+        if lines[-1]:
+            logger.warning("Skipping the torn last entry of %s", path)
+        entries = []
+        for line in lines[:-1]:
+            try:
+                entries.append(orjson.loads(line))  # pylint: disable=no-member
+            except orjson.JSONDecodeError:  # pylint: disable=no-member
+                logger.warning("Skipping a corrupt entry of %s", path)
+        return entries
+
+    def _release_if_drained(self, segment: _Segment) -> None:
+        """
+        Delete a segment that is not appended to and has nothing left to drain.
+
+        Args:
+            segment (_Segment): The segment.
+        """
+        if segment is not self._active and segment.pending == 0:
+            del self._segments[segment.path]
+            segment.remove()
+
+    async def _drain(self) -> None:
+        """
+        Create the spooled users in batches until cancelled, retrying with backoff on errors.
+
+        Entries created or rejected before an error are not retried.
+        """
+        delay = 0.1
+        next_adopt = next_prune = time.monotonic()
+        while not self._stopping:
+            if not self._entries:
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), SPOOL_ADOPT_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            if len(self._entries) < self.batch_size and not self._stopping:
+                await asyncio.sleep(self.drain_delay)
+            now = time.monotonic()
+            if now >= next_adopt and not self._stopping:
+                next_adopt = now + SPOOL_ADOPT_SECONDS
+                await self._adopt()
+            if not self._entries or self._stopping:
+                continue
+            batch = [self._entries[index]
+                     for index in range(min(self.batch_size, len(self._entries)))]
+            prune = now >= next_prune
+            try:
+                if await self._create(batch, prune) and prune:
+                    next_prune = now + self.retention.total_seconds() / 24
+            except Exception as error:  # pylint: disable=broad-except
+                self.failures += 1
+                logger.warning("Spool drain failed, retrying in %.1fs: %s", delay, error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_DRAIN_DELAY)
+                continue
+            delay = 0.1
+
+    async def _create(self, batch: List[_Entry], prune: bool = False,
+                      isolated: bool = False) -> bool:
+        """
+        Create the users of a batch in one transaction, then forget its entries.
+
+        When the batch fails on its data, as told by is_entry_error, its halves are created
+        in transactions of their own, so an entry that can never be created
+        does not hold back the others. An entry failing again alone is
+        recorded as failed and dropped. Retrying in halves also settles the
+        IntegrityError of a user created meanwhile in another country.
+
+        Args:
+            batch (List[_Entry]): The entries, first in the queue.
+            prune (bool): Whether to prune the old outcomes in the same transaction.
+            isolated (bool): Whether the batch is a part of a batch that failed.
+
+        Returns:
+            bool: True if the batch was committed as a whole.
+
+        Raises:
+            Exception: Any other error, e.g. when the database is unavailable.
+        """
+        try:
+            async with self._repository_factory() as repository:
+                await repository.create_ticketed({entry.ticket: entry.user for entry in batch})
+                if prune:
+                    await repository.prune_ticket_outcomes(
+                        datetime.now(timezone.utc) - self.retention)
+        except DBAPIError as error:
+            if not is_entry_error(error):
+                raise
+            if isolated and len(batch) == 1:
+                await self._reject(batch[0], error)
+                return False
+            middle = (len(batch) + 1) // 2
+            for part in (batch[:middle], batch[middle:]):
+                if part:
+                    await self._create(part, isolated=True)
+            return False
+        self.batches += 1
+        self.drained += len(batch)
+        self._forget(batch)
+        return True
+
+    async def _reject(self, entry: _Entry, error: Exception) -> None:
+        """
+        Record the ticket of an entry that cannot be created as failed, then forget the entry.
+
+        Args:
+            entry (_Entry): The entry, first in the queue.
+            error (Exception): Why its user cannot be created.
+        """
+        logger.error("Dropping spooled ticket %s, its user cannot be created: %s",
+                     entry.ticket, error)
+        async with self._repository_factory() as repository:
+            await repository.fail_ticketed({entry.ticket: entry.user})
+        self.rejected += 1
+        self._forget([entry])
+
+    def _forget(self, batch: List[_Entry]) -> None:
+        """
+        Forget the entries of a batch and delete the segments it emptied.
+
+        Args:
+            batch (List[_Entry]): The entries, first in the queue.
+        """
+        for entry in batch:
+            self._entries.popleft()
+            self._pending.discard(entry.ticket)
+            entry.segment.pending -= 1
+        for segment in {entry.segment for entry in batch}:
+            self._release_if_drained(segment)
+
+    def snapshot(self) -> dict:
+        """
+        Describe the spool.
+
+        Returns:
+            dict: Entries waiting, segments held, entries appended and replayed,
+                fsyncs, entries drained, batches, failed batches and entries rejected.
+        """
+        return {"running": self.running, "pending": len(self._entries),
+                "segments": len(self._segments),
+                "appended": self.appended, "replayed": self.replayed, "fsyncs": self.fsyncs,
+                "drained": self.drained, "batches": self.batches, "failures": self.failures,
+                "rejected": self.rejected}
+
+
+create_spool = CreateSpool(CREATE_SPOOL_DIR, coherent_factory(open_user_repository))
@@ -0,0 +1,208 @@
+"""
+Outcomes of the creations spooled by /create/, recorded in create_ticket.
+
+An outcome is written in the transaction that creates the users of its
+spooled batch, so a batch replayed after a crash keeps the outcomes it had
+instead of reporting its own users as duplicates. The repositories delegate
+their ticket methods to the functions of this module.
+"""
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from sqlalchemy import DateTime, String, any_, bindparam, delete, func, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column
+
+from labels import label_cache
+from user_repository import (SQL_BASE, UPSERT_CHUNK_ROWS, UPSERT_CONFLICT_COLUMNS,
+                             InMemoryUserRepository, User, UserInDB)
+
+TICKET_CREATED = "created"
+TICKET_DUPLICATE = "duplicate"
+TICKET_FAILED = "failed"
+
+
+class CreateTicketInDB(SQL_BASE):
+    """
+    SQLAlchemy model recording the outcome of a spooled creation.
+    """
+    __tablename__ = 'create_ticket'
+
+    ticket: Mapped[str] = mapped_column(String(length=64), primary_key=True)
+    email: Mapped[str] = mapped_column(String(length=128), nullable=False)
+    outcome: Mapped[str] = mapped_column(String(length=16), nullable=False)
+    resolved_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False,
+        server_default=func.now())  # pylint: disable=not-callable
+
+
+async def sql_create_ticketed(session: AsyncSession, execute: Callable,
+                              tickets: Dict[str, User]) -> Dict[str, str]:
+    """
+    Create the users of spooled tickets and record their outcomes in the session's transaction.
+
+    Taken emails are looked up first, so a duplicate is reported whatever
+    the partitioning layout, and the rows are inserted with ON CONFLICT
+    DO NOTHING for users created meanwhile. Under the country layout a user
+    created meanwhile in another country fails the whole batch with an
+    IntegrityError instead, and the batch can be retried.
+
+    Args:
+        session (AsyncSession): The session of the repository.
+        execute (Callable): Runs a statement on it.
+        tickets (Dict[str, User]): The users to create by ticket, in spooling order.
+
+    Returns:
+        Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+    """
+    if not tickets:
+        return {}
+    recorded = await execute(
+        select(CreateTicketInDB.ticket, CreateTicketInDB.outcome)
+        .where(CreateTicketInDB.ticket == any_(bindparam("tickets", list(tickets),
+                                                         type_=ARRAY(String)))))
+    outcomes: Dict[str, str] = dict(recorded.all())
+    fresh = {ticket: user for ticket, user in tickets.items() if ticket not in outcomes}
+    emails = list({user.email for user in fresh.values()})
+    taken = set((await execute(select(UserInDB.email).where(
+        UserInDB.email == any_(bindparam("emails", emails, type_=ARRAY(String)))))).scalars())
+    rows: Dict[str, Dict[str, Any]] = {}
+    for user in fresh.values():
+        if user.email not in taken:
+            rows.setdefault(user.email, user.model_dump())
+    inserted = await _insert_new_users(session, execute, list(rows.values()))
+    for ticket, user in fresh.items():
+        created = user.email in inserted
+        inserted.discard(user.email)
+        outcomes[ticket] = TICKET_CREATED if created else TICKET_DUPLICATE
+    if fresh:
+        await execute(insert(CreateTicketInDB).values(
+            [{"ticket": ticket, "email": user.email, "outcome": outcomes[ticket]}
+             for ticket, user in fresh.items()]))
+    return outcomes
+
+
+async def _insert_new_users(session: AsyncSession, execute: Callable,
+                            rows: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Insert users unless their email was taken meanwhile, in chunks of UPSERT_CHUNK_ROWS.
+
+    Args:
+        session (AsyncSession): The session of the repository.
+        execute (Callable): Runs a statement on it.
+        rows (List[Dict[str, Any]]): The users, one per email.
+
+    Returns:
+        Set[str]: The emails inserted.
+    """
+    inserted: Set[str] = set()
+    if rows:
+        await label_cache.ensure(session, rows, execute)
+    for start in range(0, len(rows), UPSERT_CHUNK_ROWS):
+        statement = insert(UserInDB).values(rows[start:start + UPSERT_CHUNK_ROWS]) \
+            .on_conflict_do_nothing(index_elements=UPSERT_CONFLICT_COLUMNS) \
+            .returning(UserInDB.email)
+        inserted.update((await execute(statement)).scalars())
+    return inserted
+
+
+async def sql_fail_ticketed(execute: Callable, tickets: Dict[str, User]) -> None:
+    """
+    Record spooled tickets as failed, unless they already have an outcome.
+
+    Args:
+        execute (Callable): Runs a statement on the session of the repository.
+        tickets (Dict[str, User]): The users that could not be created, by ticket.
+    """
+    if tickets:
+        # The email may be the value that did not fit in user_table.
+        await execute(insert(CreateTicketInDB).values(
+            [{"ticket": ticket, "email": user.email[:128], "outcome": TICKET_FAILED}
+             for ticket, user in tickets.items()])
+            .on_conflict_do_nothing(index_elements=[CreateTicketInDB.ticket]))
+
+
+async def sql_get_ticket_outcome(execute: Callable, ticket: str) -> Optional[str]:
+    """
+    Retrieve the outcome of a spooled ticket by its primary key.
+
+    Args:
+        execute (Callable): Runs a statement on the session of the repository.
+        ticket (str): The ticket.
+
+    Returns:
+        Optional[str]: TICKET_CREATED, TICKET_DUPLICATE or TICKET_FAILED, or None if
+            not recorded.
+    """
+    result = await execute(select(CreateTicketInDB.outcome)
+                           .where(CreateTicketInDB.ticket == ticket))
+    return result.scalar_one_or_none()
+
+
+async def sql_prune_ticket_outcomes(execute: Callable, before: datetime) -> int:
+    """
+    Delete the outcomes recorded before a time, by the create_ticket_resolved_at index.
+
+    Args:
+        execute (Callable): Runs a statement on the session of the repository.
+        before (datetime): The oldest outcome to keep.
+
+    Returns:
+        int: The number of outcomes deleted.
+    """
+    result = await execute(delete(CreateTicketInDB).where(CreateTicketInDB.resolved_at < before))
+    return result.rowcount
+
+
+async def memory_create_ticketed(repository: InMemoryUserRepository,
+                                 tickets: Dict[str, User]) -> Dict[str, str]:
+    """
+    Create the users of spooled tickets in an in-memory repository.
+
+    Args:
+        repository (InMemoryUserRepository): The repository.
+        tickets (Dict[str, User]): The users to create by ticket, in spooling order.
+
+    Returns:
+        Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+    """
+    for ticket, user in tickets.items():
+        if ticket in repository.tickets:
+            continue
+        if user.email in repository.data:
+            repository.tickets[ticket] = (TICKET_DUPLICATE, datetime.now(timezone.utc))
+        else:
+            await repository.save(user)
+            repository.tickets[ticket] = (TICKET_CREATED, datetime.now(timezone.utc))
+    return {ticket: repository.tickets[ticket][0] for ticket in tickets}
+
+
+def memory_fail_ticketed(repository: InMemoryUserRepository, tickets: Dict[str, User]) -> None:
+    """
+    Record spooled tickets as failed in an in-memory repository, unless they have an outcome.
+
+    Args:
+        repository (InMemoryUserRepository): The repository.
+        tickets (Dict[str, User]): The users that could not be created, by ticket.
+    """
+    for ticket in tickets:
+        repository.tickets.setdefault(ticket, (TICKET_FAILED, datetime.now(timezone.utc)))
+
+
+def memory_prune_ticket_outcomes(repository: InMemoryUserRepository, before: datetime) -> int:
+    """
+    Forget the outcomes an in-memory repository recorded before a time.
+
+    Args:
+        repository (InMemoryUserRepository): The repository.
+        before (datetime): The oldest outcome to keep.
+
+    Returns:
+        int: The number of outcomes forgotten.
+    """
+    pruned = [ticket for ticket, (_, resolved_at) in repository.tickets.items()
+              if resolved_at < before]
+    for ticket in pruned:
+        del repository.tickets[ticket]
+    return len(pruned)
@@ -0,0 +1,708 @@
+"""
+Per-process caches of users, kept coherent across processes.
+
+Every API process caches the users it read by email, and the results of
+/find (see find_cache), so a write made by one process must evict the
+entries of all the others. Writes are announced on an invalidation bus as
+changes, dicts with the op and email of the row and, when they are known,
+its name, country and status, and each process evicts what they make stale:
+
+- "postgres" (the default) listens to the user_changes notifications that
+  the user_table triggers send from the database itself, so every write is
+  heard, whichever process or tool made it, with the values of the row.
+- "unix" is for single-host deployments: each process binds a datagram
+  socket in INVALIDATION_SOCKET_DIR and the writing process sends the
+  changes it made to every other socket once its transaction is committed.
+
+A read that started before an invalidation must not put what it read into
+a cache afterwards. The caches count invalidations in a generation number:
+a read takes the generation before querying, and its result is only cached
+if nothing it may have read was invalidated since.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import OrderedDict
+from typing import (AsyncContextManager, AsyncIterator, Callable, Dict, Iterable, List, Optional,
+                    Tuple)
+from contextlib import asynccontextmanager
+
+import orjson
+
+from find_cache import FIND_CACHE_BYTES, FindCache
+from changes import LOST_CHANGE, RESET_CHANGE, ChangeFeed, ChangeFeedUnavailable, change_feed
+from tickets import TICKET_CREATED
+from user_repository import (User, UserFilter, UserRepository, UserRepositoryDecorator, UserUpdate)
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "0"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+INVALIDATION_TRANSPORT = os.getenv("INVALIDATION_TRANSPORT", "postgres")
+INVALIDATION_SOCKET_DIR = os.getenv("INVALIDATION_SOCKET_DIR", "/tmp/user-invalidation")
+# Seconds before listening is tried again after it failed; the cache is bypassed meanwhile.
+BUS_RETRY_SECONDS = 5.0
+# Changes per datagram, well below the default socket buffer size.
+DATAGRAM_CHANGES = 100
+SEND_ATTEMPTS = 5
+
+
+class UserCache:
+    """
+    A bounded LRU cache of users and their versions, by email.
+
+    Entries also expire USER_CACHE_TTL seconds after they were cached, which
+    bounds how stale an entry can get if an invalidation is ever lost.
+    """
+
+    def __init__(self, max_entries: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        """
+        Start empty, at generation 0.
+
+        Args:
+            max_entries (int): Users kept at most.
+            ttl (float): Seconds an entry is served for.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Tuple[User, int], float]]" = OrderedDict()
+        # The generation each recently invalidated email was invalidated at.
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        # Reads that started before this generation may have missed an invalidation.
+        self._floor = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def get(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Look up a user.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not cached.
+        """
+        cached = self._entries.get(email)
+        if cached is None or cached[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(email)
+        self.hits += 1
+        return cached[0]
+
+    def token(self) -> int:
+        """
+        Take the generation before reading from the database.
+
+        Returns:
+            int: The token to pass to fill.
+        """
+        return self.generation
+
+    def fill(self, email: str, entry: Tuple[User, int], token: int) -> bool:
+        """
+        Cache what a read returned, unless the email was invalidated since it started.
+
+        Args:
+            email (str): The email of the user.
+            entry (Tuple[User, int]): The user and its version.
+            token (int): The token taken before the read.
+
+        Returns:
+            bool: Whether the user was cached.
+        """
+        if token < self._floor or self._invalidated.get(email, -1) > token:
+            self.rejected += 1
+            return False
+        self._entries[email] = (entry, time.monotonic() + self.ttl)
+        self._entries.move_to_end(email)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def invalidate(self, emails: Iterable[str]) -> None:
+        """
+        Evict users that were written, and reject the fills of reads in flight.
+
+        Args:
+            emails (Iterable[str]): The emails of the users.
+        """
+        self.generation += 1
+        for email in emails:
+            self._entries.pop(email, None)
+            self._invalidated[email] = self.generation
+            self._invalidated.move_to_end(email)
+        # Only recent invalidations are remembered; older reads are rejected as a whole.
+        while len(self._invalidated) > max(self.max_entries, 1):
+            _, generation = self._invalidated.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+    def clear(self) -> None:
+        """
+        Evict every user, and reject the fills of every read in flight.
+        """
+        self.generation += 1
+        self._entries.clear()
+        self._invalidated.clear()
+        self._floor = self.generation
+
+    def on_change(self, change: dict) -> None:
+        """
+        Evict the user a change was made to.
+
+        Args:
+            change (dict): A change heard on the invalidation bus.
+        """
+        self.invalidate([change["email"]])
+
+    @staticmethod
+    def knows(change: dict) -> bool:
+        """
+        Tell whether on_change evicts exactly what a change makes stale: always, from the email.
+
+        Args:
+            change (dict): A change heard on the invalidation bus.
+
+        Returns:
+            bool: True.
+        """
+        return "email" in change
+
+    def snapshot(self) -> dict:
+        """
+        Describe the cache.
+
+        Returns:
+            dict: Cached users, hits, misses, LRU evictions, fills rejected
+                because of an invalidation and the generation.
+        """
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "rejected": self.rejected,
+                "generation": self.generation}
+
+
+class _InvalidationBus:
+    """
+    What both transports share: the caches of the process.
+    """
+
+    def __init__(self, caches: list):
+        """
+        Initialize with the caches to keep coherent.
+
+        Args:
+            caches (list): UserCache and FindCache instances.
+        """
+        self.caches = caches
+
+    def apply(self, changes: Optional[List[dict]]) -> None:
+        """
+        Evict what changes make stale from every cache.
+
+        Args:
+            changes (Optional[List[dict]]): The changes, or None to clear every cache.
+        """
+        for cache in self.caches:
+            if changes is None:
+                cache.clear()
+            else:
+                for change in changes:
+                    cache.on_change(change)
+
+
+class PostgresInvalidationBus(_InvalidationBus):
+    """
+    Hears every write from the user_changes notifications of the database.
+
+    The triggers notify when the writing transaction commits, with the values
+    of the row, so nothing is sent. The writing process evicts at once what
+    it can evict exactly from the changes it made, and the rest when the
+    notifications arrive. While a listening connection is down, the caches
+    are bypassed, and they are cleared once it is opened again.
+    """
+
+    def __init__(self, caches: list, feed: ChangeFeed = change_feed):
+        """
+        Initialize without listening yet.
+
+        Args:
+            caches (list): UserCache and FindCache instances.
+            feed (ChangeFeed): The feed of the user_changes notifications.
+        """
+        super().__init__(caches)
+        self.feed = feed
+        self.listening = False
+        self._watching = False
+        # Listening connections lost and not opened again yet.
+        self._lost = 0
+        self._retry_at = 0.0
+        self._starting: Optional[asyncio.Future] = None
+
+    async def start(self) -> bool:
+        """
+        Start listening unless it is already, or failed less than BUS_RETRY_SECONDS ago.
+
+        Returns:
+            bool: Whether invalidations are heard, so the caches can be used.
+        """
+        if self.listening or self._watching:
+            return self.listening
+        if self._starting is None:
+            if time.monotonic() < self._retry_at:
+                return False
+            self._starting = asyncio.ensure_future(self._start())
+        return await asyncio.shield(self._starting)
+
+    async def _start(self) -> bool:
+        """
+        Watch the feed.
+
+        Returns:
+            bool: Whether the feed could be listened to.
+        """
+        try:
+            await self.feed.watch(self._on_change)
+        except ChangeFeedUnavailable as error:
+            logger.warning("Caches bypassed, invalidations cannot be heard: %s", error)
+            self._retry_at = time.monotonic() + BUS_RETRY_SECONDS
+            return False
+        finally:
+            self._starting = None
+        self.apply(None)
+        self._watching = self.listening = True
+        return True
+
+    def _on_change(self, change: dict) -> None:
+        """
+        Evict what a notification makes stale.
+
+        Args:
+            change (dict): The notification, LOST_CHANGE or RESET_CHANGE.
+        """
+        if change is LOST_CHANGE:
+            self._lost += 1
+        elif change is RESET_CHANGE:
+            self._lost -= 1
+        if change is LOST_CHANGE or change is RESET_CHANGE or change["op"] in ("truncate", "reset"):
+            self.apply(None)
+            self.listening = self._lost == 0
+        else:
+            self.apply([change])
+
+    async def publish(self, changes: Optional[List[dict]]) -> None:
+        """
+        Evict at once what the changes of this process make stale, where it is exact.
+
+        Args:
+            changes (Optional[List[dict]]): The changes made, or None for changes to any user.
+        """
+        for cache in self.caches:
+            for change in changes or []:
+                if cache.knows(change):
+                    cache.on_change(change)
+
+    def stop(self) -> None:
+        """
+        Stop listening.
+        """
+        self.listening = self._watching = False
+        self._lost = 0
+        self.feed.unwatch(self._on_change)
+
+
+class UnixSocketInvalidationBus(_InvalidationBus):
+    """
+    Sends the changes made by a process to the other processes of the host.
+
+    Each process binds a datagram socket named after its pid in the socket
+    directory when it first uses the cache, so workers forked by gunicorn
+    each get theirs. A socket nobody receives on any more is removed by the
+    first process failing to send to it.
+    """
+
+    def __init__(self, caches: list, directory: str = INVALIDATION_SOCKET_DIR,
+                 name: Optional[str] = None):
+        """
+        Initialize without a socket yet.
+
+        Args:
+            caches (list): UserCache and FindCache instances.
+            directory (str): The directory shared by the processes of the host.
+            name (Optional[str]): The name of the socket, the pid of the process by default.
+        """
+        super().__init__(caches)
+        self.directory = directory
+        self.name = name
+        self.path: Optional[str] = None
+        self._socket: Optional[socket.socket] = None
+        self.listening = False
+        self.dropped = 0
+
+    async def start(self) -> bool:
+        """
+        Bind the socket of this process unless it is bound.
+
+        Returns:
+            bool: Always True, the socket is local.
+        """
+        if self.listening:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{self.name or os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._socket.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._socket.fileno(), self._receive)
+        self.apply(None)
+        self.listening = True
+        return True
+
+    def _receive(self) -> None:
+        """
+        Evict what the changes of every datagram waiting on the socket make stale.
+        """
+        while True:
+            try:
+                datagram = self._socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.apply(orjson.loads(datagram))  # pylint: disable=no-member
+
+    async def publish(self, changes: Optional[List[dict]]) -> None:
+        """
+        Evict what the changes of this process make stale, here and in every other process.
+
+        Args:
+            changes (Optional[List[dict]]): The changes made, or None to clear every cache.
+        """
+        await self.start()
+        self.apply(changes)
+        chunks = ([None] if changes is None else
+                  [changes[start:start + DATAGRAM_CHANGES]
+                   for start in range(0, len(changes), DATAGRAM_CHANGES)])
+        datagrams = [orjson.dumps(chunk) for chunk in chunks]  # pylint: disable=no-member
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path != self.path and name.endswith(".sock"):
+                for datagram in datagrams:
+                    if not await self._send(path, datagram):
+                        break
+
+    async def _send(self, path: str, datagram: bytes) -> bool:
+        """
+        Send a datagram, waiting a little while the receiver's queue is full.
+
+        Args:
+            path (str): The socket of the receiving process.
+            datagram (bytes): The encoded changes.
+
+        Returns:
+            bool: Whether the receiver is still there.
+        """
+        for attempt in range(SEND_ATTEMPTS):
+            try:
+                self._socket.sendto(datagram, path)
+                return True
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The process is gone; whoever notices first removes its socket.
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                return False
+            except BlockingIOError:
+                await asyncio.sleep(0.001 * 2 ** attempt)
+        self.dropped += 1
+        logger.warning("Invalidation dropped, %s does not keep up", path)
+        return True
+
+    def stop(self) -> None:
+        """
+        Close and remove the socket of this process.
+        """
+        if self.listening:
+            asyncio.get_running_loop().remove_reader(self._socket.fileno())
+            self._socket.close()
+            os.unlink(self.path)
+            self.listening = False
+
+
+def create_invalidation_bus(caches: list, transport: str = INVALIDATION_TRANSPORT):
+    """
+    Build the bus of the configured transport.
+
+    Args:
+        caches (list): UserCache and FindCache instances.
+        transport (str): "postgres" or "unix".
+
+    Returns:
+        Union[PostgresInvalidationBus, UnixSocketInvalidationBus]: The bus.
+
+    Raises:
+        ValueError: If the transport is unknown.
+    """
+    if transport == "postgres":
+        return PostgresInvalidationBus(caches)
+    if transport == "unix":
+        return UnixSocketInvalidationBus(caches)
+    raise ValueError(f"Unknown INVALIDATION_TRANSPORT {transport!r}, expected postgres or unix")
+
+
+def user_change(operation: str, user: User) -> dict:
+    """
+    Describe a change made to a user whose values are known.
+
+    Args:
+        operation (str): "insert", or "upsert" when the previous values are not known.
+        user (User): The user written.
+
+    Returns:
+        dict: The change, without the password.
+    """
+    return {"op": operation, "email": user.email, "name": user.name, "country": user.country,
+            "status": user.status}
+
+
+class CachingUserRepository(UserRepositoryDecorator):
+    """
+    A repository serving lookups by email from the cache of the process.
+
+    The changes made through it are published on the invalidation bus once
+    it exits and its transaction is committed. Writes by filter publish a
+    change to every user. When the bus cannot be listened to, the cache is
+    bypassed.
+    """
+
+    def __init__(self, repository: UserRepository, cache: UserCache, bus):
+        """
+        Initialize with the repository that runs the queries.
+
+        Args:
+            repository (UserRepository): The decorated repository.
+            cache (UserCache): The cache of the process.
+            bus (Union[PostgresInvalidationBus, UnixSocketInvalidationBus]): Its invalidation bus.
+        """
+        super().__init__(repository)
+        self._cache = cache
+        self._bus = bus
+        self._changes: Dict[str, dict] = {}
+        self._changed_all = False
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit the decorated repository, then publish the changes made.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        try:
+            await self._repository.__aexit__(exc_type, exc_value, exc_traceback)
+        finally:
+            # Published even on a rollback: statements run before it may have been committed.
+            if self._changed_all:
+                await self._bus.publish(None)
+            elif self._changes:
+                await self._bus.publish(list(self._changes.values()))
+            self._changes = {}
+            self._changed_all = False
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version from the cache, or from the database.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        if not await self._bus.start():
+            return await self._repository.get_versioned_by_email(email)
+        cached = self._cache.get(email)
+        if cached is not None:
+            return cached
+        token = self._cache.token()
+        versioned_user = await self._repository.get_versioned_by_email(email)
+        if versioned_user is not None:
+            self._cache.fill(email, versioned_user, token)
+        return versioned_user
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user from the cache, or from the database.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        versioned_user = await self.get_versioned_by_email(email)
+        return versioned_user[0] if versioned_user else None
+
+    async def get_version(self, email: str) -> Optional[int]:
+        """
+        Retrieve the version of a cached user, or ask the database.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            Optional[int]: The version, or None if not found.
+        """
+        cached = self._cache.get(email) if await self._bus.start() else None
+        if cached is not None:
+            return cached[1]
+        return await self._repository.get_version(email)
+
+    async def save(self, user: User) -> None:
+        """
+        Save a user and record its insert.
+
+        Args:
+            user (User): The user to save.
+        """
+        self._changes[user.email] = user_change("insert", user)
+        await self._repository.save(user)
+
+    async def upsert(self, user: User) -> User:
+        """
+        Insert or update a user and record the change.
+
+        Args:
+            user (User): The user to insert or update.
+
+        Returns:
+            User: The user as stored.
+        """
+        self._changes[user.email] = user_change("upsert", user)
+        return await self._repository.upsert(user)
+
+    async def upsert_many(self, users: List[User]) -> List[User]:
+        """
+        Insert or update users and record their changes.
+
+        Args:
+            users (List[User]): The users to insert or update.
+
+        Returns:
+            List[User]: The users as stored.
+        """
+        self._changes.update((user.email, user_change("upsert", user)) for user in users)
+        return await self._repository.upsert_many(users)
+
+    async def update(self, email: str, changes: UserUpdate) -> Optional[User]:
+        """
+        Update a user and record the change.
+
+        Args:
+            email (str): The email of the user to update.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            Optional[User]: The updated user, or None if not found.
+        """
+        self._changes[email] = {"op": "update", "email": email}
+        return await self._repository.update(email, changes)
+
+    async def update_where(self, user_filter: UserFilter, changes: UserUpdate) -> int:
+        """
+        Update the users matching a filter and record a change to every user.
+
+        Args:
+            user_filter (UserFilter): The users to update.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            int: The number of users updated.
+        """
+        self._changed_all = True
+        return await self._repository.update_where(user_filter, changes)
+
+    async def delete(self, email: str) -> bool:
+        """
+        Delete a user and record the deletion.
+
+        Args:
+            email (str): The email of the user to delete.
+
+        Returns:
+            bool: Whether the user existed.
+        """
+        self._changes[email] = {"op": "delete", "email": email}
+        return await self._repository.delete(email)
+
+    async def delete_batch(self, user_filter: UserFilter, after_id: int,
+                           batch_size: int) -> Tuple[int, Optional[int]]:
+        """
+        Delete a batch of the users matching a filter and record a change to every user.
+
+        Args:
+            user_filter (UserFilter): The users to delete.
+            after_id (int): Only users with a greater id are deleted.
+            batch_size (int): Users deleted at most.
+
+        Returns:
+            Tuple[int, Optional[int]]: The number of users deleted and the
+                greatest id deleted, None if none was.
+        """
+        self._changed_all = True
+        return await self._repository.delete_batch(user_filter, after_id, batch_size)
+
+    async def create_ticketed(self, tickets: Dict[str, User]) -> Dict[str, str]:
+        """
+        Create the users of spooled tickets and record the inserts of those created.
+
+        Args:
+            tickets (Dict[str, User]): The users to create by ticket.
+
+        Returns:
+            Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+        """
+        outcomes = await self._repository.create_ticketed(tickets)
+        created = [user for ticket, user in tickets.items() if outcomes[ticket] == TICKET_CREATED]
+        self._changes.update((user.email, user_change("insert", user)) for user in created)
+        return outcomes
+
+
+user_cache = UserCache()
+find_cache = FindCache()
+invalidation_bus = create_invalidation_bus([user_cache, find_cache])
+# Writes are published whenever a cache is enabled, even if this process only writes.
+CACHES_ENABLED = bool(USER_CACHE_SIZE or FIND_CACHE_BYTES)
+
+
+def coherent_factory(
+        factory: Callable[[], AsyncContextManager[UserRepository]]
+) -> Callable[[], AsyncContextManager[UserRepository]]:
+    """
+    Make the repositories of a factory publish what they write when a cache is enabled.
+
+    Args:
+        factory (Callable[[], AsyncContextManager[UserRepository]]): Opens a repository.
+
+    Returns:
+        Callable[[], AsyncContextManager[UserRepository]]: Opens the same
+            repository, decorated with CachingUserRepository.
+    """
+    if not CACHES_ENABLED:
+        return factory
+
+    @asynccontextmanager
+    async def open_coherent_repository() -> AsyncIterator[UserRepository]:
+        async with factory() as repository:
+            async with CachingUserRepository(repository, user_cache, invalidation_bus) as caching:
+                yield caching
+
+    return open_coherent_repository
@@ -1,15 +1,44 @@
 import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from functools import lru_cache
-from typing import Optional, List, AsyncGenerator, Any
-
-from pydantic import BaseModel
-from sqlalchemy import Integer, String, NullPool, select
-from sqlalchemy.exc import DatabaseError
+from typing import (Any, AsyncContextManager, AsyncGenerator, AsyncIterator, Callable, Dict, List,
+                    Optional, Tuple)
+
+from pydantic import BaseModel, Field
+from sqlalchemy import (BigInteger, DateTime, Integer, String, NullPool, any_, bindparam, column,
+                        delete, func, literal_column, select, text, tuple_, update)
+from sqlalchemy import table as table_clause
+from sqlalchemy.sql import ColumnElement
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.exc import DatabaseError, DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import Mapped, declarative_base, mapped_column
 
+from labels import ENUM_TYPES, EnumLabel, Label, label_cache
+from partitioning import COUNTRY, USER_TABLE_PARTITIONING
+
 SQL_BASE = declarative_base()
 
+MAX_BATCH_EMAILS = int(os.getenv("MAX_BATCH_EMAILS", "1000"))
+UPSERT_CHUNK_ROWS = 1000
+EXPORT_COLUMNS = ("id", "email", "name", "country", "status", "version")
+# Unique constraints of a partitioned table contain its partition key.
+UPSERT_CONFLICT_COLUMNS = ("email", "country") if USER_TABLE_PARTITIONING == COUNTRY else ("email",)
+# 0 keeps one connection per session (NullPool); above it, connections are pooled
+# and handed back as soon as a read-only call is done.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "0"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Counts the planner expects to cost more than this are estimated instead of run.
+COUNT_EXACT_MAX_COST = float(os.getenv("COUNT_EXACT_MAX_COST", "1000"))
+QUERY_CANCELED = "57014"
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "1000"))
+# "sqlalchemy", or "asyncpg" to serve the hot operations on raw asyncpg.
+USER_REPOSITORY_BACKEND = os.getenv("USER_REPOSITORY_BACKEND", "sqlalchemy")
+# Transactions below this id have all ended, so no row can still be committed behind it.
+CHANGE_HORIZON = select(literal_column("pg_snapshot_xmin(pg_current_snapshot())::text::bigint")) \
+    .scalar_subquery()
+
 
 @lru_cache(maxsize=None)
 def get_engine(db_string: str):
@@ -22,9 +51,42 @@ def get_engine(db_string: str):
     Returns:
         Engine: The SQLAlchemy async engine.
     """
+    if DB_POOL_SIZE > 0:
+        return create_async_engine(db_string, pool_pre_ping=True, pool_size=DB_POOL_SIZE,
+                                   max_overflow=DB_MAX_OVERFLOW)
     return create_async_engine(db_string, pool_pre_ping=True, poolclass=NullPool)
 
 
+@lru_cache(maxsize=None)
+def get_read_only_engine(db_string: str):
+    """
+    Create and cache an autocommit view of the engine for read-only work.
+
+    Statements run without BEGIN and COMMIT, each one in its own implicit
+    transaction, and the connections are shared with get_engine.
+
+    Args:
+        db_string (str): The database connection string.
+
+    Returns:
+        Engine: The SQLAlchemy async engine in autocommit mode.
+    """
+    return get_engine(db_string).execution_options(isolation_level="AUTOCOMMIT")
+
+
+def _clear_engines() -> None:
+    """
+    Forget the cached engines.
+    """
+    get_engine.cache_clear()
+    get_read_only_engine.cache_clear()
+
+
+# An engine must not be shared with a forked worker, so every child process
+# creates its own on first use.
+os.register_at_fork(after_in_child=_clear_engines)
+
+
 class UserInDB(SQL_BASE):
     """
     SQLAlchemy model representing a user in the database.
@@ -35,8 +97,33 @@ class UserInDB(SQL_BASE):
     email: Mapped[str] = mapped_column(String(length=128), unique=True, nullable=False)
     password: Mapped[str] = mapped_column(String(length=128), nullable=False)
     name: Mapped[str] = mapped_column(String(length=128), nullable=True)
-    status: Mapped[str] = mapped_column(String, nullable=True)
-    country: Mapped[str] = mapped_column(String(length=128), nullable=True)
+    status: Mapped[str] = mapped_column(EnumLabel(ENUM_TYPES["status"]), nullable=True)
+    country: Mapped[str] = mapped_column(EnumLabel(ENUM_TYPES["country"]), nullable=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False, server_default="0")
+
+
+# The columns read by get_changes. They are set by the database and left out of
+# UserInDB, so the ORM never writes or loads them.
+USER_CHANGES = table_clause("user_table", column("email"), column("name"), column("country"),
+                            column("status"), column("version", BigInteger),
+                            column("created_at", DateTime(timezone=True)),
+                            column("updated_at", DateTime(timezone=True)),
+                            column("change_xid", BigInteger))
+
+
+class UserTableGeneration(SQL_BASE):
+    """
+    SQLAlchemy model holding the generation counter of user_table.
+
+    A database trigger bumps one row of this table in every statement that
+    writes to user_table, the row of the writing backend's stripe, and the
+    generation is the sum of the rows. Another trigger stamps each written row
+    with a new version, so both markers stay correct across API processes.
+    """
+    __tablename__ = 'user_table_generation'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    generation: Mapped[int] = mapped_column(BigInteger, nullable=False)
 
 
 class User(BaseModel):
@@ -46,17 +133,35 @@ class User(BaseModel):
     Attributes:
         email (str): User email.
         name (str): User name.
-        country (str): User country.
-        status (str): User status.
+        country (str): User country, at most MAX_LABEL_BYTES bytes long.
+        status (str): User status, at most MAX_LABEL_BYTES bytes long.
         password (str): User password.
     """
     email: str
     name: str
-    country: str
-    status: str
+    country: Label
+    status: Label
     password: str
 
 
+def _to_user(user: UserInDB) -> User:
+    """
+    Build a User from a database row without validating it again.
+
+    Rows in user_table were validated when they were saved, so the model is
+    constructed directly from the column values.
+
+    Args:
+        user (UserInDB): The database row.
+
+    Returns:
+        User: The user model.
+    """
+    return User.model_construct(email=user.email, name=user.name,
+                                country=user.country, status=user.status,
+                                password=user.password)
+
+
 class UserFilter(BaseModel):
     """
     Pydantic model for filtering users by criteria.
@@ -72,8 +177,149 @@ class UserFilter(BaseModel):
     by_country: Optional[str] = None
     status: Optional[str] = None
 
+    def matches(self, user: User) -> bool:
+        """
+        Check a user against the criteria, ignoring the limit.
+
+        Args:
+            user (User): The user to check.
+
+        Returns:
+            bool: True if the user satisfies every given criterion.
+        """
+        return ((self.by_name is None or self.by_name == user.name)
+                and (self.by_country is None or self.by_country == user.country)
+                and (self.status is None or self.status == user.status))
+
+
+def _filter_clauses(user_filter: UserFilter) -> List[ColumnElement]:
+    """
+    Translate the criteria of a UserFilter into WHERE clauses, ignoring the limit.
+
+    Args:
+        user_filter (UserFilter): The filter criteria.
+
+    Returns:
+        List[ColumnElement]: One clause per given criterion.
+    """
+    clauses = []
+    if user_filter.by_name is not None:
+        clauses.append(UserInDB.name == user_filter.by_name)
+    if user_filter.by_country is not None:
+        clauses.append(UserInDB.country == user_filter.by_country)
+    if user_filter.status is not None:
+        clauses.append(UserInDB.status == user_filter.status)
+    return clauses
+
+
+class UserUpdate(BaseModel):
+    """
+    Pydantic model for a partial update of a user.
+
+    Fields left out or set to null keep their current value.
+
+    Attributes:
+        name (Optional[str]): New user name.
+        country (Optional[str]): New user country, at most MAX_LABEL_BYTES bytes long.
+        status (Optional[str]): New user status, at most MAX_LABEL_BYTES bytes long.
+        password (Optional[str]): New user password.
+    """
+    name: Optional[str] = None
+    country: Optional[Label] = None
+    status: Optional[Label] = None
+    password: Optional[str] = None
+
+
+class UserCount(BaseModel):
+    """
+    Pydantic model for the number of users matching a filter.
+
+    Attributes:
+        count (int): The number of users.
+        exact (bool): False when the count is an estimate.
+    """
+    count: int
+    exact: bool
+
+
+class UserChange(BaseModel):
+    """
+    Pydantic model for a user as it was last created or updated.
+
+    Attributes:
+        email (str): User email.
+        name (str): User name.
+        country (str): User country.
+        status (str): User status.
+        version (int): Version of the user.
+        created_at (datetime): When the user was created.
+        updated_at (datetime): When the user was last written.
+    """
+    email: str
+    name: str
+    country: str
+    status: str
+    version: int
+    created_at: datetime
+    updated_at: datetime
+
+
+class UserChanges(BaseModel):
+    """
+    Pydantic model for a page of changes.
+
+    Attributes:
+        changes (List[UserChange]): The changed users, in the order they were written.
+        cursor (str): Where the next page starts, to pass as since.
+        more (bool): Whether the next page can be fetched right away.
+    """
+    changes: List[UserChange]
+    cursor: str
+    more: bool
+
+
+def parse_change_cursor(cursor: Optional[str]) -> Tuple[int, int]:
+    """
+    Parse a change cursor, "<transaction id>-<version>".
+
+    Args:
+        cursor (Optional[str]): The cursor, None or empty for the first change.
+
+    Returns:
+        Tuple[int, int]: The transaction id and the version of the last change read.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    if not cursor:
+        return 0, 0
+    xid, separator, version = cursor.partition("-")
+    if not separator or not xid.isdigit() or not version.isdigit():
+        raise ValueError(f"Malformed change cursor {cursor!r}")
+    return int(xid), int(version)
+
+
+class UserBatch(BaseModel):
+    """
+    Pydantic model for a batch of users to write.
+
+    Attributes:
+        users (List[User]): The users to write, at most MAX_BATCH_EMAILS.
+    """
+    users: List[User] = Field(min_length=1, max_length=MAX_BATCH_EMAILS)
+
 
-class UserRepository:
+class EmailBatch(BaseModel):
+    """
+    Pydantic model for a batch of emails to resolve.
+
+    Attributes:
+        emails (List[str]): Emails of the users to retrieve, at most MAX_BATCH_EMAILS.
+    """
+    emails: List[str] = Field(min_length=1, max_length=MAX_BATCH_EMAILS)
+
+
+class UserRepository:  # pylint: disable=too-many-public-methods
     """
     Interface for user repository operations.
     """
@@ -87,7 +333,15 @@ class UserRepository:
         """
         return self
 
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit context for the repository.
 
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
 
     async def save(self, user: User) -> None:
         """
@@ -122,176 +376,1397 @@ class UserRepository:
         """
         raise NotImplementedError()
 
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email.
 
-class SQLUserRepository(UserRepository):
-    """
-    SQL implementation of the UserRepository interface.
-    """
+        Args:
+            email (str): The email of the user to retrieve.
 
-    def __init__(self, session: AsyncSession):
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
         """
-        Initialize with a SQLAlchemy session.
+        raise NotImplementedError()
+
+    async def get_version(self, email: str) -> Optional[int]:
+        """
+        Retrieve the version of a user without loading it.
 
         Args:
-            session (AsyncSession): The SQLAlchemy async session.
+            email (str): The email of the user.
+
+        Returns:
+            Optional[int]: The version of the user, or None if not found.
         """
-        self._session: AsyncSession = session
+        raise NotImplementedError()
 
-    async def __aexit__(self, exc_type, exc_value, exc_traceback: str) -> None:
+    async def get_generation(self) -> int:
         """
-        Exit context for the repository, handle transactions.
+        Retrieve the generation of the user collection.
 
-        Args:
-            exc_type (Optional[Type[BaseException]]): Exception type.
-            exc_value (Optional[BaseException]): Exception value.
-            exc_traceback (Optional[TracebackType]): Exception traceback.
+        The generation changes whenever any user is written.
+
+        Returns:
+            int: The current generation.
         """
-        if any([exc_value, exc_type, exc_traceback]):
-            await self._session.rollback()
-            return
-        try:
-            await self._session.commit()
-        except DatabaseError as error:
-            await self._session.rollback()
-            raise error
+        raise NotImplementedError()
 
-    async def get(self, user_filter: UserFilter) -> List[User]:
+    async def get_many_by_email(self, emails: List[str]) -> List[User]:
         """
-        Get a list of users based on filtering criteria.
+        Retrieve the users with any of the given emails.
 
         Args:
-            user_filter (UserFilter): The filter criteria.
+            emails (List[str]): The emails of the users to retrieve.
 
         Returns:
-            List[User]: List of users matching the filter criteria.
+            List[User]: The users found, emails without a user are left out.
         """
-        statement = select(UserInDB)
-
-        if user_filter.by_name is not None:
-            statement = statement.where(UserInDB.name == user_filter.by_name)
-        if user_filter.by_country is not None:
-            statement = statement.where(UserInDB.country == user_filter.by_country)
-        if user_filter.status is not None:
-            statement = statement.where(UserInDB.status == user_filter.status)
-        if user_filter.limit is not None:
-            statement = statement.limit(user_filter.limit)
-        users_in_db = await self._session.execute(statement)
-        return [
-            User(email=user.email, name=user.name,
-                 country=user.country, status=user.status, password=user.password)
-            for user in users_in_db.scalars()]
+        raise NotImplementedError()
 
-    async def get_by_email(self, email: str) -> Optional[User]:
+    async def get_many_versioned_by_email(self, emails: List[str]) -> Dict[str, Tuple[User, int]]:
         """
-        Retrieve a user by email.
+        Retrieve the users with any of the given emails and their versions.
 
         Args:
-            email (str): The email of the user to retrieve.
+            emails (List[str]): The emails of the users to retrieve.
 
         Returns:
-            Optional[User]: The user with the given email, or None if not found.
+            Dict[str, Tuple[User, int]]: The users found and their versions, keyed by email.
         """
-        result = await self._session.execute(select(UserInDB).where(UserInDB.email == email))
-        user = result.scalars().first()
-        if user:
-            return User(email=user.email, name=user.name,
-                        country=user.country, status=user.status,
-                        password=user.password)
-        return None
+        raise NotImplementedError()
 
-    async def save(self, user: User) -> None:
+    async def upsert(self, user: User) -> User:
         """
-        Save a user.
+        Create a user, or update the user with the same email.
 
         Args:
-            user (User): The user to save.
+            user (User): The user to write.
+
+        Returns:
+            User: The stored user.
         """
-        self._session.add(UserInDB(email=user.email, name=user.name,
-                                   country=user.country, status=user.status,
-                                   password=user.password))
+        raise NotImplementedError()
 
-        await self._session.commit()
+    async def upsert_many(self, users: List[User]) -> List[User]:
+        """
+        Create or update several users.
 
+        When the same email appears more than once, the last user wins.
 
-async def create_user_repository() -> AsyncGenerator[SQLUserRepository, Any]:
-    """
-    Create a SQLUserRepository instance within an async context.
+        Args:
+            users (List[User]): The users to write.
 
-    Returns:
-        AsyncGenerator[SQLUserRepository, Any]:
-        An asynchronous generator yielding a SQLUserRepository.
-    """
-    async with AsyncSession(get_engine(os.getenv("DB_STRING"))) as session:
-        try:
-            user_repository = SQLUserRepository(session)
+        Returns:
+            List[User]: The stored users.
+        """
+        raise NotImplementedError()
 
-            yield user_repository
-        except Exception:
-            await session.rollback()
-            raise
-        finally:
-            await session.close()
+    async def update(self, email: str, changes: UserUpdate) -> Optional[User]:
+        """
+        Update the given fields of a user.
+
+        Args:
+            email (str): The email of the user to update.
+            changes (UserUpdate): The fields to change.
 
+        Returns:
+            Optional[User]: The updated user, or None if not found.
+        """
+        raise NotImplementedError()
 
-class InMemoryUserRepository:
-    """
-    In-memory implementation of the UserRepository interface (for unit tests).
-    """
+    async def update_where(self, user_filter: UserFilter, changes: UserUpdate) -> int:
+        """
+        Update the given fields of every user matching a filter.
 
-    async def __aenter__(self):
+        Args:
+            user_filter (UserFilter): The filter criteria; the limit caps the number
+                of updated users.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            int: The number of updated users.
         """
-        Enter context for the in-memory repository.
+        raise NotImplementedError()
+
+    async def delete(self, email: str) -> bool:
+        """
+        Delete a user.
+
+        Args:
+            email (str): The email of the user to delete.
 
         Returns:
-            InMemoryUserRepository: The repository instance.
+            bool: True if the user existed.
         """
-        return self
+        raise NotImplementedError()
 
+    async def delete_batch(self, user_filter: UserFilter, after_id: int,
+                           batch_size: int) -> Tuple[int, Optional[int]]:
+        """
+        Delete the next batch of users matching a filter, in id order.
 
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            after_id (int): Only users with a greater id are deleted.
+            batch_size (int): Maximum number of users to delete.
 
-    def __init__(self):
+        Returns:
+            Tuple[int, Optional[int]]: The number of deleted users and the
+            greatest deleted id, None when nothing was left to delete.
         """
-        Initialize the in-memory user repository.
+        raise NotImplementedError()
+
+    async def stream_rows(self, user_filter: UserFilter, columns: List[str],
+                          chunk_size: int) -> AsyncIterator[List[tuple]]:
         """
-        self.data = {}
+        Stream the matching users as tuples of the requested columns, chunk by chunk.
 
-    async def save(self, user: User) -> None:
+        Args:
+            user_filter (UserFilter): The filter criteria.
+            columns (List[str]): Names from EXPORT_COLUMNS, in output order.
+            chunk_size (int): Maximum number of rows per chunk.
+
+        Returns:
+            AsyncIterator[List[tuple]]: The chunks of rows.
         """
-        Save a user to the in-memory repository.
+        raise NotImplementedError()
+
+    async def count(self, user_filter: UserFilter, budget: float) -> UserCount:
+        """
+        Count the users matching a filter, or estimate their number.
 
         Args:
-            user (User): The user to save.
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            budget (float): Seconds an exact count may take at most.
+
+        Returns:
+            UserCount: The count and whether it is exact.
         """
-        self.data[user.email] = user
+        raise NotImplementedError()
 
-    async def get_by_email(self, email: str) -> Optional[User]:
+    async def get_changes(self, since: Optional[str], limit: int) -> UserChanges:
         """
-        Retrieve a user by email from the in-memory repository.
+        Get the users created or updated after a cursor, in the order they were written.
 
         Args:
-            email (str): The email of the user to retrieve.
+            since (Optional[str]): The cursor returned with the previous page, None for
+                the first page.
+            limit (int): Maximum number of changes.
 
         Returns:
-            Optional[User]: The user with the given email, or None if not found.
+            UserChanges: The changes and the cursor of the next page.
+
+        Raises:
+            ValueError: If the cursor is malformed.
         """
-        return self.data.get(email)
+        raise NotImplementedError()
 
-    async def get(self, user_filter: UserFilter) -> List[User]:
+    async def create_ticketed(self, tickets: Dict[str, User]) -> Dict[str, str]:
         """
-        Retrieve users from the in-memory repository based on filters.
+        Create the users of spooled tickets and record the outcome of every ticket.
+
+        A user whose email is already taken, by an existing user or by an
+        earlier ticket of the batch, is not created. A ticket already
+        recorded keeps its outcome, so a batch can be replayed.
 
         Args:
-            user_filter (UserFilter): The filter criteria.
+            tickets (Dict[str, User]): The users to create by ticket, in spooling order.
 
         Returns:
-            List[User]: List of users matching the filter criteria.
+            Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+        """
+        raise NotImplementedError()
+
+    async def fail_ticketed(self, tickets: Dict[str, User]) -> None:
         """
-        all_matching_users = filter(
-            lambda user: (not user_filter.status or user_filter.status == user.status)
-                         and (not user_filter.by_name or user_filter.by_name == user.name)
-                         and (not user_filter.by_country or user_filter.by_country == user.country),
+        Record spooled tickets whose users cannot be created as failed.
 
-            self.data.values(),
-        )
+        A ticket already recorded keeps its outcome.
 
-        return list(all_matching_users)[: user_filter.limit]
+        Args:
+            tickets (Dict[str, User]): The users that could not be created, by ticket.
+        """
+        raise NotImplementedError()
+
+    async def get_ticket_outcome(self, ticket: str) -> Optional[str]:
+        """
+        Retrieve the outcome of a spooled ticket.
+
+        Args:
+            ticket (str): The ticket.
+
+        Returns:
+            Optional[str]: TICKET_CREATED, TICKET_DUPLICATE or TICKET_FAILED, or None if
+                not recorded.
+        """
+        raise NotImplementedError()
+
+    async def prune_ticket_outcomes(self, before: datetime) -> int:
+        """
+        Forget the outcomes recorded before a time.
+
+        Args:
+            before (datetime): The oldest outcome to keep.
+
+        Returns:
+            int: The number of outcomes forgotten.
+        """
+        raise NotImplementedError()
+
+
+class SQLUserRepository(UserRepository):  # pylint: disable=too-many-public-methods
+    """
+    SQL implementation of the UserRepository interface.
+
+    The session only checks a connection out on the first query, so a
+    repository that is never queried never touches the database. With a
+    pooled engine, the connection is handed back as soon as a read-only call
+    is done instead of being held until the end of the request.
+
+    A read-only repository is meant for a session bound to
+    get_read_only_engine: its statements run in autocommit, so there is no
+    transaction to commit or roll back when it is closed.
+    """
+
+    def __init__(self, session: AsyncSession, read_only: bool = False):
+        """
+        Initialize with a SQLAlchemy session.
+
+        Args:
+            session (AsyncSession): The SQLAlchemy async session.
+            read_only (bool): Whether the repository is only read, in autocommit.
+        """
+        self._session: AsyncSession = session
+        self.read_only = read_only
+        self.queries = 0
+        # Under NullPool a released connection is closed, and the next read
+        # would have to connect again, so it is kept until the end.
+        self._release_reads = not isinstance(getattr(session.bind, "pool", None), NullPool)
+
+    async def _execute(self, statement, parameters=None):
+        """
+        Execute a statement, checking a connection out if none is held yet.
+
+        Args:
+            statement (Executable): The statement.
+            parameters (Optional[Any]): Its parameters, if any.
+
+        Returns:
+            Result: The result of the statement.
+        """
+        self.queries += 1
+        return await self._session.execute(statement, parameters)
+
+    async def _release(self) -> None:
+        """
+        Hand the connection back to the pool after read-only work.
+
+        Nothing is released while the session holds changes to write.
+        """
+        if (self._release_reads and self._session.in_transaction()
+                and not (self._session.new or self._session.dirty or self._session.deleted)):
+            await self._session.rollback()
+
+    async def _labels_exist(self, user_filter: UserFilter) -> bool:
+        """
+        Tell whether the status and country of a filter can match any user.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            bool: False if the filter names a status or country no user ever had.
+        """
+        return await label_cache.exist(self._session, {"country": user_filter.by_country,
+                                                       "status": user_filter.status},
+                                       self._execute)
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback: str) -> None:
+        """
+        Exit context for the repository, handle transactions.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        if self.read_only:
+            return
+        if any([exc_value, exc_type, exc_traceback]):
+            await self._session.rollback()
+            return
+        try:
+            await self._session.commit()
+        except DatabaseError as error:
+            await self._session.rollback()
+            raise error
+
+    async def get(self, user_filter: UserFilter) -> List[User]:
+        """
+        Get a list of users based on filtering criteria.
+
+        The criteria are plain equalities, so with the country layout a filter
+        on country is pruned to the partition of that country.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            List[User]: List of users matching the filter criteria.
+        """
+        if not await self._labels_exist(user_filter):
+            await self._release()
+            return []
+        statement = select(UserInDB).where(*_filter_clauses(user_filter))
+        if user_filter.limit is not None:
+            statement = statement.limit(user_filter.limit)
+        users_in_db = await self._execute(statement)
+        users = [_to_user(user) for user in users_in_db.scalars()]
+        await self._release()
+        return users
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by email.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        result = await self._execute(select(UserInDB).where(UserInDB.email == email))
+        user = result.scalars().first()
+        found = _to_user(user) if user else None
+        await self._release()
+        return found
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        result = await self._execute(select(UserInDB).where(UserInDB.email == email))
+        user = result.scalars().first()
+        found = (_to_user(user), user.version) if user else None
+        await self._release()
+        return found
+
+    async def get_version(self, email: str) -> Optional[int]:
+        """
+        Retrieve the version of a user without loading it.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            Optional[int]: The version of the user, or None if not found.
+        """
+        result = await self._execute(
+            select(UserInDB.version).where(UserInDB.email == email))
+        version = result.scalar()
+        await self._release()
+        return version
+
+    async def get_generation(self) -> int:
+        """
+        Retrieve the generation of user_table.
+
+        Returns:
+            int: The current generation, 0 if no counter row exists.
+        """
+        result = await self._execute(
+            select(func.sum(UserTableGeneration.generation).cast(BigInteger)))
+        generation = result.scalar() or 0
+        await self._release()
+        return generation
+
+    async def get_many_by_email(self, emails: List[str]) -> List[User]:
+        """
+        Retrieve the users with any of the given emails in one query.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            List[User]: The users found, emails without a user are left out.
+        """
+        return [user for user, _ in (await self.get_many_versioned_by_email(emails)).values()]
+
+    async def get_many_versioned_by_email(self, emails: List[str]) -> Dict[str, Tuple[User, int]]:
+        """
+        Retrieve the users with any of the given emails and their versions in one query.
+
+        The emails are bound as a single array parameter (email = ANY($1)),
+        so every batch size shares the same prepared statement.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            Dict[str, Tuple[User, int]]: The users found and their versions, keyed by email.
+        """
+        statement = select(UserInDB).where(
+            UserInDB.email == any_(bindparam("emails", list(set(emails)), type_=ARRAY(String))))
+        result = await self._execute(statement)
+        found = {user.email: (_to_user(user), user.version) for user in result.scalars()}
+        await self._release()
+        return found
+
+    async def upsert(self, user: User) -> User:
+        """
+        Create a user, or update the user with the same email, in one statement.
+
+        Args:
+            user (User): The user to write.
+
+        Returns:
+            User: The stored user.
+        """
+        return (await self.upsert_many([user]))[0]
+
+    async def upsert_many(self, users: List[User]) -> List[User]:
+        """
+        Create or update several users with INSERT ... ON CONFLICT (email) DO UPDATE.
+
+        Conflicts are resolved by the database, so no IntegrityError has to be
+        caught and retried. The rows are sent in statements of at most
+        UPSERT_CHUNK_ROWS rows within one transaction.
+
+        Args:
+            users (List[User]): The users to write.
+
+        Returns:
+            List[User]: The stored users.
+        """
+        rows = list({user.email: user.model_dump() for user in users}.values())
+        await label_cache.ensure(self._session, rows, self._execute)
+        stored = []
+        for start in range(0, len(rows), UPSERT_CHUNK_ROWS):
+            if USER_TABLE_PARTITIONING == COUNTRY:
+                await self._move_to_country(rows[start:start + UPSERT_CHUNK_ROWS])
+            statement = insert(UserInDB).values(rows[start:start + UPSERT_CHUNK_ROWS])
+            statement = statement.on_conflict_do_update(
+                index_elements=UPSERT_CONFLICT_COLUMNS,
+                set_={column: statement.excluded[column]
+                      for column in ("password", "name", "country", "status")},
+            ).returning(UserInDB.email, UserInDB.name, UserInDB.country,
+                        UserInDB.status, UserInDB.password)
+            result = await self._execute(statement)
+            stored.extend(User.model_construct(**row) for row in result.mappings())
+        await self._session.commit()
+        return stored
+
+    async def _move_to_country(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Move the existing users of an upsert to the partition of their new country.
+
+        With the country layout ON CONFLICT only finds a user in the partition
+        of the country being written, so users changing country are moved first.
+
+        Args:
+            rows (List[Dict[str, Any]]): The users about to be upserted.
+        """
+        table = UserInDB.__table__
+        await self._execute(
+            update(table)
+            .where(table.c.email == bindparam("moved_email"),
+                   table.c.country != bindparam("moved_country"))
+            .values(country=bindparam("moved_country")),
+            [{"moved_email": row["email"], "moved_country": row["country"]} for row in rows])
+
+    async def update(self, email: str, changes: UserUpdate) -> Optional[User]:
+        """
+        Update the given fields of a user with one UPDATE ... RETURNING statement.
+
+        The row is not loaded into the session first and only the changed
+        columns are sent.
+
+        Args:
+            email (str): The email of the user to update.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            Optional[User]: The updated user, or None if not found.
+        """
+        values = changes.model_dump(exclude_none=True)
+        if not values:
+            return await self.get_by_email(email)
+        await label_cache.ensure(self._session, [values], self._execute)
+        statement = (update(UserInDB).where(UserInDB.email == email).values(**values)
+                     .returning(UserInDB.email, UserInDB.name, UserInDB.country,
+                                UserInDB.status, UserInDB.password)
+                     .execution_options(synchronize_session=False))
+        row = (await self._execute(statement)).mappings().first()
+        await self._session.commit()
+        return User.model_construct(**row) if row else None
+
+    async def update_where(self, user_filter: UserFilter, changes: UserUpdate) -> int:
+        """
+        Update the given fields of every user matching a filter in one statement.
+
+        Args:
+            user_filter (UserFilter): The filter criteria; the limit caps the number
+                of updated users.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            int: The number of updated users.
+        """
+        values = changes.model_dump(exclude_none=True)
+        if not values or not await self._labels_exist(user_filter):
+            return 0
+        await label_cache.ensure(self._session, [values], self._execute)
+        clauses = _filter_clauses(user_filter)
+        if user_filter.limit is not None:
+            limited_ids = select(UserInDB.id).where(*clauses).limit(user_filter.limit)
+            # The criteria are repeated so that the planner can prune partitions.
+            clauses = [UserInDB.id.in_(limited_ids), *clauses]
+        statement = (update(UserInDB).where(*clauses).values(**values)
+                     .execution_options(synchronize_session=False))
+        result = await self._execute(statement)
+        await self._session.commit()
+        return result.rowcount
+
+    async def delete(self, email: str) -> bool:
+        """
+        Delete a user.
+
+        Args:
+            email (str): The email of the user to delete.
+
+        Returns:
+            bool: True if the user existed.
+        """
+        result = await self._execute(
+            delete(UserInDB).where(UserInDB.email == email)
+            .execution_options(synchronize_session=False))
+        await self._session.commit()
+        return result.rowcount > 0
+
+    async def delete_batch(self, user_filter: UserFilter, after_id: int,
+                           batch_size: int) -> Tuple[int, Optional[int]]:
+        """
+        Delete the next batch of users matching a filter, in id order.
+
+        The batch is picked by a primary key range scan and deleted and
+        committed in its own short transaction, so locks are only held for
+        one batch at a time.
+
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            after_id (int): Only users with a greater id are deleted.
+            batch_size (int): Maximum number of users to delete.
+
+        Returns:
+            Tuple[int, Optional[int]]: The number of deleted users and the
+            greatest deleted id, None when nothing was left to delete.
+        """
+        if not await self._labels_exist(user_filter):
+            return 0, None
+        batch_ids = (select(UserInDB.id)
+                     .where(UserInDB.id > after_id, *_filter_clauses(user_filter))
+                     .order_by(UserInDB.id).limit(batch_size))
+        result = await self._execute(
+            delete(UserInDB).where(UserInDB.id.in_(batch_ids), *_filter_clauses(user_filter))
+            .returning(UserInDB.id)
+            .execution_options(synchronize_session=False))
+        deleted_ids = result.scalars().all()
+        await self._session.commit()
+        return len(deleted_ids), max(deleted_ids, default=None)
+
+    async def stream_rows(self, user_filter: UserFilter, columns: List[str],
+                          chunk_size: int) -> AsyncIterator[List[tuple]]:
+        """
+        Stream the matching users through a server-side cursor, chunk by chunk.
+
+        Only the requested columns are selected and the filter and limit are
+        applied by the database, so memory use is bounded by the chunk size.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+            columns (List[str]): Names from EXPORT_COLUMNS, in output order.
+            chunk_size (int): Maximum number of rows per chunk.
+
+        Returns:
+            AsyncIterator[List[tuple]]: The chunks of rows.
+        """
+        if not await self._labels_exist(user_filter):
+            await self._release()
+            return
+        statement = (select(*[getattr(UserInDB, column) for column in columns])
+                     .where(*_filter_clauses(user_filter)).order_by(UserInDB.id)
+                     .limit(user_filter.limit)
+                     .execution_options(yield_per=chunk_size))
+        self.queries += 1
+        result = await self._session.stream(statement)
+        async for partition in result.partitions(chunk_size):
+            yield [tuple(row) for row in partition]
+
+    async def count(self, user_filter: UserFilter, budget: float) -> UserCount:
+        """
+        Count the users matching a filter, or estimate their number.
+
+        The query is planned first. When the planner expects it to cost more
+        than COUNT_EXACT_MAX_COST, e.g. because the filter is not selective or
+        no index backs it, its row estimate is returned. Otherwise the users
+        are counted under a statement timeout of the budget, and the estimate
+        is returned if the timeout fires.
+
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            budget (float): Seconds an exact count may take at most.
+
+        Returns:
+            UserCount: The count and whether it is exact.
+        """
+        if not await self._labels_exist(user_filter):
+            await self._release()
+            return UserCount(count=0, exact=True)
+        clauses = _filter_clauses(user_filter)
+        scan = select(UserInDB.id).where(*clauses).compile(self._session.bind.sync_engine)
+        connection = await self._session.connection()
+        self.queries += 1
+        plan = (await connection.exec_driver_sql(
+            f"EXPLAIN (FORMAT JSON) {scan}", tuple(scan.params[name] for name in scan.positiontup)
+        )).scalar()[0]["Plan"]
+        estimate = UserCount(count=round(plan["Plan Rows"]), exact=False)
+        if plan["Total Cost"] > COUNT_EXACT_MAX_COST:
+            await self._release()
+            return estimate
+        # SET is not transactional once committed, so the timeout is reset whatever happens.
+        await self._execute(text(f"SET statement_timeout = {max(1, round(budget * 1000))}"))
+        try:
+            statement = select(func.count()).select_from(UserInDB)  # pylint: disable=not-callable
+            count = (await self._execute(statement.where(*clauses))).scalar()
+        except DBAPIError as error:
+            if getattr(error.orig, "pgcode", None) != QUERY_CANCELED:
+                raise
+            if not self.read_only:
+                await self._session.rollback()
+            return estimate
+        finally:
+            await self._execute(text("RESET statement_timeout"))
+        await self._release()
+        return UserCount(count=count, exact=True)
+
+    async def get_changes(self, since: Optional[str], limit: int) -> UserChanges:
+        """
+        Get the users created or updated after a cursor, in the order they were written.
+
+        Changes are ordered by the id of the writing transaction, then by
+        version, and read by a range scan of the user_table_change_cursor
+        index. Versions and transaction ids are taken before commit, so a
+        transaction still running could later commit rows that sort before
+        ones already visible. Only rows written by transactions older than
+        every running one are returned, so a cursor never skips a change;
+        a long-running write transaction holds the feed back until it ends.
+
+        Args:
+            since (Optional[str]): The cursor returned with the previous page, None for
+                the first page.
+            limit (int): Maximum number of changes.
+
+        Returns:
+            UserChanges: The changes and the cursor of the next page.
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        xid, version = parse_change_cursor(since)
+        columns = USER_CHANGES.c
+        result = await self._execute(
+            select(USER_CHANGES)
+            .where(tuple_(columns.change_xid, columns.version) > tuple_(xid, version),
+                   columns.change_xid < CHANGE_HORIZON)
+            .order_by(columns.change_xid, columns.version)
+            .limit(limit))
+        rows = result.mappings().all()
+        await self._release()
+        if rows:
+            xid, version = rows[-1]["change_xid"], rows[-1]["version"]
+        return UserChanges(changes=[UserChange.model_construct(**row) for row in rows],
+                           cursor=f"{xid}-{version}", more=len(rows) == limit)
+
+    async def create_ticketed(self, tickets: Dict[str, User]) -> Dict[str, str]:
+        """
+        Create the users of spooled tickets and record their outcomes in the request's transaction.
+
+        Args:
+            tickets (Dict[str, User]): The users to create by ticket, in spooling order.
+
+        Returns:
+            Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+        """
+        # tickets builds on this module, so it is only imported when creations are spooled.
+        from tickets import sql_create_ticketed  # pylint: disable=import-outside-toplevel
+        return await sql_create_ticketed(self._session, self._execute, tickets)
+
+    async def fail_ticketed(self, tickets: Dict[str, User]) -> None:
+        """
+        Record spooled tickets as failed in the request's transaction.
+
+        Args:
+            tickets (Dict[str, User]): The users that could not be created, by ticket.
+        """
+        from tickets import sql_fail_ticketed  # pylint: disable=import-outside-toplevel
+        await sql_fail_ticketed(self._execute, tickets)
+
+    async def get_ticket_outcome(self, ticket: str) -> Optional[str]:
+        """
+        Retrieve the outcome of a spooled ticket.
+
+        Args:
+            ticket (str): The ticket.
+
+        Returns:
+            Optional[str]: TICKET_CREATED, TICKET_DUPLICATE or TICKET_FAILED, or None if
+                not recorded.
+        """
+        from tickets import sql_get_ticket_outcome  # pylint: disable=import-outside-toplevel
+        outcome = await sql_get_ticket_outcome(self._execute, ticket)
+        await self._release()
+        return outcome
+
+    async def prune_ticket_outcomes(self, before: datetime) -> int:
+        """
+        Delete the outcomes recorded before a time, in the request's transaction.
+
+        Args:
+            before (datetime): The oldest outcome to keep.
+
+        Returns:
+            int: The number of outcomes deleted.
+        """
+        from tickets import sql_prune_ticket_outcomes  # pylint: disable=import-outside-toplevel
+        return await sql_prune_ticket_outcomes(self._execute, before)
+
+    async def save(self, user: User) -> None:
+        """
+        Save a user.
+
+        Args:
+            user (User): The user to save.
+        """
+        await label_cache.ensure(self._session, [{"country": user.country, "status": user.status}],
+                                 self._execute)
+        self._session.add(UserInDB(email=user.email, name=user.name,
+                                   country=user.country, status=user.status,
+                                   password=user.password))
+
+        await self._session.commit()
+
+
+class RepositoryStats:
+    """
+    Counts the request repositories and those closed without running a query.
+    """
+
+    def __init__(self):
+        """
+        Start with no repository counted.
+        """
+        self.requests = 0
+        self.untouched = 0
+
+    def record(self, queries: int) -> None:
+        """
+        Count a closed repository.
+
+        Args:
+            queries (int): Number of queries it ran.
+        """
+        self.requests += 1
+        if not queries:
+            self.untouched += 1
+
+    def snapshot(self) -> dict:
+        """
+        Describe the counters.
+
+        Returns:
+            dict: Repositories closed, and those that never touched the database.
+        """
+        return {"requests": self.requests, "untouched": self.untouched}
+
+
+repository_stats = RepositoryStats()
+
+
+@asynccontextmanager
+async def _request_user_repository(read_only: bool) -> AsyncIterator[UserRepository]:
+    """
+    Create the repository of a request and count it in repository_stats.
+
+    Args:
+        read_only (bool): Whether the request only reads, in autocommit.
+
+    Returns:
+        AsyncIterator[UserRepository]: A context manager yielding the repository.
+    """
+    if os.getenv("SHARD_DB_STRINGS"):
+        # sharding builds on this module, so it is only imported when shards are configured.
+        from sharding import open_sharded_user_repository  # pylint: disable=import-outside-toplevel
+        async with open_sharded_user_repository(read_only=read_only) as user_repository:
+            try:
+                yield user_repository
+            finally:
+                repository_stats.record(user_repository.queries)
+        return
+    db_string = os.getenv("DB_STRING")
+    engine = get_read_only_engine(db_string) if read_only else get_engine(db_string)
+    async with AsyncSession(engine) as session:
+        user_repository = SQLUserRepository(session, read_only)
+        if USER_REPOSITORY_BACKEND == "asyncpg":
+            # asyncpg_repository builds on this module, so it is only imported when selected.
+            from asyncpg_repository import AsyncpgUserRepository  # pylint: disable=import-outside-toplevel
+            user_repository = AsyncpgUserRepository(user_repository, db_string)
+        try:
+            yield user_repository
+        except Exception:
+            if not read_only:
+                await session.rollback()
+            raise
+        finally:
+            repository_stats.record(user_repository.queries)
+            if USER_REPOSITORY_BACKEND == "asyncpg":
+                await user_repository.close()
+            await session.close()
+
+
+async def create_user_repository() -> AsyncGenerator[UserRepository, Any]:
+    """
+    Create a SQLUserRepository instance within an async context.
+
+    Creating the session does no I/O: a connection is only checked out by
+    the first query. Repositories closed without running a query are counted
+    in repository_stats. When SHARD_DB_STRINGS is set, a
+    ShardedUserRepository is created instead. With
+    USER_REPOSITORY_BACKEND=asyncpg, the repository is wrapped in an
+    AsyncpgUserRepository serving the hot operations on raw asyncpg.
+
+    Returns:
+        AsyncGenerator[UserRepository, Any]:
+        An asynchronous generator yielding a SQLUserRepository.
+    """
+    async with _request_user_repository(read_only=False) as user_repository:
+        yield user_repository
+
+
+async def create_read_only_user_repository() -> AsyncGenerator[UserRepository, Any]:
+    """
+    Create a read-only SQLUserRepository for the routes that never write.
+
+    Its statements run in autocommit on get_read_only_engine, so a read
+    costs one round trip instead of BEGIN, the query and COMMIT. Reads made
+    by the same request do not share a snapshot.
+
+    Returns:
+        AsyncGenerator[UserRepository, Any]:
+        An asynchronous generator yielding a read-only SQLUserRepository.
+    """
+    async with _request_user_repository(read_only=True) as user_repository:
+        yield user_repository
+
+
+@asynccontextmanager
+async def open_user_repository() -> AsyncIterator[UserRepository]:
+    """
+    Open a SQLUserRepository outside of a request, e.g. for background jobs.
+
+    The session is committed when the block succeeds and rolled back otherwise.
+    When SHARD_DB_STRINGS is set, a ShardedUserRepository is opened instead.
+
+    Returns:
+        AsyncIterator[UserRepository]: A context manager yielding a SQLUserRepository.
+    """
+    if os.getenv("SHARD_DB_STRINGS"):
+        from sharding import open_sharded_user_repository  # pylint: disable=import-outside-toplevel
+        async with open_sharded_user_repository() as user_repository:
+            yield user_repository
+        return
+    async with AsyncSession(get_engine(os.getenv("DB_STRING"))) as session:
+        async with SQLUserRepository(session) as user_repository:
+            yield user_repository
+
+
+def get_user_repository_factory() -> Callable[[], AsyncContextManager[UserRepository]]:
+    """
+    Provide the factory used by work that outlives the request dependencies.
+
+    Streaming responses keep running after the dependencies have been
+    closed, so they open their own repository with this factory.
+
+    Returns:
+        Callable[[], AsyncContextManager[UserRepository]]: open_user_repository.
+    """
+    return open_user_repository
+
+
+class UserRepositoryDecorator(UserRepository):  # pylint: disable=too-many-public-methods
+    """
+    Base for repositories that add behaviour around another repository.
+
+    Every operation is delegated to the decorated repository; subclasses
+    override the ones they change. The delegating methods below do nothing
+    else, so they are documented once, on UserRepository.
+    """
+
+    def __init__(self, repository: UserRepository):
+        """
+        Initialize with the decorated repository.
+
+        Args:
+            repository (UserRepository): The decorated repository.
+        """
+        self._repository = repository
+
+    async def __aenter__(self):
+        """
+        Enter context for the decorated repository.
+
+        Returns:
+            UserRepositoryDecorator: The repository instance.
+        """
+        await self._repository.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit context for the decorated repository.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+        await self._repository.__aexit__(exc_type, exc_value, exc_traceback)
+
+    async def save(self, user: User) -> None:
+        await self._repository.save(user)
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        return await self._repository.get_by_email(email)
+
+    async def get(self, user_filter: UserFilter) -> List[User]:
+        return await self._repository.get(user_filter)
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        return await self._repository.get_versioned_by_email(email)
+
+    async def get_version(self, email: str) -> Optional[int]:
+        return await self._repository.get_version(email)
+
+    async def get_generation(self) -> int:
+        return await self._repository.get_generation()
+
+    async def get_many_by_email(self, emails: List[str]) -> List[User]:
+        return await self._repository.get_many_by_email(emails)
+
+    async def get_many_versioned_by_email(self, emails: List[str]) -> Dict[str, Tuple[User, int]]:
+        return await self._repository.get_many_versioned_by_email(emails)
+
+    async def upsert(self, user: User) -> User:
+        return await self._repository.upsert(user)
+
+    async def upsert_many(self, users: List[User]) -> List[User]:
+        return await self._repository.upsert_many(users)
+
+    async def update(self, email: str, changes: UserUpdate) -> Optional[User]:
+        return await self._repository.update(email, changes)
+
+    async def update_where(self, user_filter: UserFilter, changes: UserUpdate) -> int:
+        return await self._repository.update_where(user_filter, changes)
+
+    async def delete(self, email: str) -> bool:
+        return await self._repository.delete(email)
+
+    async def delete_batch(self, user_filter: UserFilter, after_id: int,
+                           batch_size: int) -> Tuple[int, Optional[int]]:
+        return await self._repository.delete_batch(user_filter, after_id, batch_size)
+
+    async def stream_rows(self, user_filter: UserFilter, columns: List[str],
+                          chunk_size: int) -> AsyncIterator[List[tuple]]:
+        async for chunk in self._repository.stream_rows(user_filter, columns, chunk_size):
+            yield chunk
+
+    async def count(self, user_filter: UserFilter, budget: float) -> UserCount:
+        return await self._repository.count(user_filter, budget)
+
+    async def get_changes(self, since: Optional[str], limit: int) -> UserChanges:
+        return await self._repository.get_changes(since, limit)
+
+    async def create_ticketed(self, tickets: Dict[str, User]) -> Dict[str, str]:
+        return await self._repository.create_ticketed(tickets)
+
+    async def fail_ticketed(self, tickets: Dict[str, User]) -> None:
+        await self._repository.fail_ticketed(tickets)
+
+    async def get_ticket_outcome(self, ticket: str) -> Optional[str]:
+        return await self._repository.get_ticket_outcome(ticket)
+
+    async def prune_ticket_outcomes(self, before: datetime) -> int:
+        return await self._repository.prune_ticket_outcomes(before)
+
+
+class InMemoryUserRepository:  # pylint: disable=too-many-public-methods
+    """
+    In-memory implementation of the UserRepository interface (for unit tests).
+    """
+
+    async def __aenter__(self):
+        """
+        Enter context for the in-memory repository.
+
+        Returns:
+            InMemoryUserRepository: The repository instance.
+        """
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit context for the in-memory repository.
+
+        Args:
+            exc_type (Optional[Type[BaseException]]): Exception type.
+            exc_value (Optional[BaseException]): Exception value.
+            exc_traceback (Optional[TracebackType]): Exception traceback.
+        """
+
+    def __init__(self):
+        """
+        Initialize the in-memory user repository.
+        """
+        self.data = {}
+        self.versions = {}
+        self.ids = {}
+        self.created = {}
+        self.updated = {}
+        self.tickets = {}
+        self.generation = 0
+
+    async def save(self, user: User) -> None:
+        """
+        Save a user to the in-memory repository.
+
+        Args:
+            user (User): The user to save.
+        """
+        self.data[user.email] = user
+        self.ids.setdefault(user.email, len(self.ids) + 1)
+        self._touch(user.email)
+
+    def _touch(self, email: str) -> None:
+        """
+        Stamp a written user with a new version and bump the generation.
+
+        Args:
+            email (str): The email of the written user.
+        """
+        self.generation += 1
+        self.versions[email] = self.generation
+        self.updated[email] = datetime.now(timezone.utc)
+        self.created.setdefault(email, self.updated[email])
+
+    async def get_by_email(self, email: str) -> Optional[User]:
+        """
+        Retrieve a user by email from the in-memory repository.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[User]: The user with the given email, or None if not found.
+        """
+        return self.data.get(email)
+
+    async def get(self, user_filter: UserFilter) -> List[User]:
+        """
+        Retrieve users from the in-memory repository based on filters.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+
+        Returns:
+            List[User]: List of users matching the filter criteria.
+        """
+        all_matching_users = filter(user_filter.matches, self.data.values())
+
+        return list(all_matching_users)[: user_filter.limit]
+
+    async def get_versioned_by_email(self, email: str) -> Optional[Tuple[User, int]]:
+        """
+        Retrieve a user and its version by email from the in-memory repository.
+
+        Args:
+            email (str): The email of the user to retrieve.
+
+        Returns:
+            Optional[Tuple[User, int]]: The user and its version, or None if not found.
+        """
+        if email not in self.data:
+            return None
+        return self.data[email], self.versions[email]
+
+    async def get_version(self, email: str) -> Optional[int]:
+        """
+        Retrieve the version of a user from the in-memory repository.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            Optional[int]: The version of the user, or None if not found.
+        """
+        return self.versions.get(email)
+
+    async def get_generation(self) -> int:
+        """
+        Retrieve the generation of the in-memory repository.
+
+        Returns:
+            int: The current generation.
+        """
+        return self.generation
+
+    async def get_many_by_email(self, emails: List[str]) -> List[User]:
+        """
+        Retrieve the users with any of the given emails from the in-memory repository.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            List[User]: The users found, emails without a user are left out.
+        """
+        return [user for user, _ in (await self.get_many_versioned_by_email(emails)).values()]
+
+    async def get_many_versioned_by_email(self, emails: List[str]) -> Dict[str, Tuple[User, int]]:
+        """
+        Retrieve the users with any of the given emails and their versions
+        from the in-memory repository.
+
+        Args:
+            emails (List[str]): The emails of the users to retrieve.
+
+        Returns:
+            Dict[str, Tuple[User, int]]: The users found and their versions, keyed by email.
+        """
+        return {email: (self.data[email], self.versions[email])
+                for email in emails if email in self.data}
+
+    async def upsert(self, user: User) -> User:
+        """
+        Create or update a user in the in-memory repository.
+
+        Args:
+            user (User): The user to write.
+
+        Returns:
+            User: The stored user.
+        """
+        await self.save(user)
+        return user
+
+    async def upsert_many(self, users: List[User]) -> List[User]:
+        """
+        Create or update several users in the in-memory repository.
+
+        Args:
+            users (List[User]): The users to write.
+
+        Returns:
+            List[User]: The stored users.
+        """
+        for user in users:
+            await self.save(user)
+        return list({user.email: user for user in users}.values())
+
+    async def update(self, email: str, changes: UserUpdate) -> Optional[User]:
+        """
+        Update the given fields of a user in the in-memory repository.
+
+        Args:
+            email (str): The email of the user to update.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            Optional[User]: The updated user, or None if not found.
+        """
+        if email not in self.data:
+            return None
+        values = changes.model_dump(exclude_none=True)
+        if values:
+            self.data[email] = self.data[email].model_copy(update=values)
+            self._touch(email)
+        return self.data[email]
+
+    async def update_where(self, user_filter: UserFilter, changes: UserUpdate) -> int:
+        """
+        Update the given fields of every matching user in the in-memory repository.
+
+        Args:
+            user_filter (UserFilter): The filter criteria; the limit caps the number
+                of updated users.
+            changes (UserUpdate): The fields to change.
+
+        Returns:
+            int: The number of updated users.
+        """
+        if not changes.model_dump(exclude_none=True):
+            return 0
+        matching_users = await self.get(user_filter)
+        for user in matching_users:
+            await self.update(user.email, changes)
+        return len(matching_users)
+
+    async def delete(self, email: str) -> bool:
+        """
+        Delete a user from the in-memory repository.
+
+        Args:
+            email (str): The email of the user to delete.
+
+        Returns:
+            bool: True if the user existed.
+        """
+        if self.data.pop(email, None) is None:
+            return False
+        del self.versions[email]
+        del self.ids[email]
+        del self.created[email]
+        del self.updated[email]
+        self.generation += 1
+        return True
+
+    async def delete_batch(self, user_filter: UserFilter, after_id: int,
+                           batch_size: int) -> Tuple[int, Optional[int]]:
+        """
+        Delete the next batch of matching users from the in-memory repository, in id order.
+
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            after_id (int): Only users with a greater id are deleted.
+            batch_size (int): Maximum number of users to delete.
+
+        Returns:
+            Tuple[int, Optional[int]]: The number of deleted users and the
+            greatest deleted id, None when nothing was left to delete.
+        """
+        batch = sorted((user_id, email) for email, user_id in self.ids.items()
+                       if user_id > after_id and user_filter.matches(self.data[email]))[:batch_size]
+        for _, email in batch:
+            await self.delete(email)
+        return len(batch), batch[-1][0] if batch else None
+
+    async def stream_rows(self, user_filter: UserFilter, columns: List[str],
+                          chunk_size: int) -> AsyncIterator[List[tuple]]:
+        """
+        Stream the matching users of the in-memory repository, chunk by chunk.
+
+        Args:
+            user_filter (UserFilter): The filter criteria.
+            columns (List[str]): Names from EXPORT_COLUMNS, in output order.
+            chunk_size (int): Maximum number of rows per chunk.
+
+        Returns:
+            AsyncIterator[List[tuple]]: The chunks of rows.
+        """
+        rows = [tuple({"id": self.ids[user.email], "version": self.versions[user.email],
+                       **user.model_dump()}[column] for column in columns)
+                for user in await self.get(user_filter)]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    async def count(self, user_filter: UserFilter,
+                    budget: float) -> UserCount:  # pylint: disable=unused-argument
+        """
+        Count the matching users of the in-memory repository.
+
+        Args:
+            user_filter (UserFilter): The filter criteria, the limit is ignored.
+            budget (float): Unused, counting is always exact.
+
+        Returns:
+            UserCount: The exact count.
+        """
+        return UserCount(count=sum(user_filter.matches(user) for user in self.data.values()),
+                         exact=True)
+
+    async def get_changes(self, since: Optional[str], limit: int) -> UserChanges:
+        """
+        Get the users of the in-memory repository written after a cursor, by version.
+
+        Args:
+            since (Optional[str]): The cursor returned with the previous page, None for
+                the first page.
+            limit (int): Maximum number of changes.
+
+        Returns:
+            UserChanges: The changes and the cursor of the next page.
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        xid, version = parse_change_cursor(since)
+        emails = sorted((email for email in self.data if self.versions[email] > version),
+                        key=self.versions.__getitem__)[:limit]
+        changes = [UserChange(**self.data[email].model_dump(exclude={"password"}),
+                              version=self.versions[email], created_at=self.created[email],
+                              updated_at=self.updated[email]) for email in emails]
+        cursor = f"0-{changes[-1].version}" if changes else f"{xid}-{version}"
+        return UserChanges(changes=changes, cursor=cursor, more=len(changes) == limit)
+
+    async def create_ticketed(self, tickets: Dict[str, User]) -> Dict[str, str]:
+        """
+        Create the users of spooled tickets in the in-memory repository.
+
+        Args:
+            tickets (Dict[str, User]): The users to create by ticket, in spooling order.
+
+        Returns:
+            Dict[str, str]: TICKET_CREATED or TICKET_DUPLICATE by ticket.
+        """
+        from tickets import memory_create_ticketed  # pylint: disable=import-outside-toplevel
+        return await memory_create_ticketed(self, tickets)
+
+    async def fail_ticketed(self, tickets: Dict[str, User]) -> None:
+        """
+        Record spooled tickets as failed in the in-memory repository.
+
+        Args:
+            tickets (Dict[str, User]): The users that could not be created, by ticket.
+        """
+        from tickets import memory_fail_ticketed  # pylint: disable=import-outside-toplevel
+        memory_fail_ticketed(self, tickets)
+
+    async def get_ticket_outcome(self, ticket: str) -> Optional[str]:
+        """
+        Retrieve the outcome of a spooled ticket from the in-memory repository.
+
+        Args:
+            ticket (str): The ticket.
+
+        Returns:
+            Optional[str]: TICKET_CREATED, TICKET_DUPLICATE or TICKET_FAILED, or None if
+                not recorded.
+        """
+        return self.tickets[ticket][0] if ticket in self.tickets else None
+
+    async def prune_ticket_outcomes(self, before: datetime) -> int:
+        """
+        Forget the outcomes recorded before a time.
+
+        Args:
+            before (datetime): The oldest outcome to keep.
+
+        Returns:
+            int: The number of outcomes forgotten.
+        """
+        from tickets import memory_prune_ticket_outcomes  # pylint: disable=import-outside-toplevel
+        return memory_prune_ticket_outcomes(self, before)